@@ -0,0 +1,125 @@
+'''
+
+cached cosmological calculations shared by all the fitters. astropy
+cosmology calculations are slow compared to the rest of a likelihood
+evaluation, so the age of the universe and the luminosity distance are
+tabulated once per cosmology and interpolated. Outside of the tabulated
+redshift range the exact astropy values are returned.
+
+The default redshift range of the tables is module-level configuration (see
+`set_zrange`). The fitters look up the table at every call, so changing the
+range also applies to fitters that already exist from their next model
+evaluation on. Avoid changing it in the middle of a fit.
+
+    >>> from gqp_mc import cosmology as Cosmo
+    >>> tage = Cosmo.age(cosmo, 0.1) # Gyr
+    >>> d_lum = Cosmo.luminosity_distance(cosmo, 0.1) # cm
+
+'''
+import numpy as np
+import scipy.interpolate as Interp
+from astropy import units as U
+
+
+# default redshift range and number of points of the tables
+_zrange = {'zmin': 0., 'zmax': 3., 'nz': 3000}
+
+# tables for each cosmology. keyed by id(cosmo) since astropy cosmologies are
+# not hashable
+_tables = {}
+
+
+class CosmoTable(object):
+    ''' interpolation tables of the age of the universe and the luminosity
+    distance for a given cosmology
+
+    :param cosmo:
+        astropy.cosmology object
+    :param zmin: (default: 0.)
+        minimum redshift of the table
+    :param zmax: (default: 3.)
+        maximum redshift of the table
+    :param nz: (default: 3000)
+        number of redshift bins
+    '''
+    def __init__(self, cosmo, zmin=0., zmax=3., nz=3000):
+        self.cosmo  = cosmo
+        self.zmin   = zmin
+        self.zmax   = zmax
+
+        _z = np.linspace(zmin, zmax, nz)
+        self._age_interp = Interp.InterpolatedUnivariateSpline(
+                _z, cosmo.age(_z).value, k=3)
+        self._d_lum_interp = Interp.InterpolatedUnivariateSpline(
+                _z, cosmo.luminosity_distance(_z).to(U.cm).value, k=3)
+
+    def age(self, z):
+        ''' age of the universe at redshift z in Gyr
+        '''
+        return self._evaluate(z, self._age_interp,
+                lambda _z: self.cosmo.age(_z).value)
+
+    def luminosity_distance(self, z):
+        ''' luminosity distance at redshift z in cm
+        '''
+        return self._evaluate(z, self._d_lum_interp,
+                lambda _z: self.cosmo.luminosity_distance(_z).to(U.cm).value)
+
+    def _evaluate(self, z, interp, exact):
+        ''' interpolate within the redshift range of the table and evaluate
+        exactly outside of it
+        '''
+        if np.isscalar(z):
+            if self.zmin <= z <= self.zmax: return float(interp(z))
+            return float(exact(z))
+
+        z = np.asarray(z, dtype=float)
+        inrange = (z >= self.zmin) & (z <= self.zmax)
+        out = np.empty(z.shape)
+        out[inrange] = interp(z[inrange])
+        if not np.all(inrange):
+            out[~inrange] = exact(z[~inrange])
+        return out
+
+
+def get_table(cosmo, zmin=None, zmax=None, nz=None):
+    ''' get the (shared) interpolation table for the cosmology. Tables are
+    built once per cosmology object and redshift range.
+
+    :param cosmo:
+        astropy.cosmology object
+    :param zmin, zmax, nz: (default: None)
+        redshift range and number of bins of the table. If None, the defaults
+        set by `set_zrange` are used.
+    '''
+    zmin = _zrange['zmin'] if zmin is None else zmin
+    zmax = _zrange['zmax'] if zmax is None else zmax
+    nz = _zrange['nz'] if nz is None else nz
+
+    key = (id(cosmo), zmin, zmax, nz)
+    if key not in _tables or _tables[key].cosmo is not cosmo:
+        _tables[key] = CosmoTable(cosmo, zmin=zmin, zmax=zmax, nz=nz)
+    return _tables[key]
+
+
+def set_zrange(zmin=0., zmax=3., nz=3000):
+    ''' set the default redshift range and number of bins of the tables used
+    by the fitters. This applies to all fitters, including existing ones, from
+    their next model evaluation on. Tables of the previous range are kept. 
+    '''
+    _zrange['zmin'] = zmin
+    _zrange['zmax'] = zmax
+    _zrange['nz'] = nz
+    return None
+
+
+def age(cosmo, z):
+    ''' age of the universe at redshift z in Gyr
+    '''
+    return get_table(cosmo).age(z)
+
+
+def luminosity_distance(cosmo, z):
+    ''' luminosity distance at redshift z in cm
+    '''
+    return get_table(cosmo).luminosity_distance(z)
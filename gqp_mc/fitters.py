@@ -1,10 +1,15 @@
 import os 
+import sys 
 import h5py 
+import threading
 import fsps
+import emcee
 import pickle
 import numpy as np 
+from collections import OrderedDict
 from scipy.stats import sigmaclip
 from scipy.special import gammainc
+import scipy.sparse as Sparse
 import scipy.interpolate as Interp
 # --- astropy --- 
 from astropy import units as U
@@ -13,12 +18,36 @@ from astropy.cosmology import Planck13 as cosmo
 from speclite import filters as specFilter
 # --- gqp_mc --- 
 from . import util as UT
+from . import cosmology as Cosmo
 from .firefly._firefly import hpf, curve_smoother, calculate_averages_pdf, convert_chis_to_probs
 
 
 class Fitter(object): 
     def __init__(self): 
+        self._config = {} # arguments of __init__ (see __getstate__) 
         self.prior = None   # prior object 
+        self._photo_projections = {} # cached filter projections 
+
+    def __getstate__(self): 
+        ''' only the configuration of the fitter (the arguments of __init__)
+        is pickled. FSPS, the emulator weights, caches, and the sampler are 
+        rebuilt on first use after unpickling (see `__getattr__`), so fitters
+        can be sent cheaply to multiprocessing workers. 
+        '''
+        return {'_config': self._config, '_uninitiated': True} 
+
+    def __setstate__(self, state): 
+        self.__dict__.update(state) 
+
+    def __getattr__(self, name): 
+        ''' initialize an unpickled fitter on the first access of an attribute
+        that is not set 
+        '''
+        if name.startswith('__') or not self.__dict__.get('_uninitiated', False): 
+            raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+        self._uninitiated = False 
+        self.__init__(**self._config) 
+        return getattr(self, name) 
 
     def _check_mask(self, mask, wave_obs, flux_ivar_obs, zred): 
         ''' check that mask is sensible and mask out any parts of the 
@@ -57,6 +86,85 @@ class Fitter(object):
         if _prior == 0: return -np.inf 
         else: return np.log(_prior) 
 
+    def _get_photo(self, w, spec, filters): 
+        ''' photometry of (N x Nwave array of) spectra in units of nanomaggies.
+        Photometry is linear in the spectra, so it is computed as a dot product
+        with the cached filter projection matrix (see `_photo_projection`). 
+
+        :param w: 
+            observed-frame wavelength of the spectra 
+        :param spec: 
+            (N x Nwave array of) spectra in units of 1e-17 * erg/s/cm^2/Angstrom
+        :param filters: 
+            speclite.filters filter object
+        :return photo: 
+            N x Nband array of photometric fluxes in nanomaggies 
+        '''
+        return np.dot(np.atleast_2d(spec), self._photo_projection(w, filters).T)
+
+    def _photo_projection(self, w, filters): 
+        ''' Nband x Nwave filter projection matrix that converts spectra on the
+        observed-frame wavelength grid w (in units of 1e-17
+        erg/s/cm^2/Angstrom) into photometry in nanomaggies. The matrix is
+        computed once with speclite for each set of filters and wavelength
+        grid (i.e. model and redshift) and cached. The cache is keyed by a
+        hash of the wavelength grid. 
+        '''
+        w = np.ascontiguousarray(w, dtype=float) 
+        key = (tuple(filters.names), len(w), hash(w.tobytes())) 
+        if key not in self._photo_projections: 
+            if len(self._photo_projections) >= 32: 
+                # drop the oldest projection
+                self._photo_projections.pop(next(iter(self._photo_projections)))
+            self._photo_projections[key] = self._build_photo_projection(w, filters) 
+        return self._photo_projections[key]
+
+    def _build_photo_projection(self, w, filters, window=None): 
+        ''' build the filter projection matrix by applying speclite to unit
+        spectra (in chunks). 
+
+        :param w: 
+            observed-frame wavelength 
+        :param filters: 
+            speclite.filters filter object
+        :param window: (default: None) 
+            slice of w. If specified, only the columns of the projection within
+            the window are computed (i.e. the spectra are zero outside of it). 
+        :return proj: 
+            Nband x Nwindow projection matrix 
+        '''
+        if window is None: window = slice(0, len(w)) 
+        cols = np.arange(len(w))[window] 
+
+        nchunk = 500 
+        proj = np.zeros((len(filters.names), len(cols))) 
+        for i0 in range(0, len(cols), nchunk): 
+            i1 = min(i0 + nchunk, len(cols)) 
+            unit = np.zeros((i1 - i0, len(w))) 
+            unit[np.arange(i1 - i0), cols[i0:i1]] = 1. 
+            proj[:,i0:i1] = self._get_ab_maggies(w, unit, filters).T 
+        return proj
+
+    def _get_ab_maggies(self, w, spec, filters): 
+        ''' photometry of N x Nwave array of spectra in units of nanomaggies
+        using speclite. 
+        '''
+        maggies = filters.get_ab_maggies(np.atleast_2d(spec) * 1e-17*U.erg/U.s/U.cm**2/U.Angstrom, 
+                wavelength=w*U.Angstrom) # maggies 
+        return np.array([maggies[band] for band in maggies.colnames]).T * 1e9
+
+    def _lnPrior_batch(self, tt_arr, prior=None): 
+        ''' log prior(theta) for an N x Ntheta array of parameters. 
+        '''
+        assert prior is not None 
+        tt_arr = np.atleast_2d(tt_arr) 
+
+        if isinstance(prior, UniformPrior): 
+            inprior = (np.all(tt_arr < prior.max, axis=1) & 
+                    np.all(tt_arr >= prior.min, axis=1))
+            return np.where(inprior, 0., -np.inf) 
+        return np.array([self._lnPrior(tt, prior=prior) for tt in tt_arr]) 
+
     def _default_prior(self): 
         ''' set self.prior to be default prior 
         '''
@@ -88,15 +196,53 @@ class iFSPS(Fitter):
     :param cosmo: (optional) 
         astropy.cosmology object that specifies the cosmology.(default: astropy.cosmology.Planck13) 
 
+    :param grid: (optional) 
+        hdf5 file of a precomputed FSPS grid (see `iFSPS.build_grid`). If specified, 
+        model spectra are interpolated from the grid rather than computed with FSPS. 
+        (default: None) 
+
+    :param dust_cache: (optional) 
+        If True, dust-free FSPS spectra are cached by (logzsol, tau, tage) and the 
+        Calzetti attenuation is applied analytically, so that changes in dust2 do not 
+        require FSPS calls. Only available for the Calzetti models (vanilla and 
+        vanilla_kroupa). FSPS dust re-emission, which only contributes at rest-frame 
+        wavelengths >~ 2.5 micron, is not included. The cache only hits if Z,
+        tau, and tage are exactly the same, which is not the case for the
+        default emcee stretch move or the optimizer since they move all the
+        parameters. With the cache, emcee therefore mixes in moves that only
+        update dust2 (see dust_moves). (default: False) 
+
+    :param dust_cache_size: (optional) 
+        maximum number of dust-free spectra kept in the cache. Least recently used
+        spectra are dropped first. Should be several times the number of walkers,
+        so that the current walker positions stay in the cache. (default: 500) 
+
+    :param dust_moves: (optional) 
+        fraction of emcee steps that only update dust2 (see
+        `SubspaceStretchMove`) when dust_cache is True. The log posteriors of
+        these steps are computed from the cached dust-free spectra without
+        FSPS calls. (default: 0.5) 
+
     '''
-    def __init__(self, model_name='vanilla', cosmo=cosmo): 
+    def __init__(self, model_name='vanilla', cosmo=cosmo, grid=None, dust_cache=False, 
+            dust_cache_size=500, dust_moves=0.5): 
+        self._config = {'model_name': model_name, 'cosmo': cosmo, 'grid': grid, 
+                'dust_cache': dust_cache, 'dust_cache_size': dust_cache_size, 
+                'dust_moves': dust_moves} 
         self._init_model(model_name)
         self.cosmo      = cosmo # cosmology  
         self.ssp        = self._ssp_initiate() # initial ssp
+        self._photo_projections = {} # cached filter projections 
+        self._grid      = None # precomputed FSPS grid 
+        if grid is not None: self.load_grid(grid) 
+        self._native_mags = {} # validated native FSPS photometry 
+        self._init_dust_cache(dust_cache, dust_cache_size) 
+        self._dust_move_fraction = dust_moves 
         
     def MCMC_spectrophoto(self, wave_obs, flux_obs, flux_ivar_obs, photo_obs, photo_ivar_obs, zred, prior=None, 
             mask=None, bands='desi', nwalkers=100, burnin=100, niter=1000,
-            maxiter=200000, opt_maxiter=100, writeout=None, silent=True): 
+            maxiter=200000, opt_maxiter=100, nprocs=None, stop='psrf', chain_file=None, 
+            thin=1, resume=False, init='optimize', warm_start=None, writeout=None, silent=True): 
         ''' infer the posterior distribution of the free parameters given spectroscopy and photometry:
         observed wavelength, spectra flux, inverse variance flux, photometry, inv. variance photometry
         using MCMC. The function outputs a dictionary with the median theta of the posterior as well as 
@@ -142,6 +288,44 @@ class iFSPS(Fitter):
         :param opt_maxiter: (default: 100)
             maximum number of iterations for initial optimizer before MCMC is
             run. 
+
+        :param nprocs: (optional) 
+            number of processes used to evaluate the walkers. Each process
+            has its own copy of the fitter and FSPS. (default: None) 
+
+        :param stop: (optional) 
+            stopping rule if niter == 'adaptive': 'psrf' (Gelman-Rubin) or
+            'autocorr' (chain longer than 50 autocorrelation times). With
+            'autocorr', the chain is also thinned by the autocorrelation time.
+            (default: 'psrf') 
+
+        :param chain_file: (optional) 
+            hdf5 file where the MCMC chain is streamed to in compressed blocks
+            while sampling, so that only the last block is kept in memory
+            (see `ChainBackend`). output['mcmc_chain'] is then a `ChainView`
+            that is read from chain_file block by block as it is needed. If
+            None, the chain is kept in memory. (default: None) 
+
+        :param thin: (optional) 
+            thinning of the returned MCMC chain. (default: 1) 
+
+        :param resume: (optional) 
+            If True, continue an interrupted run from the last checkpoint in
+            chain_file. The sampler state is checkpointed to chain_file after
+            the burn in and every 1000 iterations. (default: False) 
+
+        :param init: (optional) 
+            walker initialization: 'optimize' (small ball around the optimum
+            from the middle of the prior) or 'multistart' (around the best
+            optima of local optimizations from a Latin hypercube of starting
+            points). (default: 'optimize') 
+
+        :param warm_start: (optional) 
+            output dictionary, or file written by `writeout`, of a previous fit
+            of the same galaxy (e.g. `MCMC_photo`). If specified, the walkers
+            are initialized by resampling its MCMC chain and no optimization is
+            run. f_fiber is initialized around its best-fit value if the chain
+            does not include it. (default: None) 
         
         :param writeout: (optional) 
             string specifying the output file. If specified, everything in the output dictionary 
@@ -186,6 +370,11 @@ class iFSPS(Fitter):
                 'prior': prior          # prior
                 }
         
+        if warm_start is not None: 
+            # initialize the walkers from the posterior of a previous fit 
+            init = self._warm_start(warm_start, nwalkers, prior, wave_obs,
+                    flux_obs, flux_ivar_obs, zred, mask=_mask, silent=silent) 
+
         # run emcee and get MCMC chains 
         chain = self._emcee(
                 self._lnPost_spectrophoto, 
@@ -196,6 +385,13 @@ class iFSPS(Fitter):
                 niter=niter, 
                 maxiter=maxiter,
                 opt_maxiter=opt_maxiter,
+                moves=self._dust_moves(), 
+                nprocs=nprocs, 
+                stop=stop, 
+                chain_file=chain_file, 
+                thin=thin, 
+                resume=resume, 
+                init=init, 
                 silent=silent)
 
         prior_ranges = np.vstack([prior.min, prior.max]).T
@@ -203,7 +399,7 @@ class iFSPS(Fitter):
         self.theta_names += ['f_fiber']
 
         # get quanitles of the posterior
-        lowlow, low, med, high, highhigh = np.percentile(chain, [2.5, 16, 50, 84, 97.5], axis=0)
+        lowlow, low, med, high, highhigh = _chain_percentile(chain, [2.5, 16, 50, 84, 97.5])
     
         output = {} 
         output['redshift'] = zred
@@ -234,13 +430,17 @@ class iFSPS(Fitter):
         if writeout is not None: 
             fh5  = h5py.File(writeout, 'w') 
             for k in output.keys(): 
-                fh5.create_dataset(k, data=output[k]) 
+                if k == 'mcmc_chain': # compress the chain 
+                    _write_chain(fh5, k, output[k]) 
+                else: 
+                    fh5.create_dataset(k, data=output[k]) 
             fh5.close() 
         return output  
 
     def MCMC_spec(self, wave_obs, flux_obs, flux_ivar_obs, zred, mask=None, prior=None,
             nwalkers=100, burnin=100, niter=1000, maxiter=200000,
-            opt_maxiter=100, writeout=None, silent=True): 
+            opt_maxiter=100, nprocs=None, stop='psrf', chain_file=None, thin=1,
+            resume=False, init='optimize', writeout=None, silent=True): 
         ''' infer the posterior distribution of the free parameters given observed
         wavelength, spectra flux, and inverse variance using MCMC. The function 
         outputs a dictionary with the median theta of the posterior as well as the 
@@ -280,6 +480,37 @@ class iFSPS(Fitter):
         :param opt_maxiter: (default: 100)
             maximum number of iterations for initial optimizer before MCMC is
             run. 
+
+        :param nprocs: (optional) 
+            number of processes used to evaluate the walkers. Each process
+            has its own copy of the fitter and FSPS. (default: None) 
+
+        :param stop: (optional) 
+            stopping rule if niter == 'adaptive': 'psrf' (Gelman-Rubin) or
+            'autocorr' (chain longer than 50 autocorrelation times). With
+            'autocorr', the chain is also thinned by the autocorrelation time.
+            (default: 'psrf') 
+
+        :param chain_file: (optional) 
+            hdf5 file where the MCMC chain is streamed to in compressed blocks
+            while sampling, so that only the last block is kept in memory
+            (see `ChainBackend`). output['mcmc_chain'] is then a `ChainView`
+            that is read from chain_file block by block as it is needed. If
+            None, the chain is kept in memory. (default: None) 
+
+        :param thin: (optional) 
+            thinning of the returned MCMC chain. (default: 1) 
+
+        :param resume: (optional) 
+            If True, continue an interrupted run from the last checkpoint in
+            chain_file. The sampler state is checkpointed to chain_file after
+            the burn in and every 1000 iterations. (default: False) 
+
+        :param init: (optional) 
+            walker initialization: 'optimize' (small ball around the optimum
+            from the middle of the prior) or 'multistart' (around the best
+            optima of local optimizations from a Latin hypercube of starting
+            points). (default: 'optimize') 
         
         :param writeout: (optional) 
             string specifying the output file. If specified, everything in the output dictionary 
@@ -325,12 +556,19 @@ class iFSPS(Fitter):
                 niter=niter, 
                 maxiter=maxiter,
                 opt_maxiter=opt_maxiter,
+                moves=self._dust_moves(), 
+                nprocs=nprocs, 
+                stop=stop, 
+                chain_file=chain_file, 
+                thin=thin, 
+                resume=resume, 
+                init=init, 
                 silent=silent)
 
         prior_ranges = np.vstack([prior.min, prior.max]).T
     
         # get quanitles of the posterior
-        lowlow, low, med, high, highhigh = np.percentile(chain, [2.5, 16, 50, 84, 97.5], axis=0)
+        lowlow, low, med, high, highhigh = _chain_percentile(chain, [2.5, 16, 50, 84, 97.5])
     
         output = {} 
         output['redshift'] = zred
@@ -357,13 +595,17 @@ class iFSPS(Fitter):
         if writeout is not None: 
             fh5  = h5py.File(writeout, 'w') 
             for k in output.keys(): 
-                fh5.create_dataset(k, data=output[k]) 
+                if k == 'mcmc_chain': # compress the chain 
+                    _write_chain(fh5, k, output[k]) 
+                else: 
+                    fh5.create_dataset(k, data=output[k]) 
             fh5.close() 
         return output  
     
     def MCMC_photo(self, photo_obs, photo_ivar_obs, zred, bands='desi', prior=None,
             nwalkers=100, burnin=100, niter=1000, maxiter=200000,
-            opt_maxiter=100, writeout=None, silent=True): 
+            opt_maxiter=100, native_mags=False, nprocs=None, stop='psrf', 
+            chain_file=None, thin=1, resume=False, init='optimize', writeout=None, silent=True): 
         ''' infer the posterior distribution of the free parameters given observed
         photometric flux, and inverse variance using MCMC. The function 
         outputs a dictionary with the median theta of the posterior as well as the 
@@ -399,6 +641,44 @@ class iFSPS(Fitter):
         :param opt_maxiter: (default: 100)
             maximum number of iterations for initial optimizer before MCMC is
             run. 
+
+        :param nprocs: (optional) 
+            number of processes used to evaluate the walkers. Each process
+            has its own copy of the fitter and FSPS. (default: None) 
+
+        :param stop: (optional) 
+            stopping rule if niter == 'adaptive': 'psrf' (Gelman-Rubin) or
+            'autocorr' (chain longer than 50 autocorrelation times). With
+            'autocorr', the chain is also thinned by the autocorrelation time.
+            (default: 'psrf') 
+
+        :param chain_file: (optional) 
+            hdf5 file where the MCMC chain is streamed to in compressed blocks
+            while sampling, so that only the last block is kept in memory
+            (see `ChainBackend`). output['mcmc_chain'] is then a `ChainView`
+            that is read from chain_file block by block as it is needed. If
+            None, the chain is kept in memory. (default: None) 
+
+        :param thin: (optional) 
+            thinning of the returned MCMC chain. (default: 1) 
+
+        :param resume: (optional) 
+            If True, continue an interrupted run from the last checkpoint in
+            chain_file. The sampler state is checkpointed to chain_file after
+            the burn in and every 1000 iterations. (default: False) 
+
+        :param init: (optional) 
+            walker initialization: 'optimize' (small ball around the optimum
+            from the middle of the prior) or 'multistart' (around the best
+            optima of local optimizations from a Latin hypercube of starting
+            points). (default: 'optimize') 
+
+        :param native_mags: (default: False) 
+            If True, model photometry is computed by FSPS with its built-in 
+            filters rather than by integrating the model spectra through the 
+            speclite filters. FSPS photometry is validated against the speclite
+            photometry at several draws from the prior and is only used for
+            this fit if they agree (see `_native_mags_setup`). 
         
         :param writeout: (optional) 
             string specifying the output file. If specified, everything in the output dictionary 
@@ -429,6 +709,10 @@ class iFSPS(Fitter):
         # get filters
         filters = specFilter.load_filters(*tuple(bands_list))
 
+        if native_mags: 
+            # validate FSPS photometry over the prior 
+            native_mags = self._native_mags_setup(filters, zred, prior, silent=silent) 
+
         # posterior function args and kwargs
         lnpost_args = (
                 photo_obs,               # nanomaggies
@@ -437,6 +721,7 @@ class iFSPS(Fitter):
                 ) 
         lnpost_kwargs = {
                 'filters': filters,
+                'native_mags': native_mags, # FSPS photometry 
                 'prior': prior  # prior object
                 }
     
@@ -450,12 +735,19 @@ class iFSPS(Fitter):
                 niter=niter, 
                 maxiter=maxiter,
                 opt_maxiter=opt_maxiter,
+                moves=self._dust_moves(), 
+                nprocs=nprocs, 
+                stop=stop, 
+                chain_file=chain_file, 
+                thin=thin, 
+                resume=resume, 
+                init=init, 
                 silent=silent)
 
         prior_ranges = np.vstack([prior.min, prior.max]).T
     
         # get quanitles of the posterior
-        lowlow, low, med, high, highhigh = np.percentile(chain, [2.5, 16, 50, 84, 97.5], axis=0)
+        lowlow, low, med, high, highhigh = _chain_percentile(chain, [2.5, 16, 50, 84, 97.5])
     
         output = {} 
         output['redshift'] = zred
@@ -467,7 +759,7 @@ class iFSPS(Fitter):
         output['theta_1sig_minus'] = low
         output['theta_2sig_minus'] = lowlow
     
-        flux_model = self.model_photo(med, zred=zred, filters=filters)
+        flux_model = self.model_photo(med, zred=zred, filters=filters, native_mags=native_mags)
         output['flux_photo_model'] = flux_model
         output['flux_photo_data'] = photo_obs
         output['flux_photo_ivar_data'] = photo_ivar_obs
@@ -479,7 +771,10 @@ class iFSPS(Fitter):
         if writeout is not None: 
             fh5  = h5py.File(writeout, 'w') 
             for k in output.keys(): 
-                fh5.create_dataset(k, data=output[k]) 
+                if k == 'mcmc_chain': # compress the chain 
+                    _write_chain(fh5, k, output[k]) 
+                else: 
+                    fh5.create_dataset(k, data=output[k]) 
             fh5.close() 
         return output  
 
@@ -504,30 +799,22 @@ class iFSPS(Fitter):
         outspec : array 
             spectra generated from FSPS model(theta) in units of 1e-17 * erg/s/cm^2/Angstrom
         '''
-        tage    = self.cosmo.age(zred).value # age of the universe at z=zred in Gyr
+        tage    = Cosmo.age(self.cosmo, zred) # age of the universe at z=zred in Gyr
         theta   = self._theta(tt_arr) 
 
-        if self.model_name in ['vanilla', 'vanilla_kroupa']: 
-            self.ssp.params['logzsol']  = np.log10(theta['Z']/0.0190) # log(z/zsun) 
-            self.ssp.params['dust2']    = theta['dust2'] # dust2 parameter in fsps 
-            self.ssp.params['tau']      = theta['tau'] # sfh parameter 
-
-            w, ssp_lum = self.ssp.get_spectrum(tage=tage, peraa=True) 
-        elif self.model_name == 'vanilla_complexdust': 
-            self.ssp.params['logzsol']  = np.log10(theta['Z']/0.0190) # log(z/zsun) 
-            self.ssp.params['dust1']    = theta['dust1'] # dust1 parameter in fsps 
-            self.ssp.params['dust2']    = theta['dust2'] # dust2 parameter in fsps 
-            self.ssp.params['dust_index'] = theta['dust_index'] # dust2 parameter in fsps 
-            self.ssp.params['tau']      = theta['tau'] # sfh parameter 
-
-            w, ssp_lum = self.ssp.get_spectrum(tage=tage, peraa=True) 
+        ssp_lum = None 
+        if self._grid is not None: 
+            # interpolate the tabulated grid (None if outside of the grid) 
+            w, ssp_lum = self._grid_spectrum(tt_arr, tage) 
+        if ssp_lum is None: 
+            w, ssp_lum = self._fsps_spectrum(tt_arr, tage) 
 
         # mass normalization
         lum_ssp = theta['mass'] * ssp_lum
 
         # redshift the spectra
         w_z = w * (1. + zred)
-        d_lum = self.cosmo.luminosity_distance(zred).to(U.cm).value # luminosity distance in cm
+        d_lum = Cosmo.luminosity_distance(self.cosmo, zred) # luminosity distance in cm
         flux_z = lum_ssp * UT.Lsun() / (4. * np.pi * d_lum**2) / (1. + zred) * 1e17 # 10^-17 ergs/s/cm^2/Ang
 
         if wavelength is None: 
@@ -540,7 +827,7 @@ class iFSPS(Fitter):
 
         return outwave, outspec 
    
-    def model_photo(self, tt_arr, zred=0.1, filters=None, bands=None): 
+    def model_photo(self, tt_arr, zred=0.1, filters=None, bands=None, native_mags=False): 
         ''' very simple wrapper for a fsps model with minimal overhead. Generates photometry 
         in specified photometric bands 
 
@@ -557,6 +844,11 @@ class iFSPS(Fitter):
             photometric bands to generate the photometry. Either bands or filters has to be 
             specified. (default: None)  
 
+        :param native_mags: (default: False) 
+            If True, use the photometry computed by FSPS with its built-in
+            filters, if it has been validated for the filters and redshift by
+            `_native_mags_setup`. Otherwise, the speclite photometry is used. 
+
         :return outphoto:
             array of photometric fluxes in nanomaggies in the specified bands 
         '''
@@ -567,12 +859,90 @@ class iFSPS(Fitter):
             else: 
                 raise ValueError("specify either filters or bands") 
 
+        native = None 
+        if native_mags: 
+            native = self._native_mags.get((tuple(filters.names), float(zred)))
+        if native is not None: 
+            # magnitudes computed by FSPS (see self._native_mags_setup) 
+            return native['scale'] * self._model_photo_native(tt_arr, zred, native['fsps_bands'])
+
         w, spec = self.model(tt_arr, zred=zred) # get spectra  
     
-        maggies = filters.get_ab_maggies(np.atleast_2d(spec) * 1e-17*U.erg/U.s/U.cm**2/U.Angstrom, 
-            wavelength=w.flatten()*U.Angstrom) # maggies 
+        return self._get_photo(w.flatten(), spec, filters)[0] # nanomaggies
+
+    def _model_photo_native(self, tt_arr, zred, fsps_bands): 
+        ''' photometry in nanomaggies from the magnitudes that FSPS computes 
+        internally for the redshifted stellar population 
+        '''
+        tage    = Cosmo.age(self.cosmo, zred) # age of the universe at z=zred in Gyr
+        theta   = self._theta(tt_arr) 
+
+        self._set_fsps_params(theta) 
+        mags = self.ssp.get_mags(tage=tage, redshift=zred, bands=fsps_bands) # absolute AB magnitudes
+        
+        d_lum = Cosmo.luminosity_distance(self.cosmo, zred) # luminosity distance in cm
+        dist_mod = 5. * np.log10(d_lum / (10. * UT.parsec())) 
+        return theta['mass'] * 10**(-0.4 * (mags + dist_mod)) * 1e9 # nanomaggies 
+
+    def _native_mags_setup(self, filters, zred, prior, ndraw=5, tol=0.02, silent=True): 
+        ''' validate photometry computed by FSPS with its built-in filter
+        curves against the photometry from integrating the model spectra
+        through the speclite filters. Native photometry can only be used if the
+        speclite filters have FSPS counterparts and, at the center of the prior
+        and ndraw random draws from it, the FSPS photometry agrees with the
+        speclite photometry within tol up to a single overall normalization.
+        The normalization absorbs the FSPS convention for redshifted
+        magnitudes. Since it is fixed across all the draws, it cannot absorb a
+        theta dependent mismatch. The validation is cached for each set of
+        filters and redshift; whether it is used is set by the native_mags
+        argument of `model_photo`. 
+
+        :param filters: 
+            speclite.filters filter object 
 
-        return np.array(list(maggies[0])) * 1e9
+        :param zred: 
+            redshift 
+
+        :param prior: 
+            prior object. thetas used for the validation are drawn from it. 
+
+        :param ndraw: (default: 5) 
+            number of random draws from the prior used for the validation 
+
+        :return native: 
+            True if native FSPS photometry can be used 
+        '''
+        key = (tuple(filters.names), float(zred))
+        if key in self._native_mags: return (self._native_mags[key] is not None)
+        self._native_mags[key] = None 
+
+        fsps_bands = [self._fsps_filter_names.get(name) for name in filters.names]
+        fsps_filters = fsps.list_filters() 
+        if any([band not in fsps_filters for band in fsps_bands]): 
+            print('no FSPS filters for %s; using speclite photometry' % 
+                    ', '.join([name for name, band in zip(filters.names, fsps_bands) 
+                        if band not in fsps_filters]))
+            return False 
+
+        # center of the prior and (reproducible) random draws from it 
+        tts = np.concatenate([0.5 * (prior.min + prior.max)[None,:], 
+            np.random.RandomState(0).uniform(prior.min, prior.max, size=(ndraw, prior.ndim))], axis=0)
+
+        photo = np.array([self.model_photo(tt, zred=zred, filters=filters) for tt in tts]) # speclite 
+        photo_native = np.array([self._model_photo_native(tt, zred, fsps_bands) for tt in tts]) 
+
+        ratio = photo / photo_native 
+        scale = np.median(ratio) 
+        if np.any(np.abs(ratio / scale - 1.) > tol): 
+            print('FSPS photometry does not match speclite photometry; using speclite photometry')
+            print('  fractional differences: %s' % str(ratio / scale - 1.)) 
+            return False 
+
+        if not silent: 
+            print('using FSPS photometry for %s' % ', '.join(filters.names)) 
+            print('  normalization = %f; fractional differences: %s' % (scale, str(ratio / scale - 1.)))
+        self._native_mags[key] = {'fsps_bands': fsps_bands, 'scale': scale}
+        return True 
    
     def _model_spectrophoto(self, tt_arr, zred=0.1, wavelength=None, filters=None, bands=None): 
         ''' very simple wrapper for a fsps model with minimal overhead. Generates photometry 
@@ -608,13 +978,12 @@ class iFSPS(Fitter):
             outspec = np.interp(wavelength, w, spec, left=0, right=0)
         
         try: 
-            maggies = filters.get_ab_maggies(np.atleast_2d(spec) * 1e-17*U.erg/U.s/U.cm**2/U.Angstrom,
-                wavelength=w.flatten()*U.Angstrom) # maggies 
+            photo = self._get_photo(w.flatten(), spec, filters)[0] # nanomaggies
         except ValueError: 
             print('redshift = %f' % zred)
             raise ValueError
 
-        return outspec, np.array(list(maggies[0])) * 1e9
+        return outspec, photo
     
     def postprocess(self, mcmc_output=None, f_mcmc=None, writeout=None): 
         ''' postprocess MC chain and calculate SFR and Z for the chain using
@@ -715,7 +1084,7 @@ class iFSPS(Fitter):
         :return sfr: 
             average SFR over dt Gyrs
         '''
-        tage = self.cosmo.age(zred).value 
+        tage = Cosmo.age(self.cosmo, zred) 
         assert tage > dt
 
         theta = self._theta(tt)
@@ -814,7 +1183,10 @@ class iFSPS(Fitter):
         return (convergent, PSRF)
 
     def _emcee(self, lnpost_fn, lnpost_args, lnpost_kwargs, nwalkers=100,
-            burnin=100, niter='adaptive', maxiter=200000, opt_maxiter=1000, silent=True): 
+            burnin=100, niter='adaptive', maxiter=200000, opt_maxiter=1000,
+            vectorize=False, grad=False, moves=None, opt_lnpost_fn=None, nprocs=None, 
+            nthreads=None, blas_threads=1, stop='psrf', chain_file=None, thin=1, resume=False, 
+            init='optimize', silent=True): 
         ''' Runs MCMC (using emcee) for a given log posterior function.
 
         :param lnpost_fn: 
@@ -845,68 +1217,241 @@ class iFSPS(Fitter):
         :param opt_maxiter: (default: 1000) 
             maximum number of iterations for initial optimizer. 
 
+        :param vectorize: (default: False) 
+            If `True`, lnpost_fn takes an N x Ntheta array of the walker
+            positions and returns an array of N log posteriors, so that all
+            the walkers are evaluated in a single call. 
+
+        :param grad: (default: False) 
+            If `True`, lnpost_fn(..., grad=True) also returns the gradient of
+            the log posterior and the initial theta is found with a
+            gradient-based optimizer (L-BFGS-B) instead of Nelder-Mead. 
+
+        :param moves: (default: None) 
+            emcee moves (e.g. `DelayedAcceptanceMove`). If None, the emcee
+            default stretch move is used. 
+
+        :param opt_lnpost_fn: (default: None) 
+            log(posterior) function with the same arguments as lnpost_fn that
+            is maximized by the initial optimizer instead of lnpost_fn (e.g. a 
+            cheap approximation of lnpost_fn). 
+
+        :param nprocs: (default: None) 
+            If nprocs > 1, the walkers are evaluated in a pool of nprocs
+            processes. The processes are started once at the start of the
+            run so each has its own copy of the fitter and its
+            fsps.StellarPopulation (FSPS keeps its state in Fortran globals
+            and cannot be shared; see `_FitterPool` for fork vs spawn). The walkers are split into nprocs chunks
+            per evaluation and only the walker positions and log posteriors
+            are passed between processes. 
+
+        :param nthreads: (default: None) 
+            If nthreads > 1, the walkers are evaluated in nthreads threads
+            (see `_FitterThreadPool`). Only useful for log posteriors that
+            release the GIL (e.g. the NumPy emulator). 
+
+        :param blas_threads: (default: 1) 
+            number of threads of each BLAS call while the walkers are
+            evaluated in threads (see `_FitterThreadPool`). 
+
+        :param stop: (default: 'psrf') 
+            stopping rule for `niter=adaptive`. If stop == 'psrf', MCMC stops
+            after the PSRF of every parameter is < 1.1 for three consecutive
+            checks. If stop == 'autocorr', MCMC stops when the chain is longer
+            than 50 integrated autocorrelation times (tau) and the estimate of
+            tau changed by < 5% since the last check. The returned chain is
+            then thinned by tau, rounded up (or thin if larger), so that the
+            returned samples are approximately independent. 
+
+        :param chain_file: (default: None) 
+            If specified, the chain is streamed to chain_file in compressed
+            blocks of 1000 iterations (see `ChainBackend`) rather than kept in
+            memory and a lazily read `ChainView` of the chain is returned. 
+
+        :param thin: (default: 1) 
+            thinning of the returned chain 
+
+        :param init: (default: 'optimize') 
+            walker initialization. If init == 'optimize', the walkers start in
+            a small ball around the optimum found from the middle of the
+            prior. If init == 'multistart', the walkers start around the best
+            optima of several local optimizations (see `_multistart`). init
+            can also be an nwalkers x Ntheta array of initial walker positions
+            (e.g. from `_warm_start`), in which case no optimization is run. 
+
+        :param resume: (default: False) 
+            If `True` and chain_file has a checkpoint from a previous
+            (interrupted) run, the run is continued from the checkpoint. The
+            walker positions, log posteriors, random state, and the state of
+            the convergence monitor are checkpointed to chain_file after the
+            burn in and every 1000 iterations. 
+
         :param silent: (default: True) 
             If `False`, there will be periodic print statements with run details
         '''
-        import scipy.optimize as op
-        import emcee
 
-        # get initial theta by minimization 
-        if not silent: print('getting initial theta') 
-    
+        if stop not in ['psrf', 'autocorr']: 
+            raise ValueError("stop = 'psrf' or 'autocorr'") 
+
         ndim = lnpost_kwargs['prior'].ndim
 
         dprior = lnpost_kwargs['prior'].max - lnpost_kwargs['prior'].min
 
-        _lnpost = lambda *args: -2. * lnpost_fn(*args, **lnpost_kwargs) 
-
-        min_result = op.minimize(
-                _lnpost, 
-                0.5*(lnpost_kwargs['prior'].max + lnpost_kwargs['prior'].min), # guess the middle of the prior 
-                args=lnpost_args, 
-                method='Nelder-Mead', 
-                options={'maxiter': opt_maxiter}
-                ) 
-        tt0 = min_result['x'] 
-        if not silent: print('initial theta = [%s]' % ', '.join([str(_t) for _t in tt0])) 
+        backend, checkpoint = None, None 
+        if chain_file is not None: 
+            backend = ChainBackend(chain_file, window=1000) 
+            if resume: checkpoint = backend.load_checkpoint() 
+        elif resume: 
+            raise ValueError('resume requires chain_file') 
+
+        if isinstance(init, str) and init not in ['optimize', 'multistart']: 
+            raise ValueError("init = 'optimize', 'multistart', or array of walker positions") 
+        if not isinstance(init, str) and np.shape(init) != (nwalkers, ndim): 
+            raise ValueError('initial walker positions must be a nwalkers x Ntheta array') 
+
+        p0 = None 
+        if checkpoint is not None: 
+            if not silent: print('resuming from iteration %i' % backend.iteration) 
+        elif not isinstance(init, str): 
+            p0 = np.array(init, dtype=float) 
+        elif init == 'multistart': 
+            if not silent: print('getting initial walker positions') 
+            p0 = self._multistart(lnpost_fn if opt_lnpost_fn is None else opt_lnpost_fn, 
+                    lnpost_args, lnpost_kwargs, nwalkers, opt_maxiter=opt_maxiter, 
+                    vectorize=vectorize, grad=grad, nthreads=nthreads, silent=silent) 
+        else: 
+            # get initial theta by minimization 
+            if not silent: print('getting initial theta') 
+            tt0 = self._optimize(lnpost_fn if opt_lnpost_fn is None else opt_lnpost_fn, 
+                    lnpost_args, lnpost_kwargs, opt_maxiter=opt_maxiter, 
+                    vectorize=vectorize, grad=grad)
+            if not silent: print('initial theta = [%s]' % ', '.join([str(_t) for _t in tt0])) 
+            # initial walker positions 
+            p0 = np.array([tt0 + 1.e-4 * dprior * np.random.randn(ndim) for i in range(nwalkers)])
     
         # initial sampler 
-        self.sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost_fn, 
-                args=lnpost_args, kwargs=lnpost_kwargs)
-        # initial walker positions 
-        p0 = [tt0 + 1.e-4 * dprior * np.random.randn(ndim) for i in range(nwalkers)]
+        pool = None 
+        if nprocs is not None and nthreads is not None: 
+            raise ValueError('specify nprocs or nthreads, not both') 
+        if nprocs is not None and nprocs > 1: 
+            pool = _FitterPool(self, lnpost_fn, lnpost_args, lnpost_kwargs,
+                    nprocs, vectorize=vectorize) 
+        elif nthreads is not None and nthreads > 1: 
+            pool = _FitterThreadPool(lnpost_fn, lnpost_args, lnpost_kwargs,
+                    nthreads, blas_threads=blas_threads, vectorize=vectorize, silent=silent) 
+        if pool is not None: 
+            self.sampler = emcee.EnsembleSampler(nwalkers, ndim, pool, 
+                    vectorize=True, moves=moves, backend=backend)
+        else: 
+            self.sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost_fn, 
+                    args=lnpost_args, kwargs=lnpost_kwargs, vectorize=vectorize,
+                    moves=moves, backend=backend)
+        try: 
+            self._emcee_run(p0, nwalkers, burnin=burnin,
+                    niter=niter, maxiter=maxiter, stop=stop, checkpoint=checkpoint, 
+                    silent=silent)
+        finally: 
+            if pool is not None: pool.close() 
+
+        if niter == 'adaptive' and stop == 'autocorr': 
+            # thin by the autocorrelation time 
+            self.autocorr_time = self.convergence_monitor.tau() 
+            finite = np.isfinite(self.autocorr_time) 
+            if np.any(finite): 
+                thin = max(thin, int(np.ceil(np.max(self.autocorr_time[finite])))) 
+            if not silent: print('thinning chain by %i' % thin) 
+
+        if backend is not None: 
+            backend.flush() 
+            return ChainView(backend, thin=thin) 
+        return self.sampler.get_chain(flat=True, thin=thin)
+
+    def _emcee_run(self, p0, nwalkers, burnin=100, niter='adaptive',
+            maxiter=200000, stop='psrf', checkpoint=None, silent=True): 
+        ''' run the burn in and main chain of self.sampler starting from the
+        walker positions p0 (see `_emcee`). If the sampler has a `ChainBackend`, the state of the
+        run is checkpointed after the burn in and every 1000 iterations. If
+        checkpoint (from `ChainBackend.load_checkpoint`) is specified, the run
+        is resumed from it instead. 
+        '''
+        # ACM (and checkpoint) interval
+        STEP = 1000
 
-        # burn in 
-        if not silent: print('running burn-in') 
-        pos, prob, state = self.sampler.run_mcmc(p0, burnin)
-        self.sampler.reset()
-        
-        if not silent: print('running main chain') 
-        if niter == 'adaptive': # adaptve MCMC 
-            # ACM interval
-            STEP = 1000
+        backend = self.sampler.backend 
+        if not isinstance(backend, ChainBackend): backend = None 
 
-            # convergence flag
-            convergent = False
+        ndim = self.sampler.ndim 
+        monitor = ConvergenceMonitor(nwalkers, ndim) 
+        self.convergence_monitor = monitor 
 
-            # convergence stability flag
-            stable_convergence = 0
+        if checkpoint is None: 
+            # burn in 
+            if not silent: print('running burn-in') 
+            pos = self.sampler.run_mcmc(p0, burnin)
+            self.sampler.reset()
 
             idx = 0 # chain index
             n_iters = 0 
+            stable_convergence = 0 # convergence stability flag
+            tau_prev = np.inf # previous autocorrelation time 
+            done = False 
+        else: 
+            pos = emcee.State(checkpoint['coords'], log_prob=checkpoint['log_prob'],
+                    random_state=self.sampler.random_state) 
+            idx = int(checkpoint['idx']) 
+            n_iters = int(checkpoint['n_iters']) 
+            stable_convergence = int(checkpoint['stable_convergence']) 
+            tau_prev = float(checkpoint['tau_prev']) 
+            done = bool(checkpoint['done']) 
+            monitor.set_state(dict([(k[8:], checkpoint[k]) for k in checkpoint.keys() 
+                if k.startswith('monitor_')]))
+        
+        def _checkpoint(): 
+            if backend is None: return None 
+            backend.save_checkpoint(self.sampler.random_state, 
+                    coords=pos.coords, log_prob=pos.log_prob, 
+                    idx=idx, n_iters=n_iters, stable_convergence=stable_convergence, 
+                    tau_prev=tau_prev, done=done, 
+                    **dict([('monitor_'+k, v) for k, v in monitor.get_state().items()]))
+            return None 
+        if checkpoint is None: _checkpoint() 
+
+        if not silent: print('running main chain') 
+        if niter == 'adaptive': # adaptve MCMC 
+            # convergence flag
+            convergent = False
 
             # run mcmc and ACM
-            while not convergent: 
+            while not done: 
                 if not silent: print(f'chain #{idx + 1}')
 
-                pos1, prob1, state1 = self.sampler.run_mcmc(pos, STEP)
-
-                if idx > 1: 
+                pos = self.sampler.run_mcmc(pos, STEP)
+                # only the new block is passed to the monitor 
+                monitor.update(self.sampler.get_chain(discard=n_iters)) 
+
+                if stop == 'autocorr': 
+                    # stop when the chain is longer than 50 autocorrelation
+                    # times and the autocorrelation time has stabilized.
+                    # Parameters without an autocorrelation time (no
+                    # within-walker variance) are ignored. If no parameter
+                    # has one, the walkers are stuck and the run continues 
+                    tau = monitor.tau() 
+                    if np.all(np.isnan(tau)): 
+                        if not silent: print('tau is undefined; no parameter varies within the walkers') 
+                        tau = np.inf 
+                    else: 
+                        tau = np.nanmax(tau) 
+                    if not silent: print(f'tau: {tau:.1f}, N/tau: {(n_iters + STEP)/tau:.1f}')
+                    if (n_iters + STEP > 50. * tau) and (np.abs(tau - tau_prev) < 0.05 * tau): 
+                        if not silent: 
+                            print(f'Converged; tau: {tau:.1f}, Iteration: {n_iters + STEP}')
+                        done = True 
+                    tau_prev = tau 
+                elif idx > 1: 
                     # ACM is executed only after the first iteration 
-                    result = self.sampler.flatchain
-                    convergent, PSRF = self.ACM(result[:,0], nwalkers, STEP * (idx + 1), silent)
+                    convergent, PSRF = monitor.converged(), monitor.rhat().max()
+                    if not silent: print(f'PSRF: {PSRF}, ESS: {monitor.ess().min():.0f}')
 
-                pos = pos1
                 idx += 1 
                 n_iters += STEP 
 
@@ -924,18 +1469,704 @@ class iFSPS(Fitter):
                     # the value could be changed if necessary.
                     if not silent:
                         print(f'Converged; PSRF: {PSRF}, Iteration: {n_iters}')
-                    convergent = True 
-
-                if n_iters >= maxiter: 
-                    print(f'Did not converge; Max iteration reached; PSRF {PSRF}, Iteration: {n_iters}')
-                    convergent = True
+                    done = True 
 
+                if n_iters >= maxiter and not done: 
+                    print(f'Did not converge; Max iteration reached; PSRF {monitor.rhat().max()}, tau {monitor.tau().max():.1f}, Iteration: {n_iters}')
+                    done = True
+                _checkpoint() 
         else:
             # run standard mcmc with niter iterations 
             assert isinstance(niter, int) 
-            self.sampler.run_mcmc(pos, niter)
+            while n_iters < niter: 
+                nstep = min(STEP, niter - n_iters) 
+                pos = self.sampler.run_mcmc(pos, nstep)
+                n_iters += nstep 
+                done = (n_iters >= niter) 
+                _checkpoint() 
+        return None 
+
+    def _optimize(self, lnpost_fn, lnpost_args, lnpost_kwargs, opt_maxiter=1000,
+            vectorize=False, grad=False, tt_init=None): 
+        ''' maximize the log posterior starting from the middle of the prior to
+        get the initial theta for the samplers. 
+
+        :param lnpost_fn: 
+            log(posterior) function 
+
+        :param lnpost_args: 
+            arguments for the lnpost_fn function
+
+        :param lnpost_kwargs: 
+            keyward arguments for lnpost_fn function
+
+        :param opt_maxiter: (default: 1000) 
+            maximum number of iterations for the optimizer. 
+
+        :param vectorize: (default: False) 
+            If `True`, lnpost_fn takes an N x Ntheta array (see `_emcee`) 
+
+        :param grad: (default: False) 
+            If `True`, use L-BFGS-B with the gradient returned by
+            lnpost_fn(..., grad=True). Otherwise use Nelder-Mead. 
+
+        :param tt_init: (default: None) 
+            starting theta of the optimizer. If None, the middle of the prior.
+
+        :return tt0: 
+            maximum a posteriori theta 
+        '''
+        import scipy.optimize as op
+
+        dprior = lnpost_kwargs['prior'].max - lnpost_kwargs['prior'].min
+        if tt_init is None: # guess the middle of the prior 
+            tt_init = 0.5*(lnpost_kwargs['prior'].max + lnpost_kwargs['prior'].min)
+
+        if grad: 
+            def _lnpost(tt, *args): 
+                # -2 log posterior and its gradient 
+                if vectorize: 
+                    lp, dlp = lnpost_fn(np.atleast_2d(tt), *args, grad=True, **lnpost_kwargs)
+                    lp, dlp = lp[0], dlp[0]
+                else: 
+                    lp, dlp = lnpost_fn(tt, *args, grad=True, **lnpost_kwargs)
+                return -2. * lp, -2. * dlp
+            
+            # keep the optimizer away from the edges of the prior where the
+            # prior or the gradient is not finite
+            eps = 1e-6 * dprior 
+            min_result = op.minimize(
+                    _lnpost, 
+                    tt_init, 
+                    args=lnpost_args, 
+                    method='L-BFGS-B', 
+                    jac=True, 
+                    bounds=list(zip(lnpost_kwargs['prior'].min + eps, lnpost_kwargs['prior'].max - eps)), 
+                    options={'maxiter': opt_maxiter}
+                    ) 
+        else: 
+            if vectorize: 
+                _lnpost = lambda tt, *args: -2. * lnpost_fn(np.atleast_2d(tt), *args, **lnpost_kwargs)[0] 
+            else: 
+                _lnpost = lambda *args: -2. * lnpost_fn(*args, **lnpost_kwargs) 
+
+            min_result = op.minimize(
+                    _lnpost, 
+                    tt_init, 
+                    args=lnpost_args, 
+                    method='Nelder-Mead', 
+                    options={'maxiter': opt_maxiter}
+                    ) 
+        return min_result['x'] 
+
+    def _laplace(self, lnpost_fn, lnpost_args, lnpost_kwargs, nsample=10000,
+            opt_maxiter=1000, vectorize=False, silent=True): 
+        ''' Laplace approximation of the posterior: Gaussian centered on the
+        maximum a posteriori (MAP) theta with the inverse of the Hessian of
+        -log posterior at the MAP as the covariance. The Hessian is computed
+        by finite differences of the analytic gradient, with all of the
+        perturbed thetas evaluated in a single (vectorized) call. Returns a
+        synthetic chain drawn from the Gaussian truncated by the prior. If the
+        prior truncates nearly all of the Gaussian, fewer than `nsample`
+        samples are returned and a warning is printed. 
+
+        :param lnpost_fn: 
+            log(posterior) function. lnpost_fn(..., grad=True) must return the
+            log posterior and its gradient. 
+
+        :param lnpost_args: 
+            arguments for the lnpost_fn function
+
+        :param lnpost_kwargs: 
+            keyward arguments for lnpost_fn function
+
+        :param nsample: (default: 10000) 
+            number of samples in the synthetic chain 
+
+        :param opt_maxiter: (default: 1000) 
+            maximum number of iterations for the optimizer. 
+
+        :param vectorize: (default: False) 
+            If `True`, lnpost_fn takes an N x Ntheta array (see `_emcee`) 
+
+        :param silent: (default: True) 
+            If `False`, there will be print statements with run details
+
+        :return chain: 
+            nsample x Ntheta array of samples from the Laplace approximation 
+        '''
+        prior = lnpost_kwargs['prior']
+        ndim = prior.ndim
+
+        # get MAP theta 
+        if not silent: print('getting MAP theta') 
+        tt_map = self._optimize(lnpost_fn, lnpost_args, lnpost_kwargs,
+                opt_maxiter=opt_maxiter, vectorize=vectorize, grad=True)
+        if not silent: print('MAP theta = [%s]' % ', '.join([str(_t) for _t in tt_map])) 
+
+        hess, cov = self._hessian_cov(lnpost_fn, lnpost_args, lnpost_kwargs, tt_map,
+                vectorize=vectorize, silent=silent) 
+
+        self.laplace = {'theta_map': tt_map, 'hessian': hess, 'cov': cov} 
+
+        # draw samples from the Gaussian truncated by the prior. The batch
+        # size is scaled by the acceptance rate so far 
+        chain = np.empty((0, ndim))
+        ndraw, naccept = 0, 0 
+        for i in range(100): 
+            nbatch = nsample 
+            if naccept > 0: 
+                nbatch = int(min(10 * nsample, 1.1 * (nsample - chain.shape[0]) * ndraw / naccept)) + 1 
+            _chain = np.random.multivariate_normal(tt_map, cov, size=nbatch) 
+            inprior = np.isfinite(self._lnPrior_batch(_chain, prior=prior))
+            chain = np.concatenate([chain, _chain[inprior]], axis=0) 
+            ndraw += nbatch 
+            naccept += np.sum(inprior) 
+            if chain.shape[0] >= nsample: break 
+
+        self.laplace['acceptance'] = float(naccept) / float(ndraw) 
+        if chain.shape[0] < nsample: 
+            print('WARNING: only %i of %i samples of the Laplace approximation are within the prior (acceptance = %.2e)' % (chain.shape[0], nsample, self.laplace['acceptance']))
+            print('WARNING: the Laplace approximation is probably a poor description of the posterior!') 
+        return chain[:nsample] 
+
+    def _hessian_cov(self, lnpost_fn, lnpost_args, lnpost_kwargs, tt_map,
+            vectorize=False, silent=True): 
+        ''' Hessian of -log posterior at tt_map from central finite differences
+        of the gradient and the corresponding (Laplace) covariance. 
+
+        :return hess, cov: 
+            Ntheta x Ntheta Hessian and covariance 
+        '''
+        prior = lnpost_kwargs['prior']
+        ndim = prior.ndim
+        dprior = prior.max - prior.min
+
+        # perturbed thetas for central finite differences (one-sided at the
+        # edges of the prior) 
+        h = 1e-5 * dprior 
+        tt_up = tt_map + np.diag(np.where(tt_map + h < prior.max, h, 0.)) 
+        tt_dn = tt_map - np.diag(np.where(tt_map - h >= prior.min, h, 0.)) 
+        tts = np.concatenate([tt_up, tt_dn], axis=0) 
+        if vectorize: 
+            _, dlp = lnpost_fn(tts, *lnpost_args, grad=True, **lnpost_kwargs) 
+        else: 
+            dlp = np.array([lnpost_fn(_tt, *lnpost_args, grad=True, **lnpost_kwargs)[1] for _tt in tts]) 
+
+        # hessian of -log posterior 
+        hess = -(dlp[:ndim] - dlp[ndim:]).T / (np.diag(tt_up) - np.diag(tt_dn))
+        hess = 0.5 * (hess + hess.T) 
+
+        # covariance. Directions that are not constrained by the likelihood
+        # (e.g. beta4') are given the width of the prior. 
+        eigval, eigvec = np.linalg.eigh(hess) 
+        eigval_min = 12. / np.sum((eigvec * dprior[:,None])**2, axis=0) 
+        if not silent and np.any(eigval < eigval_min): 
+            print('%i unconstrained direction(s) in the Hessian' % np.sum(eigval < eigval_min)) 
+        eigval = np.clip(eigval, eigval_min, None) 
+        cov = np.dot(eigvec / eigval, eigvec.T) 
+        return hess, cov 
+
+    def _multistart(self, lnpost_fn, lnpost_args, lnpost_kwargs, nwalkers, nstart=100, 
+            nopt=4, nmode=3, opt_maxiter=1000, vectorize=False, grad=False, nthreads=None, 
+            silent=True): 
+        ''' multi-start initialization of the walkers. nstart starting points
+        are drawn from a Latin hypercube over the prior range and their log
+        posteriors are evaluated in a single batch. Short local optimizations
+        are run from the best nopt starting points (in parallel threads if
+        nthreads > 1) and the walkers are distributed over the best (up to
+        nmode) distinct optima. Around each optimum, the walkers are drawn from
+        a Gaussian with half the width of the Laplace covariance (if grad) or
+        1/10 the width of the covariance of the best 10% of the starting
+        points. 
+
+        :param lnpost_fn: 
+            log(posterior) function 
+        :param lnpost_args: 
+            arguments for the lnpost_fn function
+        :param lnpost_kwargs: 
+            keyward arguments for lnpost_fn function
+        :param nwalkers: 
+            number of walkers 
+        :param nstart: (default: 100) 
+            number of starting points 
+        :param nopt: (default: 4) 
+            number of local optimizations 
+        :param nmode: (default: 3) 
+            maximum number of optima the walkers are initialized around. Only
+            optima with log posteriors within 5 of the best are used. 
+        :param opt_maxiter: (default: 1000) 
+            maximum number of iterations of each local optimization 
+        :param vectorize, grad: (default: False) 
+            see `_emcee` 
+        :param nthreads: (default: None) 
+            number of threads for the local optimizations. Only use for
+            thread-safe log posteriors (e.g. the emulator). 
+
+        :return p0: 
+            nwalkers x Ntheta array of the initial walker positions 
+        '''
+        prior = lnpost_kwargs['prior']
+        ndim = prior.ndim
+        dprior = prior.max - prior.min
+
+        def _lnpost_batch(tts): 
+            if vectorize: return np.asarray(lnpost_fn(tts, *lnpost_args, **lnpost_kwargs)) 
+            return np.array([lnpost_fn(_tt, *lnpost_args, **lnpost_kwargs) for _tt in tts]) 
+
+        # Latin hypercube sample of the prior range 
+        lhs = (np.argsort(np.random.rand(nstart, ndim), axis=0) + np.random.rand(nstart, ndim)) / nstart 
+        tt_start = prior.min + lhs * dprior 
+        lp_start = _lnpost_batch(tt_start) 
+        finite = np.isfinite(lp_start) 
+        if not np.any(finite): 
+            raise ValueError('log posterior is not finite at any of the starting points') 
+        tt_start, lp_start = tt_start[finite], lp_start[finite] 
+        tt_start = tt_start[np.argsort(lp_start)[::-1]] 
+        
+        # local optimizations from the best starting points 
+        def _optimize(tt): 
+            return self._optimize(lnpost_fn, lnpost_args, lnpost_kwargs,
+                    opt_maxiter=opt_maxiter, vectorize=vectorize, grad=grad, tt_init=tt)
+        if nthreads is not None and nthreads > 1: 
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=nthreads) as pool: 
+                tt_opt = np.array(list(pool.map(_optimize, tt_start[:nopt])))
+        else: 
+            tt_opt = np.array([_optimize(_tt) for _tt in tt_start[:nopt]])
+        lp_opt = _lnpost_batch(tt_opt) 
+        
+        # distinct optima within 5 of the best log posterior 
+        modes = [] 
+        for i in np.argsort(lp_opt)[::-1]: 
+            if not lp_opt[i] > np.max(lp_opt) - 5.: break 
+            if any([np.all(np.abs(tt_opt[i] - _mode) < 1e-3 * dprior) for _mode in modes]): continue 
+            modes.append(tt_opt[i]) 
+            if len(modes) == nmode: break 
+        if not silent: 
+            print('initializing walkers around %i optima:' % len(modes)) 
+            for _mode in modes: print('  [%s]' % ', '.join([str(_t) for _t in _mode])) 
+        
+        p0 = [] 
+        for i, mode in enumerate(modes): 
+            nw = nwalkers // len(modes) + int(i < nwalkers % len(modes)) 
+            if grad: 
+                _, cov = self._hessian_cov(lnpost_fn, lnpost_args, lnpost_kwargs, mode, 
+                        vectorize=vectorize) 
+                cov = 0.25 * cov 
+            else: 
+                cov = 0.01 * np.atleast_2d(np.cov(tt_start[:max(ndim+1, tt_start.shape[0]//10)], rowvar=False))
+            
+            # draw from the Gaussian truncated by the prior 
+            _p0 = np.empty((0, ndim)) 
+            for j in range(100): 
+                _tt = np.random.multivariate_normal(mode, cov, size=nw) 
+                _tt = _tt[np.isfinite(self._lnPrior_batch(_tt, prior=prior))] 
+                _p0 = np.concatenate([_p0, _tt], axis=0) 
+                if _p0.shape[0] >= nw: break 
+            if _p0.shape[0] < nw: # fall back to a small ball 
+                _p0 = np.concatenate([_p0, mode + 1.e-4 * dprior * np.random.randn(nw, ndim)], axis=0)
+            p0.append(_p0[:nw]) 
+        return np.concatenate(p0, axis=0) 
+
+    def _warm_start(self, warm_start, nwalkers, prior, wave_obs, flux_obs, flux_ivar_obs,
+            zred, mask=None, silent=True): 
+        ''' initial walker positions for a spectrophotometric fit from the
+        posterior of a previous (e.g. photometric) fit of the same galaxy.
+        Walkers are resampled from the chain. If the chain does not include
+        f_fiber, f_fiber is initialized around its best-fit value for the
+        median of the chain. 
+
+        :param warm_start: 
+            output dictionary of a previous fit or the file it was written to
+            (see `writeout` of `MCMC_photo`) 
+        :param nwalkers: 
+            number of walkers 
+        :param prior: 
+            prior object of the spectrophotometric fit
+        :param wave_obs, flux_obs, flux_ivar_obs, zred, mask: 
+            observed spectrum and redshift (see `MCMC_spectrophoto`) 
+
+        :return p0: 
+            nwalkers x Ntheta array of initial walker positions 
+        '''
+        if isinstance(warm_start, str): 
+            fh5 = h5py.File(warm_start, 'r') 
+            chain = fh5['mcmc_chain'][...] 
+            fh5.close() 
+        else: 
+            chain = np.asarray(warm_start['mcmc_chain']) 
+        chain = np.atleast_2d(chain) 
+
+        ndim = prior.ndim 
+        if chain.shape[1] not in [ndim-1, ndim]: 
+            raise ValueError('warm start chain has %i parameters; expected %i or %i' % 
+                    (chain.shape[1], ndim-1, ndim))
+        # back to the basis the parameters are sampled in 
+        chain = self._chain_to_sampling_basis(chain, prior) 
+
+        if chain.shape[1] == ndim - 1: 
+            # best-fit f_fiber for the median of the chain 
+            w_model, flux_model = self.model(np.median(chain, axis=0), zred=zred, wavelength=wave_obs)
+            _ivar = flux_ivar_obs if mask is None else flux_ivar_obs * ~mask 
+            f_fiber = np.sum(_ivar * flux_obs * flux_model) / np.sum(_ivar * flux_model**2) 
+            f_fiber = np.clip(f_fiber, prior.min[-1], prior.max[-1]) 
+            if not silent: print('warm start f_fiber = %f' % f_fiber) 
+
+            _f = f_fiber * (1. + 0.05 * np.random.randn(chain.shape[0])) 
+            chain = np.concatenate([chain, _f[:,None]], axis=1) 
+        
+        inprior = np.isfinite(self._lnPrior_batch(chain, prior=prior)) 
+        if np.sum(inprior) < nwalkers: 
+            raise ValueError('fewer than nwalkers samples of the warm start chain are within the prior')
+        chain = chain[inprior] 
+
+        # resample the chain. A small jitter keeps walkers from repeated
+        # (rejected) steps distinct 
+        dprior = prior.max - prior.min 
+        p0 = chain[np.random.choice(chain.shape[0], size=nwalkers, replace=False)] 
+        jitter = p0 + 1.e-4 * dprior * np.random.randn(nwalkers, ndim) 
+        injitter = np.isfinite(self._lnPrior_batch(jitter, prior=prior)) 
+        p0[injitter] = jitter[injitter] 
+        return p0 
+
+    def _chain_to_sampling_basis(self, chain, prior): 
+        ''' transform an output MCMC chain back to the basis the parameters
+        are sampled in. 
+        '''
+        return chain 
+
+    def _nuts(self, lnpost_fn, lnpost_args, lnpost_kwargs, nchains=4,
+            burnin=1000, niter=1000, maxiter=200000, opt_maxiter=1000,
+            vectorize=False, target_accept=0.8, max_treedepth=10, silent=True): 
+        ''' Runs Hamiltonian Monte Carlo using the No-U-Turn Sampler (NUTS)
+        for a given log posterior function with analytic gradients. The
+        sampler runs in an unconstrained space where each parameter is logit
+        transformed over the range of the uniform prior. The mass matrix is
+        initialized with the inverse Hessian at the starting point. The step
+        size (dual averaging) and a dense mass matrix are then adapted during
+        burnin. 
+
+        :param lnpost_fn: 
+            log(posterior) function. lnpost_fn(..., grad=True) must return the
+            log posterior and its gradient. 
+
+        :param lnpost_args: 
+            arguments for the lnpost_fn function
+
+        :param lnpost_kwargs: 
+            keyward arguments for lnpost_fn function. lnpost_kwargs['prior']
+            must be a UniformPrior. 
+
+        :param nchains: (default: 4) 
+            number of independent chains 
+
+        :param burnin: (default: 1000) 
+            number of burnin (adaptation) iterations for each chain 
+
+        :param niter: (default: 1000) 
+            number of iterations for each chain. If `niter=adaptive`, the
+            chains are run until the Gelman-Rubin diagnostic of all the
+            parameters is < 1.1. 
+
+        :param maxiter: (default: 200000) 
+            maximum number of iterations for each chain for adaptive method.
+
+        :param opt_maxiter: (default: 1000) 
+            maximum number of iterations for initial optimizer. 
+
+        :param vectorize: (default: False) 
+            If `True`, lnpost_fn takes an N x Ntheta array (see `_emcee`) 
+
+        :param target_accept: (default: 0.8) 
+            target acceptance probability of the step size adaptation 
+
+        :param max_treedepth: (default: 10) 
+            maximum depth of the NUTS trees (at most 2^max_treedepth leapfrog
+            steps per iteration) 
+
+        :param silent: (default: True) 
+            If `False`, there will be periodic print statements with run details
+
+        :return chain: 
+            (Niter * nchains) x Ntheta array of the chains. The chains are
+            ordered in the same way as the emcee flatchain. 
+
+        reference
+        ---------
+        * Hoffman & Gelman (2014) - https://arxiv.org/abs/1111.4246
+        '''
+        prior = lnpost_kwargs['prior']
+        assert isinstance(prior, UniformPrior), 'NUTS requires a UniformPrior' 
+        if niter == 'adaptive': assert nchains > 1 
+
+        ndim = prior.ndim
+        dprior = prior.max - prior.min
+
+        def _logp(uu): 
+            # log posterior and its gradient in the unconstrained space 
+            sig = 0.5 * (1. + np.tanh(0.5 * uu)) # sigmoid 
+            tt = prior.min + dprior * sig 
+            if vectorize: 
+                lp, dlp = lnpost_fn(np.atleast_2d(tt), *lnpost_args, grad=True, **lnpost_kwargs)
+                lp, dlp = lp[0], dlp[0]
+            else: 
+                lp, dlp = lnpost_fn(tt, *lnpost_args, grad=True, **lnpost_kwargs)
+            if not np.isfinite(lp): 
+                return -np.inf, np.zeros(ndim) 
+            # include the jacobian of the logit transformation 
+            jac = dprior * sig * (1. - sig) 
+            lnjac = np.log(dprior) - np.abs(uu) - 2. * np.log1p(np.exp(-np.abs(uu)))
+            return lp + np.sum(lnjac), dlp * jac + (1. - 2. * sig) 
+
+        def _tt(uu): 
+            return prior.min + dprior * 0.5 * (1. + np.tanh(0.5 * uu)) 
+
+        # get initial theta by minimization 
+        if not silent: print('getting initial theta') 
+        tt0 = self._optimize(lnpost_fn, lnpost_args, lnpost_kwargs,
+                opt_maxiter=opt_maxiter, vectorize=vectorize, grad=True)
+        if not silent: print('initial theta = [%s]' % ', '.join([str(_t) for _t in tt0])) 
+
+        # mass matrix adaptation windows 
+        init_buffer, windows = self._nuts_windows(burnin) 
+
+        # initial mass matrix from the Hessian at the starting point 
+        ss0 = np.clip((tt0 - prior.min) / dprior, 1e-6, 1. - 1e-6) 
+        inv_mass0 = self._nuts_init_inv_mass(_logp, np.log(ss0) - np.log(1. - ss0)) 
+
+        self.nuts_diagnostics = {'step_size': [], 'inv_mass': [], 'n_leapfrog': 0} 
+        states = [] 
+        for ichain in range(nchains): 
+            if not silent: print(f'chain #{ichain + 1}: running burn-in') 
+            # initial position 
+            ss = np.clip((tt0 + 1.e-4 * dprior * np.random.randn(ndim) - prior.min) / dprior, 1e-6, 1. - 1e-6) 
+            uu = np.log(ss) - np.log(1. - ss) 
+            logp, dlogp = _logp(uu) 
+
+            inv_mass = inv_mass0.copy() 
+            eps = self._nuts_init_step_size(_logp, uu, logp, dlogp, inv_mass) 
+            # dual averaging 
+            mu, hbar, logeps_bar, t = np.log(10. * eps), 0., 0., 0
+            window = [] 
+            for i in range(burnin): 
+                uu, logp, dlogp, accept, nleap = self._nuts_step(_logp, uu,
+                        logp, dlogp, eps, inv_mass, max_treedepth)
+                self.nuts_diagnostics['n_leapfrog'] += nleap
+
+                t += 1
+                hbar = (1. - 1. / (t + 10.)) * hbar + (target_accept - accept) / (t + 10.) 
+                logeps = mu - np.sqrt(t) / 0.05 * hbar 
+                logeps_bar = t**-0.75 * logeps + (1. - t**-0.75) * logeps_bar 
+                eps = np.exp(logeps) 
+
+                if i >= init_buffer and len(windows) > 0 and i < windows[-1]: 
+                    window.append(uu) 
+                if (i + 1) in windows: 
+                    # update the mass matrix and restart the step size adaptation
+                    nwin = len(window) 
+                    inv_mass = (nwin / (nwin + 5.)) * np.cov(np.array(window).T) + \
+                            1e-3 * (5. / (nwin + 5.)) * np.identity(ndim) 
+                    window = [] 
+                    eps = self._nuts_init_step_size(_logp, uu, logp, dlogp, inv_mass) 
+                    mu, hbar, logeps_bar, t = np.log(10. * eps), 0., 0., 0
+            if burnin > 0: eps = np.exp(logeps_bar) 
+
+            self.nuts_diagnostics['step_size'].append(eps) 
+            self.nuts_diagnostics['inv_mass'].append(inv_mass) 
+            states.append([uu, logp, dlogp, eps, inv_mass]) 
+        
+        if not silent: print('running main chain') 
+        # run chains in intervals of STEP iterations 
+        STEP = 1000 if niter == 'adaptive' else niter
+        samples = [[] for ichain in range(nchains)]
+        n_iters = 0 
+        convergent = False 
+        while not convergent: 
+            for ichain in range(nchains): 
+                uu, logp, dlogp, eps, inv_mass = states[ichain]
+                _samples = np.empty((STEP, ndim)) 
+                for i in range(STEP): 
+                    uu, logp, dlogp, _, nleap = self._nuts_step(_logp, uu,
+                            logp, dlogp, eps, inv_mass, max_treedepth)
+                    self.nuts_diagnostics['n_leapfrog'] += nleap
+                    _samples[i] = uu 
+                states[ichain][:3] = uu, logp, dlogp 
+                samples[ichain].append(_samples) 
+            n_iters += STEP 
+            # niter x nchains x ndim 
+            chain = _tt(np.stack([np.concatenate(_s) for _s in samples], axis=1)) 
+
+            if niter != 'adaptive': break 
+
+            # Gelman-Rubin diagnostic for all the parameters 
+            PSRF = np.max([self.ACM(chain[:,:,i].flatten(), nchains, n_iters, True)[1] for i in range(ndim)])
+            if not silent: print(f'PSRF: {PSRF}, Iteration: {n_iters}')
+            if PSRF < 1.1: 
+                convergent = True 
+            elif n_iters >= maxiter: 
+                print(f'Did not converge; Max iteration reached; PSRF {PSRF}, Iteration: {n_iters}')
+                convergent = True
         
-        return  self.sampler.flatchain
+        return chain.reshape(-1, ndim) 
+
+    def _nuts_windows(self, burnin): 
+        ''' adaptation windows for the NUTS mass matrix during burnin. The
+        burnin starts with an initial buffer where only the step size is
+        adapted, followed by windows of doubling size at the end of which the
+        mass matrix is updated, and a final buffer where only the step size is
+        adapted (same scheme as Stan). 
+
+        :return init_buffer, windows: 
+            the number of iterations in the initial buffer and the iterations
+            at which each window ends. 
+        '''
+        if burnin < 20: # too short to adapt the mass matrix 
+            return burnin, [] 
+
+        if burnin < 150: 
+            init_buffer, term_buffer = int(0.15 * burnin), int(0.1 * burnin) 
+            base_window = burnin - init_buffer - term_buffer 
+        else: 
+            init_buffer, term_buffer, base_window = 75, 50, 25 
+
+        windows = [] 
+        start, size = init_buffer, base_window 
+        while True: 
+            end = start + size 
+            if end + 2 * size > burnin - term_buffer: 
+                windows.append(burnin - term_buffer) 
+                break 
+            windows.append(end) 
+            start, size = end, 2 * size 
+        return init_buffer, windows 
+
+    def _nuts_init_inv_mass(self, logp_fn, uu, step=1e-4): 
+        ''' initial (inverse) mass matrix for NUTS: the inverse of the Hessian
+        of -log posterior at uu, which is estimated by finite differences of
+        the analytic gradient. Falls back to the inverse of the diagonal (or
+        the identity) if the Hessian is not positive definite. 
+        '''
+        ndim = len(uu) 
+        hess = np.zeros((ndim, ndim)) 
+        for i in range(ndim): 
+            du = np.zeros(ndim) 
+            du[i] = step 
+            hess[:,i] = -(logp_fn(uu + du)[1] - logp_fn(uu - du)[1]) / (2. * step) 
+        hess = 0.5 * (hess + hess.T) 
+
+        if np.all(np.isfinite(hess)) and np.all(np.linalg.eigvalsh(hess) > 0): 
+            return np.linalg.inv(hess) 
+        diag = np.diag(hess) 
+        if np.all(np.isfinite(diag)) and np.all(diag > 0): 
+            return np.diag(1. / diag) 
+        return np.identity(ndim) 
+
+    def _nuts_kinetic(self, rr, inv_mass): 
+        ''' kinetic energy of momentum rr 
+        '''
+        return 0.5 * np.dot(rr, np.dot(inv_mass, rr)) 
+
+    def _nuts_momentum(self, inv_mass): 
+        ''' draw momentum from N(0, inv_mass^-1) 
+        '''
+        # inv_mass = L L^T --> L^-T z ~ N(0, inv_mass^-1) 
+        chol = np.linalg.cholesky(inv_mass) 
+        return np.linalg.solve(chol.T, np.random.randn(inv_mass.shape[0]))
+
+    def _nuts_init_step_size(self, logp_fn, uu, logp, dlogp, inv_mass): 
+        ''' heuristic for a reasonable initial step size (Algorithm 4 of
+        Hoffman & Gelman 2014) 
+        '''
+        eps = 1. 
+        rr = self._nuts_momentum(inv_mass) 
+        joint0 = logp - self._nuts_kinetic(rr, inv_mass) 
+
+        _, rr1, logp1, _ = self._nuts_leapfrog(logp_fn, uu, rr, dlogp, eps, inv_mass) 
+        djoint = logp1 - self._nuts_kinetic(rr1, inv_mass) - joint0 
+        if not np.isfinite(djoint): djoint = -np.inf
+
+        a = 1. if djoint > np.log(0.5) else -1. 
+        for i in range(100): 
+            if a * djoint <= a * np.log(0.5): break 
+            eps *= 2.**a 
+            _, rr1, logp1, _ = self._nuts_leapfrog(logp_fn, uu, rr, dlogp, eps, inv_mass) 
+            djoint = logp1 - self._nuts_kinetic(rr1, inv_mass) - joint0 
+            if not np.isfinite(djoint): djoint = -np.inf
+        return eps 
+
+    def _nuts_step(self, logp_fn, uu, logp, dlogp, eps, inv_mass, max_treedepth): 
+        ''' single NUTS iteration (Algorithm 6 of Hoffman & Gelman 2014) 
+
+        :return uu, logp, dlogp, accept, nleap: 
+            new position, its log posterior and gradient, the average
+            acceptance probability used for the step size adaptation and the
+            number of leapfrog steps. 
+        '''
+        rr0 = self._nuts_momentum(inv_mass) 
+        joint0 = logp - self._nuts_kinetic(rr0, inv_mass) 
+        logu = joint0 - np.random.exponential() # log slice variable 
+
+        um, rm, gm = uu, rr0, dlogp 
+        up, rp, gp = uu, rr0, dlogp 
+        j, n, s = 0, 1, 1 
+        alpha, nalpha, nleap = 0., 1, 0
+        while s == 1 and j < max_treedepth: 
+            v = 1 if np.random.uniform() < 0.5 else -1 
+            if v == -1: 
+                um, rm, gm, _, _, _, u1, logp1, g1, n1, s1, alpha, nalpha = \
+                        self._nuts_build_tree(logp_fn, um, rm, gm, logu, v, j, eps, inv_mass, joint0)
+            else: 
+                _, _, _, up, rp, gp, u1, logp1, g1, n1, s1, alpha, nalpha = \
+                        self._nuts_build_tree(logp_fn, up, rp, gp, logu, v, j, eps, inv_mass, joint0)
+            nleap += nalpha 
+
+            if s1 == 1 and np.random.uniform() < n1 / n: 
+                uu, logp, dlogp = u1, logp1, g1 
+            n += n1 
+            s = s1 * int(np.dot(up - um, np.dot(inv_mass, rm)) >= 0) * int(np.dot(up - um, np.dot(inv_mass, rp)) >= 0)
+            j += 1 
+        return uu, logp, dlogp, alpha / nalpha, nleap 
+
+    def _nuts_build_tree(self, logp_fn, uu, rr, dlogp, logu, v, j, eps, inv_mass, joint0): 
+        ''' recursively build the NUTS tree (Algorithm 6 of Hoffman & Gelman
+        2014) 
+        '''
+        if j == 0: 
+            # single leapfrog step in direction v 
+            u1, r1, logp1, g1 = self._nuts_leapfrog(logp_fn, uu, rr, dlogp, v * eps, inv_mass) 
+            joint = logp1 - self._nuts_kinetic(r1, inv_mass) 
+            n1 = int(logu <= joint) 
+            s1 = int(logu < joint + 1000.) 
+            alpha = min(1., np.exp(joint - joint0)) if np.isfinite(joint) else 0. 
+            return u1, r1, g1, u1, r1, g1, u1, logp1, g1, n1, s1, alpha, 1
+
+        # build the left and right subtrees 
+        um, rm, gm, up, rp, gp, u1, logp1, g1, n1, s1, alpha1, nalpha1 = \
+                self._nuts_build_tree(logp_fn, uu, rr, dlogp, logu, v, j-1, eps, inv_mass, joint0)
+        if s1 == 1: 
+            if v == -1: 
+                um, rm, gm, _, _, _, u2, logp2, g2, n2, s2, alpha2, nalpha2 = \
+                        self._nuts_build_tree(logp_fn, um, rm, gm, logu, v, j-1, eps, inv_mass, joint0)
+            else: 
+                _, _, _, up, rp, gp, u2, logp2, g2, n2, s2, alpha2, nalpha2 = \
+                        self._nuts_build_tree(logp_fn, up, rp, gp, logu, v, j-1, eps, inv_mass, joint0)
+            if n1 + n2 > 0 and np.random.uniform() < n2 / (n1 + n2): 
+                u1, logp1, g1 = u2, logp2, g2 
+            alpha1 += alpha2 
+            nalpha1 += nalpha2 
+            s1 = s2 * int(np.dot(up - um, np.dot(inv_mass, rm)) >= 0) * int(np.dot(up - um, np.dot(inv_mass, rp)) >= 0)
+            n1 += n2 
+        return um, rm, gm, up, rp, gp, u1, logp1, g1, n1, s1, alpha1, nalpha1
+
+    def _nuts_leapfrog(self, logp_fn, uu, rr, dlogp, eps, inv_mass): 
+        ''' leapfrog integration step 
+        '''
+        rr = rr + 0.5 * eps * dlogp 
+        uu = uu + eps * np.dot(inv_mass, rr) 
+        logp, dlogp = logp_fn(uu) 
+        rr = rr + 0.5 * eps * dlogp 
+        return uu, rr, logp, dlogp 
 
     def _lnPost_spectrophoto(self, tt_arr, wave_obs, flux_obs, flux_ivar_obs, photo_obs, photo_ivar_obs, zred, 
             mask=None, filters=None, bands=None, prior=None): 
@@ -1034,7 +2265,8 @@ class iFSPS(Fitter):
     def _lnPost_spec(self, *args, **kwargs): 
         return self._lnPost(*args, **kwargs)
     
-    def _lnPost_photo(self, tt_arr, flux_obs, flux_ivar_obs, zred, filters=None, bands=None, prior=None): 
+    def _lnPost_photo(self, tt_arr, flux_obs, flux_ivar_obs, zred, filters=None, bands=None, 
+            native_mags=False, prior=None): 
         ''' calculate the log posterior for photometry
 
         :param tt_arr: 
@@ -1054,19 +2286,23 @@ class iFSPS(Fitter):
             photometric bands to generate the photometry. Either bands or filters has to be 
             specified. (default: None)  
 
+        :param native_mags: 
+            If True, use validated FSPS photometry (see `model_photo`). (default: False) 
+
         :param prior: (optional) 
             callable prior object. 
         '''
         lp = self._lnPrior(tt_arr, prior=prior) # log prior
         if not np.isfinite(lp): 
             return -np.inf
-        return lp - 0.5 * self._Chi2_photo(tt_arr, flux_obs, flux_ivar_obs, zred, filters=filters, bands=bands)
+        return lp - 0.5 * self._Chi2_photo(tt_arr, flux_obs, flux_ivar_obs, zred,
+                filters=filters, bands=bands, native_mags=native_mags)
 
-    def _Chi2_photo(self, tt_arr, flux_obs, flux_ivar_obs, zred, filters=None, bands=None): 
+    def _Chi2_photo(self, tt_arr, flux_obs, flux_ivar_obs, zred, filters=None, bands=None, native_mags=False): 
         ''' calculated the chi-squared between the data and model photometry
         '''
         # model(theta) 
-        flux = self.model_photo(tt_arr, zred=zred, filters=filters, bands=bands) 
+        flux = self.model_photo(tt_arr, zred=zred, filters=filters, bands=bands, native_mags=native_mags) 
         # data - model(theta) with masking 
         dflux = (flux - flux_obs) 
         # calculate chi-squared
@@ -1099,6 +2335,266 @@ class iFSPS(Fitter):
             raise NotImplementedError
         return ssp 
     
+    def _fsps_spectrum(self, tt_arr, tage): 
+        ''' set the FSPS parameters from theta and return the spectrum of the
+        stellar population at age tage in Lsun/Angstrom per unit stellar mass formed 
+        '''
+        theta = self._theta(tt_arr) 
+
+        if self._dust_cache is not None: 
+            # cached dust-free spectrum attenuated by the Calzetti curve 
+            w, ssp_lum = self._dustfree_spectrum(np.log10(theta['Z']/0.0190), theta['tau'], tage)
+            return w, ssp_lum * np.exp(-theta['dust2'] * self._calzetti_curve(w))
+
+        self._set_fsps_params(theta) 
+        w, ssp_lum = self.ssp.get_spectrum(tage=tage, peraa=True) 
+        return w, ssp_lum 
+
+    def _set_fsps_params(self, theta): 
+        ''' set the FSPS parameters from the dictionary of parameter values 
+        '''
+        if self.model_name in ['vanilla', 'vanilla_kroupa']: 
+            self.ssp.params['logzsol']  = np.log10(theta['Z']/0.0190) # log(z/zsun) 
+            self.ssp.params['dust2']    = theta['dust2'] # dust2 parameter in fsps 
+            self.ssp.params['tau']      = theta['tau'] # sfh parameter 
+        elif self.model_name == 'vanilla_complexdust': 
+            self.ssp.params['logzsol']  = np.log10(theta['Z']/0.0190) # log(z/zsun) 
+            self.ssp.params['dust1']    = theta['dust1'] # dust1 parameter in fsps 
+            self.ssp.params['dust2']    = theta['dust2'] # dust2 parameter in fsps 
+            self.ssp.params['dust_index'] = theta['dust_index'] # dust2 parameter in fsps 
+            self.ssp.params['tau']      = theta['tau'] # sfh parameter 
+        else: 
+            raise NotImplementedError
+        return None 
+
+    def _init_dust_cache(self, dust_cache, dust_cache_size): 
+        ''' set up LRU cache of dust-free spectra 
+        '''
+        self._dust_cache = None 
+        if not dust_cache: return None 
+        if self.model_name not in ['vanilla', 'vanilla_kroupa']: 
+            raise ValueError("dust cache is only available for the Calzetti models") 
+
+        self._dust_cache        = OrderedDict() 
+        self._dust_cache_size   = dust_cache_size 
+        self._dust_cache_hits   = 0 
+        self._dust_cache_misses = 0 
+        self._calzetti = None 
+        return None 
+
+    def _dustfree_spectrum(self, logzsol, tau, tage): 
+        ''' dust-free FSPS spectrum from the LRU cache. FSPS is only called for
+        (logzsol, tau, tage) that are not in the cache. 
+        '''
+        key = (float(logzsol), float(tau), float(tage))
+        if key in self._dust_cache: 
+            self._dust_cache_hits += 1 
+            self._dust_cache.move_to_end(key) 
+            return self._dust_cache_wave, self._dust_cache[key]
+
+        self._dust_cache_misses += 1 
+        self.ssp.params['logzsol']  = logzsol # log(z/zsun) 
+        self.ssp.params['dust2']    = 0. # no dust 
+        self.ssp.params['tau']      = tau # sfh parameter 
+        w, ssp_lum = self.ssp.get_spectrum(tage=tage, peraa=True) 
+
+        self._dust_cache_wave = w 
+        self._dust_cache[key] = ssp_lum 
+        if len(self._dust_cache) > self._dust_cache_size: 
+            self._dust_cache.popitem(last=False) # drop least recently used 
+        return w, ssp_lum 
+
+    def _calzetti_curve(self, w): 
+        ''' Calzetti et al. (2000) attenuation curve normalized to 1 at 5500A, 
+        as implemented in FSPS for dust_type=2 (i.e. tau = dust2 * curve) 
+        '''
+        if self._calzetti is not None and len(self._calzetti) == len(w): 
+            return self._calzetti 
+        x = 1e4 / w # inverse microns 
+        curve = np.where(w > 6300., 
+                1.17 * (-1.857 + 1.04 * x) + 1.78, 
+                1.17 * (-2.156 + 1.509 * x - 0.198 * x**2 + 0.011 * x**3) + 1.78) 
+        self._calzetti = np.clip(curve / 0.44 / 4.05, 0., None) 
+        return self._calzetti 
+
+    def dust_cache_info(self): 
+        ''' hits, misses, hit rate and size of the dust-free spectra cache 
+        '''
+        if self._dust_cache is None: return None 
+        ncall = self._dust_cache_hits + self._dust_cache_misses 
+        return {
+                'hits': self._dust_cache_hits, 
+                'misses': self._dust_cache_misses, 
+                'hit_rate': float(self._dust_cache_hits) / max(ncall, 1), 
+                'size': len(self._dust_cache), 
+                'maxsize': self._dust_cache_size}
+
+    def _dust_moves(self): 
+        ''' emcee moves for the dust cache: a mixture of the default stretch
+        move and stretch moves of dust2 alone. Returns None (i.e. the default
+        emcee move) if the dust cache is not used. 
+        '''
+        if self._dust_cache is None or not self._dust_move_fraction > 0.: 
+            return None 
+        i_dust = self.theta_names.index('dust2') 
+        return [(emcee.moves.StretchMove(), 1. - self._dust_move_fraction), 
+                (SubspaceStretchMove([i_dust]), self._dust_move_fraction)]
+
+    def build_grid(self, fgrid, tage=None, zred=None, axes=None, silent=True): 
+        ''' tabulate FSPS spectra over the free parameters of the model (except for
+        stellar mass) and write the grid to an hdf5 file. Build the grid once and pass 
+        it to every fitter with `iFSPS(model_name, grid=fgrid)` (or `self.load_grid`), 
+        which then interpolates the grid instead of calling FSPS. Building the grid 
+        does not change the model of this fitter. 
+
+        The grid has one spectrum for each combination of grid points, so its size
+        grows quickly with the number of parameters. The default axes require 990
+        FSPS spectra per tage for vanilla (~25 MB) and 24,300 FSPS spectra per tage
+        for vanilla_complexdust (~0.6 GB in float32). For complexdust, use coarser
+        axes or fewer parameters if memory is limited. 
+
+        :param fgrid: 
+            hdf5 file name of the grid 
+
+        :param tage: (default: None) 
+            age or array of ages in Gyr to tabulate. Either tage or zred has to
+            be specified. 
+
+        :param zred: (default: None) 
+            redshift or array of redshifts. If specified, the grid is tabulated at 
+            the age of the universe at zred. 
+
+        :param axes: (default: None) 
+            dictionary of grid points for each of the parameters in
+            self.theta_names[1:]. Parameters that are not specified use the 
+            default grid, which spans the default prior. 
+
+        :return grid: 
+            dictionary with the grid 
+        '''
+        if tage is None: 
+            if zred is None: raise ValueError("specify either tage or zred") 
+            tage = Cosmo.age(self.cosmo, np.atleast_1d(zred)) 
+        tage = np.sort(np.atleast_1d(tage))
+
+        grid_axes = self._default_grid_axes() 
+        if axes is not None: 
+            for k in axes.keys(): 
+                if k not in grid_axes.keys(): 
+                    raise ValueError("%s is not a parameter of %s" % (k, self.model_name)) 
+                grid_axes[k] = np.sort(np.atleast_1d(axes[k]))
+        names = self.theta_names[1:] 
+        
+        shape = tuple([len(grid_axes[k]) for k in names]) + (len(tage),) 
+        if not silent: print('building %s grid of %i FSPS spectra' % (str(shape), np.prod(shape)))
+
+        log_lum = None 
+        for ii in np.ndindex(*shape): 
+            tt = np.concatenate([[0.], [grid_axes[k][i] for k, i in zip(names, ii[:-1])]]) 
+            w, ssp_lum = self._fsps_spectrum(tt, tage[ii[-1]]) 
+            if log_lum is None: 
+                log_lum = np.zeros(shape + (len(w),), dtype=np.float32) 
+                if not silent: print('grid size = %.1f MB' % (log_lum.nbytes / 1e6))
+            with np.errstate(divide='ignore'): 
+                log_lum[ii] = np.log10(ssp_lum) # -inf for zero flux 
+
+        fh5 = h5py.File(fgrid, 'w') 
+        fh5.attrs['model_name'] = self.model_name 
+        for k in names: 
+            fh5.create_dataset(k, data=grid_axes[k]) 
+        fh5.create_dataset('tage', data=tage) 
+        fh5.create_dataset('wave', data=w) 
+        fh5.create_dataset('log_lum', data=log_lum) 
+        fh5.close() 
+
+        return self._read_grid(fgrid)
+
+    def load_grid(self, fgrid): 
+        ''' load FSPS grid constructed by `self.build_grid` so that `self.model`
+        interpolates the grid rather than calling FSPS. 
+
+        :param fgrid: 
+            hdf5 file name of the grid 
+        '''
+        self._grid = self._read_grid(fgrid) 
+        self._config['grid'] = fgrid 
+        return self._grid 
+
+    def _read_grid(self, fgrid): 
+        ''' read FSPS grid constructed by `self.build_grid` 
+        '''
+        fh5 = h5py.File(fgrid, 'r') 
+        model_name = fh5.attrs['model_name'] 
+        if isinstance(model_name, bytes): model_name = model_name.decode() 
+        if model_name != self.model_name: 
+            fh5.close() 
+            raise ValueError("grid was constructed for %s not %s" % (model_name, self.model_name))
+
+        grid = {} 
+        grid['names']   = self.theta_names[1:] + ['tage'] 
+        grid['axes']    = [fh5[k][...] for k in grid['names']]
+        grid['wave']    = fh5['wave'][...]
+        grid['log_lum'] = fh5['log_lum'][...]
+        fh5.close() 
+        return grid 
+
+    def _grid_spectrum(self, tt_arr, tage): 
+        ''' multilinear interpolation of the log luminosity on the FSPS grid. At
+        wavelengths where the flux is zero at any of the surrounding grid
+        points, the luminosity is interpolated linearly instead. If theta or
+        tage are outside of the grid, returns None so that FSPS is called
+        instead. 
+        '''
+        grid = self._grid 
+        point = np.concatenate([np.atleast_1d(tt_arr)[1:len(self.theta_names)], [tage]]) 
+
+        i_lo, frac = [], [] 
+        for x, ax in zip(point, grid['axes']): 
+            if len(ax) == 1: 
+                # axis not tabulated 
+                if not np.isclose(x, ax[0], rtol=1e-3): return None, None 
+                i_lo.append(0) 
+                frac.append(0.) 
+                continue 
+            if x < ax[0] or x > ax[-1]: return None, None 
+            i = min(np.searchsorted(ax, x, side='right') - 1, len(ax) - 2) 
+            i_lo.append(i) 
+            frac.append((x - ax[i]) / (ax[i+1] - ax[i]))
+
+        wts, log_lums = [], [] 
+        for corner in np.ndindex(*((2,) * len(point))): 
+            wt = np.prod([f if c else 1. - f for c, f in zip(corner, frac)]) 
+            if wt == 0.: continue 
+            wts.append(wt) 
+            log_lums.append(grid['log_lum'][tuple(np.array(i_lo) + np.array(corner))])
+        wts, log_lums = np.array(wts), np.array(log_lums, dtype=float) 
+
+        # zero flux (-inf, or clipped to 1e-300 in older grids) 
+        zero = np.any(log_lums <= -300., axis=0) 
+        lum = 10**np.dot(wts, np.where(zero, 0., log_lums)) 
+        if np.any(zero): 
+            lum[zero] = np.dot(wts, 10**log_lums[:,zero]) 
+        return grid['wave'], lum 
+
+    def _default_grid_axes(self): 
+        ''' default grid points of the FSPS grid, which span the default prior 
+        '''
+        if self.model_name in ['vanilla', 'vanilla_kroupa']: 
+            axes = {
+                    'z_metal': np.linspace(-3., 1., 9), 
+                    'dust2': np.linspace(0., 10., 11), 
+                    'tau': np.geomspace(0.1, 10., 10)} 
+        elif self.model_name == 'vanilla_complexdust': 
+            axes = {
+                    'z_metal': np.linspace(-3., 1., 9), 
+                    'dust1': np.linspace(0., 4., 5), 
+                    'dust2': np.linspace(0., 4., 9), 
+                    'dust_index': np.linspace(-2.2, 0.4, 6), 
+                    'tau': np.geomspace(0.1, 10., 10)} 
+        else: 
+            raise NotImplementedError
+        return axes 
+    
     def _theta(self, tt_arr): 
         ''' Given some theta 1D array return dictionary of parameter values. 
         This is synchronized with self.model_name
@@ -1122,6 +2618,16 @@ class iFSPS(Fitter):
             raise NotImplementedError
         return theta
 
+    # FSPS built-in filters that correspond to the speclite filters 
+    _fsps_filter_names = {
+            'decam2014-g': 'decam_g', 
+            'decam2014-r': 'decam_r', 
+            'decam2014-z': 'decam_z', 
+            'wise2010-W1': 'wise_w1', 
+            'wise2010-W2': 'wise_w2', 
+            'wise2010-W3': 'wise_w3', 
+            'wise2010-W4': 'wise_w4'}
+
     def _get_bands(self, bands): 
         ''' given bands
         '''
@@ -1176,27 +2682,47 @@ class iSpeculator(iFSPS):
     the original SFH basis cofficient. This transformation is detailed in Betancourt2013 
     (https://arxiv.org/abs/1010.3436). **The output chain however is transformed back to the original
     SFH coefficients.**
+
+    :param model_name: (optional) 
+        name of the model to use: 'emulator', 'fsps', or 'fsps_complexdust'. (default: emulator) 
+
+    :param cosmo: (optional) 
+        astropy.cosmology object that specifies the cosmology.(default: astropy.cosmology.Planck13) 
+
+    :param ssp_grid: (optional) 
+        If True, the 'fsps' and 'fsps_complexdust' models are computed from a dust-free 
+        SSP grid over age and metallicity that is tabulated once with FSPS. Dust is applied 
+        analytically. If False, FSPS is called for each of the SFH time bins. The grid 
+        interpolates linearly in log age and log Z and has no dust emission, so it only 
+        agrees with FSPS to a few percent in the optical (see `_ssp_grid_model`). This is 
+        comparable to the emulator errors, so use the default when the FSPS model is the 
+        reference the emulator is validated against. (default: False) 
+
+    :param photo_emulator: (optional) 
+        hdf5 file of a photometry emulator constructed by
+        `iSpeculator.train_photo_emulator`, which maps theta and redshift directly 
+        to photometry. (default: None) 
     '''
-    def __init__(self, model_name='emulator', cosmo=cosmo): 
+    def __init__(self, model_name='emulator', cosmo=cosmo, ssp_grid=False, photo_emulator=None): 
+        self._config = {'model_name': model_name, 'cosmo': cosmo, 'ssp_grid': ssp_grid, 
+                'photo_emulator': photo_emulator} 
         self._init_model(model_name)
         self.cosmo = cosmo # cosmology  
+        self._photo_projections = {} # cached filter projections 
         self._load_model_params() # load emulator parameters
         self._load_NMF_bases() # read SFH and ZH basis 
         self._ssp_initiate() 
-
-        # interpolators for speeding up cosmological calculations 
-        _z = np.linspace(0, 0.4, 100)
-        _tage = self.cosmo.age(_z).value
-        _d_lum_cm = self.cosmo.luminosity_distance(_z).to(U.cm).value # luminosity distance in cm
-
-        self._tage_z_interp = \
-                Interp.InterpolatedUnivariateSpline(_z, _tage, k=3)
-        self._d_lum_z_interp = \
-                Interp.InterpolatedUnivariateSpline(_z, _d_lum_cm, k=3)
+        self._ssp_grid = None 
+        if ssp_grid and 'fsps' in self.model_name: self._ssp_grid_initiate() 
+        self._photo_emu = None 
+        if photo_emulator is not None: self.load_photo_emulator(photo_emulator) 
+        self._da_emulator = None # emulator for delayed acceptance 
 
     def MCMC_spectrophoto(self, wave_obs, flux_obs, flux_ivar_obs, photo_obs, photo_ivar_obs, zred, prior=None, 
             mask=None, bands='desi', nwalkers=100, burnin=100, niter=1000,
-            maxiter=200000, opt_maxiter=100, writeout=None, silent=True): 
+            maxiter=200000, opt_maxiter=100, sampler='emcee', nchains=4, mode='mcmc',
+            nprocs=None, nthreads=None, blas_threads=1, stop='psrf', chain_file=None, thin=1, 
+            resume=False, init='optimize', warm_start=None, writeout=None, silent=True): 
         ''' infer the posterior distribution of the free parameters given spectroscopy and photometry:
         observed wavelength, spectra flux, inverse variance flux, photometry, inv. variance photometry
         using MCMC. The function outputs a dictionary with the median theta of the posterior as well as 
@@ -1243,6 +2769,76 @@ class iSpeculator(iFSPS):
         :param opt_maxiter: (default: 1000) 
             maximum number of iterations for initial optimizer. 
         
+        :param sampler: (optional) 
+            MCMC sampler. If sampler == 'emcee', emcee is used with nwalkers
+            walkers. If sampler == 'emcee_da', emcee is used with delayed
+            acceptance, where proposals are screened with the emulator before
+            they are evaluated with the exact model (only for model_name ==
+            'fsps'; see `DelayedAcceptanceMove`). If sampler == 'nuts', the
+            No-U-Turn Sampler is used with nchains chains and burnin
+            adaptation iterations per chain (only for the emulator). 
+            (default: 'emcee') 
+
+        :param nchains: (optional) 
+            number of chains for the NUTS sampler. (default: 4) 
+
+        :param nprocs: (optional) 
+            number of processes used to evaluate the emcee walkers. Each
+            process has its own copy of the fitter (and FSPS for model_name ==
+            'fsps'). (default: None) 
+
+        :param nthreads: (optional) 
+            number of threads used to evaluate the emcee walkers. Useful for
+            the emulator, which releases the GIL, when the walkers cannot be
+            vectorized (e.g. custom priors). (default: None) 
+
+        :param blas_threads: (optional) 
+            number of threads of each BLAS call while the walkers are
+            evaluated in nthreads threads (requires threadpoolctl). The limit
+            applies to the whole process, so up to nthreads x blas_threads
+            cores are used. (default: 1) 
+
+        :param stop: (optional) 
+            stopping rule if niter == 'adaptive': 'psrf' (Gelman-Rubin) or
+            'autocorr' (chain longer than 50 autocorrelation times). With
+            'autocorr', the chain is also thinned by the autocorrelation time.
+            (default: 'psrf') 
+
+        :param chain_file: (optional) 
+            hdf5 file where the MCMC chain is streamed to in compressed blocks
+            while sampling, so that only the last block is kept in memory
+            (see `ChainBackend`). output['mcmc_chain'] is then a `ChainView`
+            that is read from chain_file block by block as it is needed. If
+            None, the chain is kept in memory. (default: None) 
+
+        :param thin: (optional) 
+            thinning of the returned MCMC chain. (default: 1) 
+
+        :param resume: (optional) 
+            If True, continue an interrupted run from the last checkpoint in
+            chain_file. The sampler state is checkpointed to chain_file after
+            the burn in and every 1000 iterations. (default: False) 
+
+        :param init: (optional) 
+            walker initialization: 'optimize' (small ball around the optimum
+            from the middle of the prior) or 'multistart' (around the best
+            optima of local optimizations from a Latin hypercube of starting
+            points). (default: 'optimize') 
+
+        :param warm_start: (optional) 
+            output dictionary, or file written by `writeout`, of a previous fit
+            of the same galaxy (e.g. `MCMC_photo`). If specified, the walkers
+            are initialized by resampling its MCMC chain and no optimization is
+            run. f_fiber is initialized around its best-fit value if the chain
+            does not include it. (default: None) 
+
+        :param mode: (optional) 
+            If mode == 'mcmc', the posterior is sampled with the sampler. If
+            mode == 'laplace', the posterior is approximated by a Gaussian at
+            the MAP with the inverse Hessian as the covariance and the chain is
+            nwalkers x niter (niter = 1000 if adaptive) samples drawn from it.
+            Only for the emulator. (default: 'mcmc') 
+
         :param writeout: (optional) 
             string specifying the output file. If specified, everything in the output dictionary 
             is written out as well as the entire MCMC chain. (default: None) 
@@ -1272,6 +2868,7 @@ class iSpeculator(iFSPS):
         *   Because the priors for the SFH basis parameters have Dirichlet priors, we have to do a 
             transformation to get it to work
         '''
+        self._check_nthreads(nthreads) 
         # check mask for spectra 
         _mask = self._check_mask(mask, wave_obs, flux_ivar_obs, zred) 
         
@@ -1294,28 +2891,89 @@ class iSpeculator(iFSPS):
                 'prior': prior          # prior
                 }
         
-        # run emcee and get MCMC chains 
-        _chain = self._emcee(
-                self._lnPost_spectrophoto, 
-                lnpost_args, 
-                lnpost_kwargs, 
-                nwalkers=nwalkers,
-                burnin=burnin, 
-                niter=niter, 
-                maxiter=maxiter,
-                opt_maxiter=opt_maxiter, 
-                silent=silent)
+        if warm_start is not None: 
+            if mode != 'mcmc' or sampler not in ['emcee', 'emcee_da']: 
+                raise ValueError("warm_start is only supported for sampler = 'emcee' or 'emcee_da'") 
+            # initialize the walkers from the posterior of a previous fit 
+            init = self._warm_start(warm_start, nwalkers, prior, wave_obs,
+                    flux_obs, flux_ivar_obs, zred, mask=_mask, silent=silent) 
+
+        # run emcee or NUTS (or Laplace approximation) and get MCMC chains 
+        if mode == 'laplace': 
+            _chain = self._laplace(
+                    self._lnPost_spectrophoto_batch, 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nsample=nwalkers * (niter if isinstance(niter, int) else 1000), 
+                    opt_maxiter=opt_maxiter, 
+                    vectorize=True, 
+                    silent=silent) 
+        elif mode != 'mcmc': 
+            raise ValueError("mode = 'mcmc' or 'laplace'") 
+        elif sampler == 'emcee': 
+            _chain = self._emcee(
+                    self._lnPost_spectrophoto_batch, 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nwalkers=nwalkers,
+                    burnin=burnin, 
+                    niter=niter, 
+                    maxiter=maxiter,
+                    opt_maxiter=opt_maxiter, 
+                    vectorize=True, 
+                    grad=(self.model_name == 'emulator'), 
+                    nprocs=nprocs, 
+                    stop=stop, 
+                    chain_file=chain_file, 
+                    thin=thin, 
+                    resume=resume, 
+                    init=init, 
+                    nthreads=nthreads, 
+                    blas_threads=blas_threads, 
+                    silent=silent)
+        elif sampler == 'emcee_da': 
+            _chain = self._emcee_delayed_acceptance(
+                    '_lnPost_spectrophoto_batch', 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nwalkers=nwalkers, 
+                    burnin=burnin, 
+                    niter=niter, 
+                    maxiter=maxiter, 
+                    opt_maxiter=opt_maxiter, 
+                    nprocs=nprocs, 
+                    stop=stop, 
+                    chain_file=chain_file, 
+                    thin=thin, 
+                    resume=resume, 
+                    init=init, 
+                    nthreads=nthreads, 
+                    blas_threads=blas_threads, 
+                    silent=silent)
+        elif sampler == 'nuts': 
+            _chain = self._nuts(
+                    self._lnPost_spectrophoto_batch, 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nchains=nchains, 
+                    burnin=burnin, 
+                    niter=niter, 
+                    maxiter=maxiter, 
+                    opt_maxiter=opt_maxiter, 
+                    vectorize=True, 
+                    silent=silent)
+        else: 
+            raise ValueError("sampler = 'emcee', 'emcee_da', or 'nuts'") 
 
         # transform chain back to original SFH basis 
-        chain = _chain.copy() 
-        chain[:,1:5] = self._transform_to_SFH_basis(_chain[:,1:5]) 
+        chain = self._chain_to_SFH_basis(_chain) 
 
         self.theta_names += ['f_fiber']
 
         prior_ranges = np.vstack([prior.min, prior.max]).T
         
         # get quanitles of the posterior
-        lowlow, low, med, high, highhigh = np.percentile(chain, [2.5, 16, 50, 84, 97.5], axis=0)
+        lowlow, low, med, high, highhigh = _chain_percentile(chain, [2.5, 16, 50, 84, 97.5])
     
         output = {} 
         output['redshift'] = zred
@@ -1348,12 +3006,17 @@ class iSpeculator(iFSPS):
         if writeout is not None: 
             fh5  = h5py.File(writeout, 'w') 
             for k in output.keys(): 
-                fh5.create_dataset(k, data=output[k]) 
+                if k == 'mcmc_chain': # compress the chain 
+                    _write_chain(fh5, k, output[k]) 
+                else: 
+                    fh5.create_dataset(k, data=output[k]) 
             fh5.close() 
         return output  
 
     def MCMC_spec(self, wave_obs, flux_obs, flux_ivar_obs, zred, mask=None, prior=None,
-            nwalkers=100, burnin=100, niter=1000, maxiter=200000, opt_maxiter=100, writeout=None, silent=True): 
+            nwalkers=100, burnin=100, niter=1000, maxiter=200000, opt_maxiter=100,
+            sampler='emcee', nchains=4, mode='mcmc', nprocs=None, nthreads=None, blas_threads=1, 
+            stop='psrf', chain_file=None, thin=1, resume=False, init='optimize', writeout=None, silent=True): 
         ''' infer the posterior distribution of the free parameters given observed
         wavelength, spectra flux, and inverse variance using MCMC. The function 
         outputs a dictionary with the median theta of the posterior as well as the 
@@ -1395,6 +3058,69 @@ class iSpeculator(iFSPS):
             maximum number of iterations for initial optimizer. 
         
         
+        :param sampler: (optional) 
+            MCMC sampler. If sampler == 'emcee', emcee is used with nwalkers
+            walkers. If sampler == 'emcee_da', emcee is used with delayed
+            acceptance, where proposals are screened with the emulator before
+            they are evaluated with the exact model (only for model_name ==
+            'fsps'; see `DelayedAcceptanceMove`). If sampler == 'nuts', the
+            No-U-Turn Sampler is used with nchains chains and burnin
+            adaptation iterations per chain (only for the emulator). 
+            (default: 'emcee') 
+
+        :param nchains: (optional) 
+            number of chains for the NUTS sampler. (default: 4) 
+
+        :param nprocs: (optional) 
+            number of processes used to evaluate the emcee walkers. Each
+            process has its own copy of the fitter (and FSPS for model_name ==
+            'fsps'). (default: None) 
+
+        :param nthreads: (optional) 
+            number of threads used to evaluate the emcee walkers. Useful for
+            the emulator, which releases the GIL, when the walkers cannot be
+            vectorized (e.g. custom priors). (default: None) 
+
+        :param blas_threads: (optional) 
+            number of threads of each BLAS call while the walkers are
+            evaluated in nthreads threads (requires threadpoolctl). The limit
+            applies to the whole process, so up to nthreads x blas_threads
+            cores are used. (default: 1) 
+
+        :param stop: (optional) 
+            stopping rule if niter == 'adaptive': 'psrf' (Gelman-Rubin) or
+            'autocorr' (chain longer than 50 autocorrelation times). With
+            'autocorr', the chain is also thinned by the autocorrelation time.
+            (default: 'psrf') 
+
+        :param chain_file: (optional) 
+            hdf5 file where the MCMC chain is streamed to in compressed blocks
+            while sampling, so that only the last block is kept in memory
+            (see `ChainBackend`). output['mcmc_chain'] is then a `ChainView`
+            that is read from chain_file block by block as it is needed. If
+            None, the chain is kept in memory. (default: None) 
+
+        :param thin: (optional) 
+            thinning of the returned MCMC chain. (default: 1) 
+
+        :param resume: (optional) 
+            If True, continue an interrupted run from the last checkpoint in
+            chain_file. The sampler state is checkpointed to chain_file after
+            the burn in and every 1000 iterations. (default: False) 
+
+        :param init: (optional) 
+            walker initialization: 'optimize' (small ball around the optimum
+            from the middle of the prior) or 'multistart' (around the best
+            optima of local optimizations from a Latin hypercube of starting
+            points). (default: 'optimize') 
+
+        :param mode: (optional) 
+            If mode == 'mcmc', the posterior is sampled with the sampler. If
+            mode == 'laplace', the posterior is approximated by a Gaussian at
+            the MAP with the inverse Hessian as the covariance and the chain is
+            nwalkers x niter (niter = 1000 if adaptive) samples drawn from it.
+            Only for the emulator. (default: 'mcmc') 
+
         :param writeout: (optional) 
             string specifying the output file. If specified, everything in the output dictionary 
             is written out as well as the entire MCMC chain. (default: None) 
@@ -1416,6 +3142,7 @@ class iSpeculator(iFSPS):
             - output['flux_spec_data'] : flux of observed spectrum 
             - output['flux_spec_ivar_data'] = inverse variance of the observed flux. 
         '''
+        self._check_nthreads(nthreads) 
         # check mask 
         _mask = self._check_mask(mask, wave_obs, flux_ivar_obs, zred) 
 
@@ -1429,25 +3156,79 @@ class iSpeculator(iFSPS):
                 'prior': prior          # prior 
                 }
 
-        # run emcee and get MCMC chains 
-        _chain = self._emcee(
-                self._lnPost, 
-                lnpost_args, 
-                lnpost_kwargs, 
-                nwalkers=nwalkers, 
-                burnin=burnin, 
-                niter=niter, 
-                maxiter=maxiter,
-                opt_maxiter=opt_maxiter,
-                silent=silent)
+        # run emcee or NUTS (or Laplace approximation) and get MCMC chains 
+        if mode == 'laplace': 
+            _chain = self._laplace(
+                    self._lnPost_batch, 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nsample=nwalkers * (niter if isinstance(niter, int) else 1000), 
+                    opt_maxiter=opt_maxiter, 
+                    vectorize=True, 
+                    silent=silent) 
+        elif mode != 'mcmc': 
+            raise ValueError("mode = 'mcmc' or 'laplace'") 
+        elif sampler == 'emcee': 
+            _chain = self._emcee(
+                    self._lnPost_batch, 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nwalkers=nwalkers, 
+                    burnin=burnin, 
+                    niter=niter, 
+                    maxiter=maxiter,
+                    opt_maxiter=opt_maxiter,
+                    vectorize=True, 
+                    grad=(self.model_name == 'emulator'), 
+                    nprocs=nprocs, 
+                    stop=stop, 
+                    chain_file=chain_file, 
+                    thin=thin, 
+                    resume=resume, 
+                    init=init, 
+                    nthreads=nthreads, 
+                    blas_threads=blas_threads, 
+                    silent=silent)
+        elif sampler == 'emcee_da': 
+            _chain = self._emcee_delayed_acceptance(
+                    '_lnPost_batch', 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nwalkers=nwalkers, 
+                    burnin=burnin, 
+                    niter=niter, 
+                    maxiter=maxiter, 
+                    opt_maxiter=opt_maxiter, 
+                    nprocs=nprocs, 
+                    stop=stop, 
+                    chain_file=chain_file, 
+                    thin=thin, 
+                    resume=resume, 
+                    init=init, 
+                    nthreads=nthreads, 
+                    blas_threads=blas_threads, 
+                    silent=silent)
+        elif sampler == 'nuts': 
+            _chain = self._nuts(
+                    self._lnPost_batch, 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nchains=nchains, 
+                    burnin=burnin, 
+                    niter=niter, 
+                    maxiter=maxiter, 
+                    opt_maxiter=opt_maxiter, 
+                    vectorize=True, 
+                    silent=silent)
+        else: 
+            raise ValueError("sampler = 'emcee', 'emcee_da', or 'nuts'") 
         # transform chain back to original SFH basis 
-        chain = _chain.copy() 
-        chain[:,1:5] = self._transform_to_SFH_basis(_chain[:,1:5]) 
+        chain = self._chain_to_SFH_basis(_chain) 
 
         prior_ranges = np.vstack([prior.min, prior.max]).T
     
         # get quanitles of the posterior
-        lowlow, low, med, high, highhigh = np.percentile(chain, [2.5, 16, 50, 84, 97.5], axis=0)
+        lowlow, low, med, high, highhigh = _chain_percentile(chain, [2.5, 16, 50, 84, 97.5])
     
         output = {} 
         output['redshift']          = zred
@@ -1474,13 +3255,18 @@ class iSpeculator(iFSPS):
         if writeout is not None: 
             fh5  = h5py.File(writeout, 'w') 
             for k in output.keys(): 
-                fh5.create_dataset(k, data=output[k]) 
+                if k == 'mcmc_chain': # compress the chain 
+                    _write_chain(fh5, k, output[k]) 
+                else: 
+                    fh5.create_dataset(k, data=output[k]) 
             fh5.close() 
         return output  
     
     def MCMC_photo(self, photo_obs, photo_ivar_obs, zred, bands='desi', prior=None,
             nwalkers=100, burnin=100, niter=1000, maxiter=200000,
-            opt_maxiter=100, writeout=None, silent=True): 
+            opt_maxiter=100, sampler='emcee', nchains=4, mode='mcmc', 
+            photo_emulator=False, nprocs=None, nthreads=None, blas_threads=1, stop='psrf', 
+            chain_file=None, thin=1, resume=False, init='optimize', writeout=None, silent=True): 
         ''' infer the posterior distribution of the free parameters given observed
         photometric flux, and inverse variance using MCMC. The function 
         outputs a dictionary with the median theta of the posterior as well as the 
@@ -1517,6 +3303,79 @@ class iSpeculator(iFSPS):
         :param opt_maxiter: (default: 1000) 
             maximum number of iterations for initial optimizer. 
         
+        :param sampler: (optional) 
+            MCMC sampler. If sampler == 'emcee', emcee is used with nwalkers
+            walkers. If sampler == 'emcee_da', emcee is used with delayed
+            acceptance, where proposals are screened with the emulator before
+            they are evaluated with the exact model (only for model_name ==
+            'fsps'; see `DelayedAcceptanceMove`). If sampler == 'nuts', the
+            No-U-Turn Sampler is used with nchains chains and burnin
+            adaptation iterations per chain (only for the emulator). 
+            (default: 'emcee') 
+
+        :param nchains: (optional) 
+            number of chains for the NUTS sampler. (default: 4) 
+
+        :param nprocs: (optional) 
+            number of processes used to evaluate the emcee walkers. Each
+            process has its own copy of the fitter (and FSPS for model_name ==
+            'fsps'). (default: None) 
+
+        :param nthreads: (optional) 
+            number of threads used to evaluate the emcee walkers. Useful for
+            the emulator, which releases the GIL, when the walkers cannot be
+            vectorized (e.g. custom priors). (default: None) 
+
+        :param blas_threads: (optional) 
+            number of threads of each BLAS call while the walkers are
+            evaluated in nthreads threads (requires threadpoolctl). The limit
+            applies to the whole process, so up to nthreads x blas_threads
+            cores are used. (default: 1) 
+
+        :param stop: (optional) 
+            stopping rule if niter == 'adaptive': 'psrf' (Gelman-Rubin) or
+            'autocorr' (chain longer than 50 autocorrelation times). With
+            'autocorr', the chain is also thinned by the autocorrelation time.
+            (default: 'psrf') 
+
+        :param chain_file: (optional) 
+            hdf5 file where the MCMC chain is streamed to in compressed blocks
+            while sampling, so that only the last block is kept in memory
+            (see `ChainBackend`). output['mcmc_chain'] is then a `ChainView`
+            that is read from chain_file block by block as it is needed. If
+            None, the chain is kept in memory. (default: None) 
+
+        :param thin: (optional) 
+            thinning of the returned MCMC chain. (default: 1) 
+
+        :param resume: (optional) 
+            If True, continue an interrupted run from the last checkpoint in
+            chain_file. The sampler state is checkpointed to chain_file after
+            the burn in and every 1000 iterations. (default: False) 
+
+        :param init: (optional) 
+            walker initialization: 'optimize' (small ball around the optimum
+            from the middle of the prior) or 'multistart' (around the best
+            optima of local optimizations from a Latin hypercube of starting
+            points). (default: 'optimize') 
+
+        :param mode: (optional) 
+            If mode == 'mcmc', the posterior is sampled with the sampler. If
+            mode == 'laplace', the posterior is approximated by a Gaussian at
+            the MAP with the inverse Hessian as the covariance and the chain is
+            nwalkers x niter (niter = 1000 if adaptive) samples drawn from it.
+            Only for the emulator. (default: 'mcmc') 
+
+        :param photo_emulator: (optional) 
+            If True, the model photometry is computed with the photometry
+            emulator (see `train_photo_emulator`) rather than the spectral
+            emulator and filter integration. The photometry emulator is checked
+            against the spectral path at zred first and only used if it is 
+            accurate. Since it is trained on the spectral emulator, it can only
+            be used for model_name == 'emulator' or, with sampler ==
+            'emcee_da', to screen the proposals for the FSPS posterior. 
+            (default: False) 
+
         :param writeout: (optional) 
             string specifying the output file. If specified, everything in the output dictionary 
             is written out as well as the entire MCMC chain. (default: None) 
@@ -1538,12 +3397,26 @@ class iSpeculator(iFSPS):
             - output['flux_photo_ivar_data'] = inverse variance of the observed
               photometry
         '''
+        self._check_nthreads(nthreads) 
         # get photometric bands  
         bands_list = self._get_bands(bands)
         assert len(bands_list) == len(photo_obs) 
         # get filters
         filters = specFilter.load_filters(*tuple(bands_list))
 
+        if photo_emulator: 
+            # the photometry emulator is trained on the spectral emulator, so
+            # it never replaces FSPS. With delayed acceptance it only screens
+            # proposals (see `_emcee_delayed_acceptance`) 
+            if self.model_name == 'emulator': 
+                emulator = self 
+            elif mode == 'mcmc' and sampler == 'emcee_da': 
+                emulator = self._delayed_acceptance_emulator() 
+            else: 
+                raise ValueError("photo_emulator requires model_name == 'emulator' or sampler == 'emcee_da'") 
+            # check the photometry emulator against the spectral path 
+            photo_emulator = emulator._photo_emulator_check(filters, zred, prior, silent=silent) 
+
         # posterior function args and kwargs
         lnpost_args = (
                 photo_obs,               # nanomaggies
@@ -1552,28 +3425,83 @@ class iSpeculator(iFSPS):
                 ) 
         lnpost_kwargs = {
                 'filters': filters,
+                'photo_emulator': photo_emulator, 
                 'prior': prior   # prior object
                 }
     
-        # run emcee and get MCMC chains 
-        _chain = self._emcee(
-                self._lnPost_photo, 
-                lnpost_args, 
-                lnpost_kwargs, 
-                nwalkers=nwalkers, 
-                burnin=burnin, 
-                niter=niter, 
-                maxiter=maxiter, 
-                opt_maxiter=opt_maxiter, 
-                silent=silent)
+        # run emcee or NUTS (or Laplace approximation) and get MCMC chains 
+        if mode == 'laplace': 
+            _chain = self._laplace(
+                    self._lnPost_photo_batch, 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nsample=nwalkers * (niter if isinstance(niter, int) else 1000), 
+                    opt_maxiter=opt_maxiter, 
+                    vectorize=True, 
+                    silent=silent) 
+        elif mode != 'mcmc': 
+            raise ValueError("mode = 'mcmc' or 'laplace'") 
+        elif sampler == 'emcee': 
+            _chain = self._emcee(
+                    self._lnPost_photo_batch, 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nwalkers=nwalkers, 
+                    burnin=burnin, 
+                    niter=niter, 
+                    maxiter=maxiter, 
+                    opt_maxiter=opt_maxiter, 
+                    vectorize=True, 
+                    grad=(self.model_name == 'emulator'), 
+                    nprocs=nprocs, 
+                    stop=stop, 
+                    chain_file=chain_file, 
+                    thin=thin, 
+                    resume=resume, 
+                    init=init, 
+                    nthreads=nthreads, 
+                    blas_threads=blas_threads, 
+                    silent=silent)
+        elif sampler == 'emcee_da': 
+            _chain = self._emcee_delayed_acceptance(
+                    '_lnPost_photo_batch', 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nwalkers=nwalkers, 
+                    burnin=burnin, 
+                    niter=niter, 
+                    maxiter=maxiter, 
+                    opt_maxiter=opt_maxiter, 
+                    nprocs=nprocs, 
+                    stop=stop, 
+                    chain_file=chain_file, 
+                    thin=thin, 
+                    resume=resume, 
+                    init=init, 
+                    nthreads=nthreads, 
+                    blas_threads=blas_threads, 
+                    silent=silent)
+        elif sampler == 'nuts': 
+            _chain = self._nuts(
+                    self._lnPost_photo_batch, 
+                    lnpost_args, 
+                    lnpost_kwargs, 
+                    nchains=nchains, 
+                    burnin=burnin, 
+                    niter=niter, 
+                    maxiter=maxiter, 
+                    opt_maxiter=opt_maxiter, 
+                    vectorize=True, 
+                    silent=silent)
+        else: 
+            raise ValueError("sampler = 'emcee', 'emcee_da', or 'nuts'") 
         # transform chain back to original SFH basis 
-        chain = _chain.copy() 
-        chain[:,1:5] = self._transform_to_SFH_basis(_chain[:,1:5]) 
+        chain = self._chain_to_SFH_basis(_chain) 
 
         prior_ranges = np.vstack([prior.min, prior.max]).T
     
         # get quanitles of the posterior
-        lowlow, low, med, high, highhigh = np.percentile(chain, [2.5, 16, 50, 84, 97.5], axis=0)
+        lowlow, low, med, high, highhigh = _chain_percentile(chain, [2.5, 16, 50, 84, 97.5])
     
         output = {} 
         output['redshift']          = zred
@@ -1597,11 +3525,75 @@ class iSpeculator(iFSPS):
         if writeout is not None: 
             fh5  = h5py.File(writeout, 'w') 
             for k in output.keys(): 
-                fh5.create_dataset(k, data=output[k]) 
+                if k == 'mcmc_chain': # compress the chain 
+                    _write_chain(fh5, k, output[k]) 
+                else: 
+                    fh5.create_dataset(k, data=output[k]) 
             fh5.close() 
         return output  
 
-    def model(self, zz_arr, zred=0.1, wavelength=None, dont_transform=False): 
+    def _emcee_delayed_acceptance(self, lnpost_name, lnpost_args, lnpost_kwargs, silent=True, 
+            **emcee_kwargs): 
+        ''' run emcee with delayed acceptance: proposals are first screened
+        with the emulator log posterior and only the proposals that pass are 
+        evaluated with the exact FSPS log posterior. The initial optimizer
+        also uses the emulator. The number of exact evaluations that were 
+        avoided is stored in self.delayed_acceptance. If lnpost_kwargs has
+        photo_emulator, the photometry emulator is only used for the emulator
+        log posterior. 
+
+        :param lnpost_name: 
+            name of the batched log posterior method (e.g. '_lnPost_batch') 
+
+        :param lnpost_args, lnpost_kwargs: 
+            arguments and keyword arguments of the log posterior 
+
+        :param emcee_kwargs: 
+            keyword arguments passed to `_emcee` 
+        '''
+        if self.model_name != 'fsps': 
+            raise ValueError("delayed acceptance is only available for model_name == 'fsps'") 
+        self._check_nthreads(emcee_kwargs.get('nthreads')) 
+        lnpost_emu = getattr(self._delayed_acceptance_emulator(), lnpost_name) 
+        
+        # the exact stage is always evaluated with FSPS 
+        lnpost_kwargs_exact = dict(lnpost_kwargs) 
+        lnpost_kwargs_exact.pop('photo_emulator', None) 
+
+        move = DelayedAcceptanceMove(lnpost_emu, lnpost_args, lnpost_kwargs) 
+        chain = self._emcee(
+                getattr(self, lnpost_name), 
+                lnpost_args, 
+                lnpost_kwargs_exact, 
+                vectorize=True, 
+                grad=True, 
+                moves=move, 
+                opt_lnpost_fn=lnpost_emu, 
+                silent=silent, 
+                **emcee_kwargs) 
+
+        self.delayed_acceptance = {
+                'n_proposed': move.n_proposed, 
+                'n_exact': move.n_exact, 
+                'n_avoided': move.n_proposed - move.n_exact}
+        if not silent: 
+            print('delayed acceptance: %i of %i proposals evaluated with FSPS (%i avoided)' % 
+                    (move.n_exact, move.n_proposed, move.n_proposed - move.n_exact))
+        return chain 
+
+    def _delayed_acceptance_emulator(self): 
+        ''' emulator that screens the proposals for delayed acceptance. It has
+        the same parameterization as the fsps model and shares its photometry
+        emulator. 
+        '''
+        if self._da_emulator is None: 
+            self._da_emulator = iSpeculator(model_name='emulator', cosmo=self.cosmo) 
+        if self._da_emulator._photo_emu is not self._photo_emu: 
+            self._da_emulator._photo_emu = self._photo_emu 
+            self._da_emulator._photo_emu_checked = {} 
+        return self._da_emulator 
+
+    def model(self, zz_arr, zred=0.1, wavelength=None, dont_transform=False, grad=False): 
         ''' calls Speculator to computee SED given theta. theta[1:4] are the **transformed** SFH basis coefficients, 
         not the actual coefficients! This method is called by the inference method. 
 
@@ -1617,6 +3609,9 @@ class iSpeculator(iFSPS):
             wavelengths.
         :param dont_transform:
             If True, skips the transformation  
+        :param grad: (default: False) 
+            If True, also returns the derivatives of the spectra with respect
+            to zz_arr. Only available for the emulator. 
 
         returns
         -------
@@ -1624,42 +3619,110 @@ class iSpeculator(iFSPS):
             output wavelength (angstroms) 
         outspec : array 
             spectra generated from FSPS model(theta) in units of 1e-17 * erg/s/cm^2/Angstrom
+        doutspec : array 
+            (if grad) Ntheta x Nwave array of d outspec / d zz_arr 
         '''
-        tage    = self._tage_z_interp(zred)
+        out = self.model_batch(np.atleast_2d(zz_arr), zred=zred,
+                wavelength=wavelength, dont_transform=dont_transform, grad=grad)
+        return (out[0],) + tuple(_out[0] for _out in out[1:])
+
+    def model_batch(self, zz_arr, zred=0.1, wavelength=None, dont_transform=False, grad=False): 
+        ''' same as `model` but for an N x Ntheta array of parameters (e.g. the
+        positions of all the MCMC walkers). For the emulator, the SEDs are
+        computed in a single batched forward pass. 
+
+        :param zz_arr:
+            N x Ntheta array of parameters. See `model` for details. 
+        :param zred: float (default: 0.1) 
+            The output wavelength and spectra are redshifted.
+        :param wavelength: (default: None)  
+            If specified, the model will interpolate the spectra to the specified 
+            wavelengths.
+        :param dont_transform:
+            If True, skips the transformation  
+        :param grad: (default: False) 
+            If True, also returns the derivatives of the spectra with respect
+            to zz_arr. The derivatives are exact through the emulator, the
+            SFH basis transformation and the mass and redshift scaling. Only
+            available for the emulator. 
+
+        :return outwave, outspec: 
+            output wavelength (angstroms) and N x Nwave array of spectra in
+            units of 1e-17 * erg/s/cm^2/Angstrom
+        :return doutspec: 
+            (if grad) N x Ntheta x Nwave array of d outspec / d zz_arr 
+        '''
+        if grad and self.model_name != 'emulator': 
+            raise ValueError("analytic gradients are only available for the emulator") 
+
+        tage    = Cosmo.age(self.cosmo, zred)
 
         # logmstar, b1SFH, b2SFH, b3SFH, b4SFH, g1ZH, g2ZH, tau, tage
-        ntheta = zz_arr.shape[0]
-        tt_arr = np.zeros(ntheta+1) 
-        tt_arr[:ntheta] = zz_arr
-        tt_arr[-1] = tage
+        zz_arr = np.atleast_2d(zz_arr) 
+        nbatch, ntheta = zz_arr.shape
+        tt_arr = np.zeros((nbatch, ntheta+1))
+        tt_arr[:,:ntheta] = zz_arr
+        tt_arr[:,-1] = tage
         # transform back to SFH basis coefficients 
         if not dont_transform: 
-            tt_arr[1:5] = self._transform_to_SFH_basis(zz_arr[1:5]) 
+            tt_arr[:,1:5] = self._transform_to_SFH_basis(zz_arr[:,1:5]) 
         
         # input: b1SFH, b2SFH, b3SFH, b4SFH, g1ZH, g2ZH, tau, tage
+        view = None 
         if self.model_name == 'emulator': 
-            ssp_lum = self._emulator(tt_arr[1:]) 
+            if wavelength is not None: 
+                # only evaluate the emulator within the observed wavelength window
+                view = self._emulator_view(zred, wavelength) 
+            if grad: 
+                ssp_lum, dssp_lum = self._emulator_batch(tt_arr[:,1:], view=view, grad=True) 
+            else: 
+                ssp_lum = self._emulator_batch(tt_arr[:,1:], view=view) 
             w = self._emu_wave
         elif 'fsps' in self.model_name: 
-            w, ssp_lum = self._fsps_model(tt_arr[1:]) 
+            ssp_lum = []
+            for _tt in tt_arr: 
+                w, _ssp_lum = self._fsps_model(_tt[1:]) 
+                ssp_lum.append(_ssp_lum) 
+            ssp_lum = np.array(ssp_lum) 
 
         # mass normalization
-        lum_ssp = (10**tt_arr[0]) * ssp_lum
+        lum_ssp = (10**tt_arr[:,0])[:,None] * ssp_lum
 
         # redshift the spectra
         w_z = w * (1. + zred)
-        d_lum = self._d_lum_z_interp(zred) 
+        d_lum = Cosmo.luminosity_distance(self.cosmo, zred) 
         flux_z = lum_ssp * UT.Lsun() / (4. * np.pi * d_lum**2) / (1. + zred) * 1e17 # 10^-17 ergs/s/cm^2/Ang
 
+        if grad: 
+            # d flux_z / d logmstar, d flux_z / d (b1SFH...b4SFH), d flux_z / d (g1ZH, g2ZH, tau) 
+            flux_scale = (10**tt_arr[:,0] * UT.Lsun() / (4. * np.pi * d_lum**2) / (1. + zred) * 1e17)[:,None,None]
+            dflux_z = np.zeros((nbatch, ntheta, flux_z.shape[1]))
+            dflux_z[:,0,:] = np.log(10.) * flux_z 
+            if dont_transform: 
+                dflux_z[:,1:5,:] = flux_scale * dssp_lum[:,:4,:]
+            else: 
+                dflux_z[:,1:5,:] = flux_scale * np.einsum('nij,niw->njw',
+                        self._transform_to_SFH_basis_jacobian(zz_arr[:,1:5]),
+                        dssp_lum[:,:4,:])
+            dflux_z[:,5:,:] = flux_scale * dssp_lum[:,4:,:]
+            flux_z = np.concatenate([flux_z, dflux_z.reshape(-1, flux_z.shape[1])], axis=0)
+
         if wavelength is None: 
             outwave = w_z
             outspec = flux_z
+        elif view is not None: 
+            outwave = wavelength
+            outspec = view['interp'].dot(flux_z.T).T
         else: 
             outwave = wavelength
-            outspec = np.interp(outwave, w_z, flux_z, left=0, right=0)
+            outspec = self._interp_batch(outwave, w_z, flux_z)
+
+        if grad: 
+            return outwave, outspec[:nbatch], outspec[nbatch:].reshape(nbatch, ntheta, -1) 
         return outwave, outspec 
-    
-    def model_photo(self, zz_arr, zred=0.1, filters=None, bands=None, dont_transform=False): 
+
+    def model_photo(self, zz_arr, zred=0.1, filters=None, bands=None, dont_transform=False, grad=False, 
+            photo_emulator=False): 
         ''' very simple wrapper for a fsps model with minimal overhead. Generates photometry 
         in specified photometric bands 
 
@@ -1676,8 +3739,34 @@ class iSpeculator(iFSPS):
             photometric bands to generate the photometry. Either bands or filters has to be 
             specified. (default: None)  
 
+        :param grad: (default: False) 
+            If True, also returns the derivatives of the photometry with
+            respect to zz_arr. Only available for the emulator. 
+
+        :param photo_emulator: (default: False) 
+            If True, the photometry is computed with the photometry emulator
+            (see `train_photo_emulator`) instead of the spectral emulator. 
+
         :return outphoto:
             array of photometric fluxes in nanomaggies in the specified bands 
+        :return doutphoto: 
+            (if grad) Ntheta x Nband array of d outphoto / d zz_arr 
+        '''
+        out = self.model_photo_batch(np.atleast_2d(zz_arr), zred=zred,
+                filters=filters, bands=bands, dont_transform=dont_transform, grad=grad, 
+                photo_emulator=photo_emulator)
+        if grad: 
+            return out[0][0], out[1][0]
+        return out[0]
+
+    def model_photo_batch(self, zz_arr, zred=0.1, filters=None, bands=None, dont_transform=False, grad=False, 
+            photo_emulator=False): 
+        ''' same as `model_photo` but for an N x Ntheta array of parameters. 
+
+        :return outphoto:
+            N x Nband array of photometric fluxes in nanomaggies in the specified bands 
+        :return doutphoto: 
+            (if grad) N x Ntheta x Nband array of d outphoto / d zz_arr 
         '''
         if filters is None: 
             if bands is not None: 
@@ -1686,37 +3775,23 @@ class iSpeculator(iFSPS):
             else: 
                 raise ValueError("specify either filters or bands") 
 
-        w, spec = self.model(zz_arr, zred=zred, dont_transform=dont_transform) # get SED  
-         
-        try: 
-            maggies = filters.get_ab_maggies(np.atleast_2d(spec) * 1e-17*U.erg/U.s/U.cm**2/U.Angstrom, wavelength=w*U.Angstrom) # maggies 
-        except ValueError: 
-            # this is a duct tape fix for the limited wavelength range of
-            # speculator. In the future we need to retrain speculator to have a
-            # wide wavelength range!
-            # we *carelessly* zero pad the wavelengths assuming that the edges
-            # of the transmission curve don't contribute to the photometry
-            w_min, w_max = w.min(), w.max() 
-            n_below = int(w_min - 1e3) + 1 # 1A resolution padding
-            n_above = int(2e4 - w_max) + 1
-            print('************************************************************') 
-            print('WARNING: wavelength range of speculator does not cover the wavelength range of the bandpass filter!!!') 
-            print('WARNING: wavelength range of speculator does not cover the wavelength range of the bandpass filter!!!') 
-            print('WARNING: we currently zero pad it, which may result in incorrect photometry!') 
-
-            w_pad = np.concatenate([
-                np.linspace(1e3, w_min, n_below)[:-1], 
-                w,
-                np.linspace(w_max, 2e4, n_above)[1:]]) 
-            spec_pad = np.concatenate([
-                np.zeros(n_below-1), 
-                spec, 
-                np.zeros(n_above-1)])
-            maggies = filters.get_ab_maggies(np.atleast_2d(spec_pad) * 1e-17*U.erg/U.s/U.cm**2/U.Angstrom, wavelength=w_pad*U.Angstrom) # maggies 
-        return np.array(list(maggies[0])) * 1e9
+        if photo_emulator: 
+            return self._photo_emulator_batch(zz_arr, zred, filters,
+                    dont_transform=dont_transform, grad=grad) 
+
+        if not grad: 
+            w, spec = self.model_batch(zz_arr, zred=zred, dont_transform=dont_transform) # get SED  
+            return self._get_photo(w, spec, filters) 
+
+        w, spec, dspec = self.model_batch(zz_arr, zred=zred,
+                dont_transform=dont_transform, grad=True) # get SED and derivatives 
+        # photometry is linear in the SED
+        nbatch, ntheta, _ = dspec.shape
+        photo = self._get_photo(w, np.concatenate([spec, dspec.reshape(nbatch*ntheta, -1)]), filters)
+        return photo[:nbatch], photo[nbatch:].reshape(nbatch, ntheta, -1) 
     
     def _model_spectrophoto(self, tt_arr, zred=0.1, wavelength=None,
-            filters=None, bands=None, dont_transform=False): 
+            filters=None, bands=None, dont_transform=False, grad=False): 
         ''' very simple wrapper for a fsps model with minimal overhead. Generates photometry 
         in specified photometric bands 
 
@@ -1736,6 +3811,23 @@ class iSpeculator(iFSPS):
         :return outphoto:
             array of photometric fluxes in nanomaggies in the specified bands 
         '''
+        out = self._model_spectrophoto_batch(np.atleast_2d(tt_arr),
+                zred=zred, wavelength=wavelength, filters=filters, bands=bands,
+                dont_transform=dont_transform, grad=grad)
+        return tuple(_out[0] for _out in out)
+
+    def _model_spectrophoto_batch(self, tt_arr, zred=0.1, wavelength=None,
+            filters=None, bands=None, dont_transform=False, grad=False): 
+        ''' same as `_model_spectrophoto` but for an N x Ntheta array of
+        parameters. 
+
+        :return outspec, outphoto:
+            N x Nwave array of spectra interpolated to `wavelength` and N x
+            Nband array of photometric fluxes in nanomaggies 
+        :return doutspec, doutphoto: 
+            (if grad) N x Ntheta x Nwave and N x Ntheta x Nband arrays of the
+            derivatives of outspec and outphoto with respect to tt_arr
+        '''
         if filters is None: 
             if bands is not None: 
                 bands_list = self._get_bands(bands) # get list of bands 
@@ -1743,40 +3835,244 @@ class iSpeculator(iFSPS):
             else: 
                 raise ValueError("specify either filters or bands") 
 
-        w, spec = self.model(tt_arr, zred=zred, dont_transform=dont_transform) # get spectra  
+        if grad: 
+            w, spec, dspec = self.model_batch(tt_arr, zred=zred,
+                    dont_transform=dont_transform, grad=True) # get spectra and derivatives 
+            nbatch, ntheta, _ = dspec.shape
+            spec = np.concatenate([spec, dspec.reshape(nbatch*ntheta, -1)])
+        else: 
+            w, spec = self.model_batch(tt_arr, zred=zred, dont_transform=dont_transform) # get spectra  
 
         if wavelength is not None: 
-            outspec = np.zeros(wavelength.shape)
-            outspec = np.interp(wavelength, w, spec, left=0, right=0)
-    
-        try: 
-            maggies = filters.get_ab_maggies(np.atleast_2d(spec) * 1e-17*U.erg/U.s/U.cm**2/U.Angstrom,
-                wavelength=w.flatten()*U.Angstrom) # maggies 
-        except ValueError: 
-            # this is a duct tape fix for the limited wavelength range of
-            # speculator. In the future we need to retrain speculator to have a
-            # wide wavelength range!
-            # we *carelessly* zero pad the wavelengths assuming that the edges
-            # of the transmission curve don't contribute to the photometry
-            w_min, w_max = w.min(), w.max() 
-            n_below = int(w_min - 1e3) + 1 # 1A resolution padding
-            n_above = int(2e4 - w_max) + 1
-            print('************************************************************') 
-            print('WARNING: wavelength range of speculator does not cover the wavelength range of the bandpass filter!!!') 
-            print('WARNING: wavelength range of speculator does not cover the wavelength range of the bandpass filter!!!') 
-            print('WARNING: we currently zero pad it, which may result in incorrect photometry!') 
-
-            w_pad = np.concatenate([
-                np.linspace(1e3, w_min, n_below)[:-1], 
-                w,
-                np.linspace(w_max, 2e4, n_above)[1:]]) 
-            spec_pad = np.concatenate([
-                np.zeros(n_below-1), 
-                spec, 
-                np.zeros(n_above-1)])
-            maggies = filters.get_ab_maggies(np.atleast_2d(spec_pad) * 1e-17*U.erg/U.s/U.cm**2/U.Angstrom, wavelength=w_pad*U.Angstrom) # maggies 
-
-        return outspec, np.array(list(maggies[0])) * 1e9
+            outspec = self._interp_batch(wavelength, w, spec)
+        else: 
+            outspec = spec
+        outphoto = self._get_photo(w, spec, filters)
+
+        if grad: 
+            return (outspec[:nbatch], outphoto[:nbatch], 
+                    outspec[nbatch:].reshape(nbatch, ntheta, -1), 
+                    outphoto[nbatch:].reshape(nbatch, ntheta, -1))
+        return outspec, outphoto
+
+    def _build_photo_projection(self, w, filters): 
+        ''' build the filter projection matrix (see `Fitter._photo_projection`).
+        If the wavelength range of speculator does not cover the filters, the
+        wavelengths are zero padded once here rather than for every
+        photometry evaluation. 
+        '''
+        w_min, w_max = w.min(), w.max() 
+        if (w_min <= np.min([_f.wavelength[0] for _f in filters]) and 
+                w_max >= np.max([_f.wavelength[-1] for _f in filters])): 
+            return super(iSpeculator, self)._build_photo_projection(w, filters) 
+
+        # this is a duct tape fix for the limited wavelength range of
+        # speculator. In the future we need to retrain speculator to have a
+        # wide wavelength range!
+        # we *carelessly* zero pad the wavelengths assuming that the edges
+        # of the transmission curve don't contribute to the photometry
+        n_below = int(w_min - 1e3) + 1 # 1A resolution padding
+        n_above = int(2e4 - w_max) + 1
+        print('************************************************************') 
+        print('WARNING: wavelength range of speculator does not cover the wavelength range of the bandpass filter!!!') 
+        print('WARNING: we currently zero pad it, which may result in incorrect photometry!') 
+
+        w_pad = np.concatenate([
+            np.linspace(1e3, w_min, n_below)[:-1], 
+            w,
+            np.linspace(w_max, 2e4, n_above)[1:]]) 
+        # the padded spectra are zero, so only the columns of w are needed
+        return super(iSpeculator, self)._build_photo_projection(w_pad, filters,
+                window=slice(n_below-1, n_below-1+len(w)))
+
+    def _interp_batch(self, wavelength, w, spec): 
+        ''' linearly interpolate N x Nwave array of spectra to the specified
+        wavelengths. Equivalent to np.interp(wavelength, w, spec[i], left=0,
+        right=0) for each spectrum, but the interpolation weights are computed
+        once for all N spectra. 
+        '''
+        i_up = np.clip(np.searchsorted(w, wavelength, side='right'), 1, len(w)-1)
+        f_up = (wavelength - w[i_up-1]) / (w[i_up] - w[i_up-1])
+
+        outspec = spec[:,i_up-1] * (1. - f_up) + spec[:,i_up] * f_up 
+        outspec[:,(wavelength < w[0]) | (wavelength > w[-1])] = 0. 
+        return outspec
+
+    def _lnPost_spectrophoto_batch(self, tt_arr, wave_obs, flux_obs,
+            flux_ivar_obs, photo_obs, photo_ivar_obs, zred, mask=None,
+            filters=None, bands=None, prior=None, grad=False): 
+        ''' calculate the log posterior for an N x Ntheta array of free
+        parameters (e.g. all the MCMC walkers). See `_lnPost_spectrophoto` for
+        details. If grad, the N x Ntheta array of derivatives of the log
+        posterior is also returned. 
+        '''
+        tt_arr = np.atleast_2d(tt_arr) 
+        lp = self._lnPrior_batch(tt_arr, prior=prior) # log prior
+        dlp = np.zeros(tt_arr.shape) 
+        inprior = np.isfinite(lp) 
+        if np.any(inprior): 
+            chi_tot = self._Chi2_spectrophoto_batch(
+                    tt_arr[inprior,:-1], wave_obs, flux_obs, flux_ivar_obs,
+                    photo_obs, photo_ivar_obs, zred, mask=mask,
+                    f_fiber=tt_arr[inprior,-1], filters=filters, bands=bands,
+                    grad=grad) 
+            if grad: 
+                chi_tot, dchi_tot = chi_tot
+                dlp[inprior] = -0.5 * dchi_tot
+            lp[inprior] -= 0.5 * chi_tot
+        if grad: return lp, dlp 
+        return lp 
+
+    def _Chi2_spectrophoto_batch(self, tt_arr, wave_obs, flux_obs,
+            flux_ivar_obs, photo_obs, photo_ivar_obs, zred, mask=None,
+            f_fiber=1., filters=None, bands=None, grad=False): 
+        ''' calculated the chi-squared between the data and model spectra and
+        photometry for an N x Ntheta array of parameters. The model spectra are
+        only interpolated onto the unmasked wavelengths. If grad, the N x
+        (Ntheta + 1) array of derivatives of the chi-squared with respect to
+        [tt_arr, f_fiber] is also returned. 
+        '''
+        # model(theta) 
+        out = self._model_spectrophoto_batch(tt_arr, zred=zred,
+                wavelength=wave_obs[~mask], filters=filters, bands=bands, grad=grad) 
+        flux, photo = out[0], out[1]
+        f_fiber = np.atleast_1d(f_fiber)[:,None]
+        # data - model(theta) with masking 
+        dflux = (f_fiber * flux - flux_obs[~mask]) 
+        # calculate chi-squared for spectra
+        _chi2_spec = np.sum(dflux**2 * flux_ivar_obs[~mask], axis=1) 
+        # data - model(theta) for photometry  
+        dphoto = (photo - photo_obs) 
+        # calculate chi-squared for photometry 
+        _chi2_photo = np.sum(dphoto**2 * photo_ivar_obs, axis=1) 
+        
+        if not grad: 
+            return _chi2_spec + _chi2_photo 
+
+        # d chi2 / d tt_arr and d chi2 / d f_fiber
+        ddflux = 2. * dflux * flux_ivar_obs[~mask]
+        dchi2 = np.concatenate([
+            np.einsum('nw,ntw->nt', f_fiber * ddflux, out[2]) + 
+            np.einsum('nb,ntb->nt', 2. * dphoto * photo_ivar_obs, out[3]), 
+            np.sum(ddflux * flux, axis=1)[:,None]], axis=1)
+        return _chi2_spec + _chi2_photo, dchi2
+
+    def _lnPost_batch(self, tt_arr, wave_obs, flux_obs, flux_ivar_obs, zred,
+            mask=None, prior=None, grad=False): 
+        ''' calculate the log posterior for an N x Ntheta array of free
+        parameters. See `_lnPost` for details. If grad, the N x Ntheta array of
+        derivatives of the log posterior is also returned. 
+        '''
+        tt_arr = np.atleast_2d(tt_arr) 
+        lp = self._lnPrior_batch(tt_arr, prior=prior) # log prior
+        dlp = np.zeros(tt_arr.shape) 
+        inprior = np.isfinite(lp) 
+        if np.any(inprior): 
+            chi_tot = self._Chi2_batch(tt_arr[inprior], wave_obs, flux_obs,
+                    flux_ivar_obs, zred, mask=mask, grad=grad) 
+            if grad: 
+                chi_tot, dchi_tot = chi_tot
+                dlp[inprior] = -0.5 * dchi_tot
+            lp[inprior] -= 0.5 * chi_tot
+        if grad: return lp, dlp 
+        return lp 
+
+    def _Chi2_batch(self, tt_arr, wave_obs, flux_obs, flux_ivar_obs, zred,
+            mask=None, f_fiber=1., grad=False): 
+        ''' calculated the chi-squared between the data and model spectra for
+        an N x Ntheta array of parameters. If grad, the N x Ntheta array of
+        derivatives of the chi-squared is also returned. 
+        '''
+        # model(theta) 
+        out = self.model_batch(tt_arr, zred=zred, wavelength=wave_obs[~mask], grad=grad) 
+        f_fiber = np.atleast_1d(f_fiber)[:,None]
+        # data - model(theta) with masking 
+        dflux = (f_fiber * out[1] - flux_obs[~mask]) 
+        # calculate chi-squared
+        _chi2 = np.sum(dflux**2 * flux_ivar_obs[~mask], axis=1) 
+        if not grad: 
+            return _chi2
+        return _chi2, np.einsum('nw,ntw->nt', 2. * f_fiber * dflux * flux_ivar_obs[~mask], out[2]) 
+
+    def _lnPost_spec_batch(self, *args, **kwargs): 
+        return self._lnPost_batch(*args, **kwargs)
+
+    def _lnPost_photo_batch(self, tt_arr, flux_obs, flux_ivar_obs, zred,
+            filters=None, bands=None, prior=None, grad=False, photo_emulator=False): 
+        ''' calculate the log posterior for photometry for an N x Ntheta array
+        of free parameters. See `_lnPost_photo` for details. If grad, the N x
+        Ntheta array of derivatives of the log posterior is also returned. 
+        '''
+        tt_arr = np.atleast_2d(tt_arr) 
+        lp = self._lnPrior_batch(tt_arr, prior=prior) # log prior
+        dlp = np.zeros(tt_arr.shape) 
+        inprior = np.isfinite(lp) 
+        if np.any(inprior): 
+            chi_tot = self._Chi2_photo_batch(tt_arr[inprior], flux_obs,
+                    flux_ivar_obs, zred, filters=filters, bands=bands, grad=grad, 
+                    photo_emulator=photo_emulator) 
+            if grad: 
+                chi_tot, dchi_tot = chi_tot
+                dlp[inprior] = -0.5 * dchi_tot
+            lp[inprior] -= 0.5 * chi_tot
+        if grad: return lp, dlp 
+        return lp 
+
+    def _Chi2_photo_batch(self, tt_arr, flux_obs, flux_ivar_obs, zred,
+            filters=None, bands=None, grad=False, photo_emulator=False): 
+        ''' calculated the chi-squared between the data and model photometry
+        for an N x Ntheta array of parameters. If grad, the N x Ntheta array of
+        derivatives of the chi-squared is also returned. 
+        '''
+        # model(theta) 
+        out = self.model_photo_batch(tt_arr, zred=zred, filters=filters, bands=bands, grad=grad, 
+                photo_emulator=photo_emulator) 
+        if not grad: 
+            out = (out,) 
+        # data - model(theta) 
+        dflux = (out[0] - flux_obs) 
+        # calculate chi-squared
+        _chi2 = np.sum(dflux**2 * flux_ivar_obs, axis=1) 
+        if not grad: 
+            return _chi2
+        return _chi2, np.einsum('nb,ntb->nt', 2. * dflux * flux_ivar_obs, out[1]) 
+
+    def _Chi2_spectrophoto(self, tt_arr, wave_obs, flux_obs, flux_ivar_obs, photo_obs,
+            photo_ivar_obs, zred, mask=None, f_fiber=1., filters=None,
+            bands=None, grad=False): 
+        ''' calculated the chi-squared between the data and model spectra. If
+        grad, the derivatives of the chi-squared with respect to [tt_arr,
+        f_fiber] are also returned. 
+        '''
+        if mask is None: mask = np.zeros(len(wave_obs)).astype(bool) 
+        out = self._Chi2_spectrophoto_batch(np.atleast_2d(tt_arr), wave_obs,
+                flux_obs, flux_ivar_obs, photo_obs, photo_ivar_obs, zred,
+                mask=mask, f_fiber=f_fiber, filters=filters, bands=bands, grad=grad)
+        if grad: return out[0][0], out[1][0]
+        return out[0] 
+
+    def _Chi2(self, tt_arr, wave_obs, flux_obs, flux_ivar_obs, zred, mask=None, f_fiber=1., grad=False): 
+        ''' calculated the chi-squared between the data and model spectra. If
+        grad, the derivatives of the chi-squared with respect to tt_arr are also
+        returned. 
+        '''
+        if mask is None: mask = np.zeros(len(wave_obs)).astype(bool) 
+        out = self._Chi2_batch(np.atleast_2d(tt_arr), wave_obs, flux_obs,
+                flux_ivar_obs, zred, mask=mask, f_fiber=f_fiber, grad=grad) 
+        if grad: return out[0][0], out[1][0]
+        return out[0] 
+
+    def _Chi2_photo(self, tt_arr, flux_obs, flux_ivar_obs, zred, filters=None, bands=None, 
+            native_mags=False, grad=False): 
+        ''' calculated the chi-squared between the data and model photometry.
+        If grad, the derivatives of the chi-squared with respect to tt_arr are
+        also returned. Native FSPS photometry is not supported. 
+        '''
+        if native_mags: raise NotImplementedError("native FSPS photometry is not supported by iSpeculator") 
+        out = self._Chi2_photo_batch(np.atleast_2d(tt_arr), flux_obs,
+                flux_ivar_obs, zred, filters=filters, bands=bands, grad=grad) 
+        if grad: return out[0][0], out[1][0]
+        return out[0] 
    
     def get_SFR(self, tt, zred, dt=1.):
         ''' given theta calculate SFR averaged over dt Gyr. 
@@ -1785,17 +4081,14 @@ class iSpeculator(iFSPS):
            [log M*, b1SFH, b2SFH, b3SFH, b4SFH, g1ZH, g2ZH, tau]  b's here are the original
            SFH basis coefficients
         '''
-        tage = self.cosmo.age(zred).value # age in Gyr
+        tage = Cosmo.age(self.cosmo, zred) # age in Gyr
         assert tage > dt 
-        t = np.linspace(0, tage, 50)
+        t, sfh_basis, _, _ = self._nmf_table(tage)
 
         tt_sfh = tt[1:5] # sfh bases 
         
         # caluclate normalized SFH
-        sfh = np.sum(np.array([
-            tt_sfh[i]*self._sfh_basis[i](t)/np.trapz(self._sfh_basis[i](t), t) 
-            for i in range(4)]), 
-            axis=0)
+        sfh = np.dot(tt_sfh, sfh_basis) 
         
         # add up the stellar mass formed during the dt time period 
         i_low = np.clip(np.abs(t - (tage - dt)).argmin(), None, 48) 
@@ -1807,20 +4100,16 @@ class iSpeculator(iFSPS):
         ''' given theta calculate mass weighted metallicity using the ZH NMF
         bases. 
         '''
-        tage = self.cosmo.age(zred).value # age in Gyr
-        t = np.linspace(0, tage, 50)
+        tage = Cosmo.age(self.cosmo, zred) # age in Gyr
+        t, sfh_basis, zh_basis, _ = self._nmf_table(tage)
 
         tt_sfh = tt[1:5] # sfh bases 
         tt_zh = tt[5:7] # zh bases 
         
         # caluclate normalized SFH
-        sfh = np.sum(np.array([
-            tt_sfh[i]*self._sfh_basis[i](t)/np.trapz(self._sfh_basis[i](t), t) 
-            for i in range(4)]), axis=0)
+        sfh = np.dot(tt_sfh, sfh_basis) 
 
-        zh = np.sum(np.array([
-            tt_zh[i] * self._zh_basis[i](t) 
-            for i in range(2)]), axis=0)
+        zh = np.dot(tt_zh, zh_basis) 
         
         # mass weighted average
         z_mw = np.trapz(zh * sfh, t) / np.trapz(sfh, t)
@@ -1834,45 +4123,451 @@ class iSpeculator(iFSPS):
         :return flux: 
             FSPS SSP flux in units of Lsun/A
         '''
+        return self._emulator_batch(np.atleast_2d(tt))[0]
+
+    def _emulator_batch(self, tt, view=None, grad=False):
+        ''' batched emulator for FSPS. The forward pass is evaluated for all N
+        parameters at once (one matrix-matrix product per layer) using
+        preallocated work buffers, rather than N separate forward passes.
+
+        :param tt:
+            N x 8 array [b1SFH, b2SFH, b3SFH, b4SFH, g1ZH, g2ZH, tau, tage]
+        :param view: (default: None) 
+            emulator view from `_emulator_view`. If specified, the SED is only
+            decoded over the wavelength window of the view. 
+        :param grad: (default: False) 
+            If True, also return the Jacobian of the flux with respect to
+            [b1SFH, b2SFH, b3SFH, b4SFH, g1ZH, g2ZH, tau]. The Jacobian is
+            propagated exactly through the network in forward mode. 
+        :return flux:
+            N x Nwave array of FSPS SSP flux in units of Lsun/A
+        :return dflux: 
+            (if grad) N x 7 x Nwave array of the derivatives of flux 
+        '''
+        tt = np.atleast_2d(tt)
+        act, layers = self._emulator_buffers(tt.shape[0])
+
+        if grad: 
+            # derivatives of the (transformed and normalized) input layer with
+            # respect to the first 7 parameters. tage is fixed by the redshift
+            ngrad = 7
+            dlayer = np.zeros((tt.shape[0], ngrad, tt.shape[1]))
+            dlayer[:,np.arange(ngrad),np.arange(ngrad)] = \
+                    self._transform_theta_jacobian(tt)[:,:ngrad] / self._emu_theta_std[:ngrad]
+
         # forward pass through the network
-        act = []
-        offset = np.log(np.sum(tt[0:4]))
-        layers = [(self._transform_theta(tt) - self._emu_theta_mean)/self._emu_theta_std]
+        offset = np.log(np.sum(tt[:,0:4], axis=1))
+        np.subtract(self._transform_theta(tt), self._emu_theta_mean, out=layers[0])
+        layers[0] /= self._emu_theta_std
         for i in range(self._emu_n_layers-1):
-        
+
             # linear network operation
-            act.append(np.dot(layers[-1], self._emu_W[i]) + self._emu_b[i])
+            np.dot(layers[i], self._emu_W[i], out=act[i])
+            act[i] += self._emu_b[i]
 
             # pass through activation function
-            layers.append((self._emu_beta[i] + (1.-self._emu_beta[i])*1./(1.+np.exp(-self._emu_alpha[i]*act[-1])))*act[-1])
+            # (beta + (1 - beta) / (1 + exp(-alpha * act))) * act
+            np.multiply(act[i], -self._emu_alpha[i], out=layers[i+1])
+            np.exp(layers[i+1], out=layers[i+1])
+            layers[i+1] += 1.
+            np.reciprocal(layers[i+1], out=layers[i+1])
+            layers[i+1] *= (1. - self._emu_beta[i])
+            layers[i+1] += self._emu_beta[i]
+            layers[i+1] *= act[i]
+
+            if grad: 
+                # derivative of the activation function 
+                # beta + (1 - beta) * sig + (1 - beta) * sig * (1 - sig) * alpha * act
+                sig = 1. / (1. + np.exp(-self._emu_alpha[i] * act[i]))
+                dact = self._emu_beta[i] + (1. - self._emu_beta[i]) * sig * (
+                        1. + (1. - sig) * self._emu_alpha[i] * act[i])
+                dlayer = np.matmul(dlayer, self._emu_W[i]) * dact[:,None,:]
 
         # final (linear) layer -> (normalized) PCA coefficients
-        layers.append(np.dot(layers[-1], self._emu_W[-1]) + self._emu_b[-1])
+        pca_coeffs = np.dot(layers[-1], self._emu_W[-1]) + self._emu_b[-1]
+
+        if view is None: 
+            pcas, spec_mean, spec_std = self._emu_pcas, self._emu_spec_mean, self._emu_spec_std
+        else: 
+            pcas, spec_mean, spec_std = view['pcas'], view['spec_mean'], view['spec_std']
 
         # rescale PCA coefficients, multiply out PCA basis -> normalized spectrum, shift and re-scale spectrum -> output spectrum
-        logflux = np.dot(layers[-1]*self._emu_pca_std + self._emu_pca_mean, self._emu_pcas)*self._emu_spec_std + self._emu_spec_mean + offset
-        flux = np.exp(logflux)
-        
+        logflux = np.dot(pca_coeffs*self._emu_pca_std + self._emu_pca_mean, pcas)
+        logflux *= spec_std
+        logflux += spec_mean
+        logflux += offset[:,None]
+        flux = np.exp(logflux, out=logflux)
+
         # normalization for the SSP SED because the SED is not normalized by
         # the integral of the SFH. This normalization should be incorporated
         # into the training set of Speculator rather than here, but for now
         # hacked together. 
-        _t = np.linspace(0, tt[7], 50)
-        norm_sfh = np.sum([tt[:4][i] * 
-            self._sfh_basis[i](_t)/np.trapz(self._sfh_basis[i](_t), _t) for i
-            in range(4)])
-        flux /= norm_sfh
-        return flux 
-    
+        norm_sfh = np.zeros(tt.shape[0])
+        dnorm_sfh = np.zeros((tt.shape[0], 4))
+        for tage in np.unique(tt[:,7]):
+            is_tage = (tt[:,7] == tage)
+            dnorm_sfh[is_tage] = self._nmf_table(tage)[3]
+            norm_sfh[is_tage] = np.dot(tt[is_tage,0:4], self._nmf_table(tage)[3])
+        flux /= norm_sfh[:,None]
+        if not grad: 
+            return flux
+
+        # d log(flux) = d logflux + d offset - d log(norm_sfh)
+        dlogflux = np.matmul(np.matmul(dlayer, self._emu_W[-1]) * self._emu_pca_std, pcas)
+        dlogflux *= spec_std
+        dlogflux[:,:4,:] += (1./np.sum(tt[:,0:4], axis=1)[:,None] - dnorm_sfh / norm_sfh[:,None])[:,:,None]
+        return flux, dlogflux * flux[:,None,:]
+
+    def _emulator_buffers(self, n):
+        ''' work buffers for the forward pass of N parameters through the
+        network. Buffers are allocated once for each N and reused. They are
+        local to each thread (see `_FitterThreadPool`), so they are freed along
+        with the threads of the pool.
+
+        :param n:
+            number of parameters in the batch
+        :return act, layers:
+            lists of N x Nnode arrays for the linear output and the activated
+            output of each layer. layers[0] is the input layer.
+        '''
+        if not hasattr(self._emu_buffers, 'buffers'): 
+            self._emu_buffers.buffers = {} 
+        buffers = self._emu_buffers.buffers 
+        if n not in buffers:
+            act = [np.empty((n, self._emu_W[i].shape[1]))
+                    for i in range(self._emu_n_layers-1)]
+            layers = [np.empty((n, self._emu_W[i].shape[0]))
+                    for i in range(self._emu_n_layers)]
+            buffers[n] = (act, layers)
+        return buffers[n]
+
+    def _emulator_view(self, zred, wavelength): 
+        ''' emulator view for a fixed redshift and observed wavelength grid.
+        The PCA basis is restricted to the rest-frame wavelengths that are
+        required to interpolate onto the observed wavelengths and the linear
+        interpolation is precomputed as a sparse Nwave_obs x Nwindow matrix.
+        The most recent view is cached, since zred and wave_obs are fixed
+        throughout the fit of a galaxy. 
+
+        :param zred: 
+            redshift 
+        :param wavelength: 
+            observed-frame wavelengths 
+        :return view: 
+            dictionary with the restricted PCA basis ('pcas'), spectrum mean
+            and std ('spec_mean', 'spec_std') and the interpolation matrix
+            ('interp'). np.interp(wavelength, w_z, flux_z, left=0, right=0) ==
+            view['interp'].dot(flux_z[view['window']])
+        '''
+        view = self._emu_view 
+        if (view is not None and view['zred'] == zred and 
+                np.array_equal(view['wavelength'], wavelength)): 
+            return view 
+
+        w_z = self._emu_wave * (1. + zred)
+
+        # linear interpolation weights 
+        i_up = np.clip(np.searchsorted(w_z, wavelength, side='right'), 1, len(w_z)-1)
+        f_up = (wavelength - w_z[i_up-1]) / (w_z[i_up] - w_z[i_up-1])
+        inwave = np.arange(len(wavelength))[(wavelength >= w_z[0]) & (wavelength <= w_z[-1])] 
+        
+        # rest-frame wavelength window that the observed wavelengths need
+        if len(inwave) > 0: 
+            i_min, i_max = i_up[inwave].min() - 1, i_up[inwave].max() + 1 
+        else: 
+            i_min, i_max = 0, 1
+        window = slice(i_min, i_max) 
+        
+        interp = Sparse.csr_matrix((
+            np.concatenate([1. - f_up[inwave], f_up[inwave]]), 
+            (np.concatenate([inwave, inwave]), 
+                np.concatenate([i_up[inwave] - 1, i_up[inwave]]) - i_min)), 
+            shape=(len(wavelength), i_max - i_min))
+
+        self._emu_view = {
+                'zred': zred, 
+                'wavelength': np.array(wavelength, copy=True), 
+                'window': window, 
+                'pcas': np.ascontiguousarray(self._emu_pcas[:,window]), 
+                'spec_mean': self._emu_spec_mean[window], 
+                'spec_std': self._emu_spec_std[window], 
+                'interp': interp
+                }
+        return self._emu_view 
+
+    def train_photo_emulator(self, fphoto, bands='desi', zmin=0.01, zmax=0.6, prior=None, 
+            ntrain=50000, nz=50, nhidden=[64, 64], nepoch=600, nbatch=256,
+            learning_rate=1e-3, seed=0, silent=True): 
+        ''' train a small neural network that maps theta and redshift directly 
+        to photometry on the outputs of the spectral emulator over the prior 
+        and redshift range. The network has tanh hidden layers and is trained
+        with Adam on the standardized log photometry per unit stellar mass 
+        with the luminosity distance scaling divided out. The weights are 
+        written to an hdf5 file and loaded.
+
+        :param fphoto: 
+            hdf5 file name of the photometry emulator 
+
+        :param bands: (default: 'desi') 
+            photometric bands of the emulator 
+
+        :param zmin, zmax: (default: 0.01, 0.6) 
+            redshift range of the training set 
+
+        :param prior: (default: None) 
+            UniformPrior object that specifies the parameter range of the 
+            training set. If None, the default prior is used. 
+
+        :param ntrain: (default: 50000) 
+            size of the training set (10% is held out for validation) 
+
+        :param nz: (default: 50) 
+            number of redshifts in the training set. The filter projection is
+            computed for each redshift, so this sets the cost of constructing
+            the training set. 
+
+        :param nhidden: (default: [64, 64]) 
+            number of units in each hidden layer 
+
+        :param nepoch, nbatch, learning_rate: (default: 600, 256, 1e-3) 
+            number of epochs, batch size and initial learning rate of Adam. The
+            learning rate decays to 1% of learning_rate by the last epoch. 
+
+        :return frac_err: 
+            fractional errors of the emulator photometry for the validation set
+        '''
+        if self.model_name != 'emulator': 
+            raise ValueError("photometry emulator is trained on the spectral emulator") 
+        if prior is None: prior = self._default_prior() 
+        bands_list = self._get_bands(bands)
+        filters = specFilter.load_filters(*tuple(bands_list))
+        rng = np.random.RandomState(seed)
+
+        # training set: photometry per unit stellar mass 
+        xx, yy = [], []
+        for _zred in rng.uniform(zmin, zmax, nz): 
+            zz = prior.min + (prior.max - prior.min) * rng.uniform(size=(ntrain // nz, prior.ndim))
+            zz[:,0] = 0. 
+            photo = self.model_photo_batch(zz, zred=_zred, filters=filters) 
+
+            xx.append(self._photo_emulator_input(zz, _zred)[0]) 
+            yy.append(np.log10(np.clip(photo, 1e-300, None)) - self._photo_emulator_offset(_zred)) 
+        xx = np.concatenate(xx) 
+        yy = np.concatenate(yy) 
+        nvalid = len(xx) // 10 
+
+        emu = {} 
+        emu['bands'] = list(filters.names) 
+        emu['zmin'], emu['zmax'] = zmin, zmax 
+        emu['x_mean'], emu['x_std'] = xx[nvalid:].mean(axis=0), xx[nvalid:].std(axis=0)
+        emu['y_mean'], emu['y_std'] = yy[nvalid:].mean(axis=0), yy[nvalid:].std(axis=0)
+        xs = (xx[nvalid:] - emu['x_mean']) / emu['x_std'] 
+        ys = (yy[nvalid:] - emu['y_mean']) / emu['y_std'] 
+
+        # Adam 
+        sizes = [xx.shape[1]] + list(nhidden) + [yy.shape[1]]
+        emu['W'] = [rng.normal(size=(n_in, n_out)) / np.sqrt(n_in) 
+                for n_in, n_out in zip(sizes[:-1], sizes[1:])]
+        emu['b'] = [np.zeros(n_out) for n_out in sizes[1:]]
+        params = emu['W'] + emu['b'] 
+        m1 = [np.zeros(_p.shape) for _p in params] 
+        m2 = [np.zeros(_p.shape) for _p in params] 
+        i_step = 0 
+        for i_epoch in range(nepoch): 
+            lr = learning_rate * 0.01**(float(i_epoch) / nepoch) 
+            perm = rng.permutation(len(xs)) 
+            for i_b in range(0, len(xs), nbatch): 
+                grads = self._photo_mlp_backprop(emu, xs[perm[i_b:i_b+nbatch]], ys[perm[i_b:i_b+nbatch]])
+                i_step += 1 
+                for _p, _g, _m1, _m2 in zip(params, grads, m1, m2): 
+                    _m1 *= 0.9 
+                    _m1 += 0.1 * _g 
+                    _m2 *= 0.999 
+                    _m2 += 0.001 * _g**2 
+                    _p -= lr * (_m1 / (1. - 0.9**i_step)) / (np.sqrt(_m2 / (1. - 0.999**i_step)) + 1e-8)
+
+            if not silent and (i_epoch % 50 == 0 or i_epoch == nepoch - 1): 
+                yv = self._photo_mlp(emu, xx[:nvalid]) 
+                print('epoch %i: validation rms fractional error = %.2e' % 
+                        (i_epoch, np.sqrt(np.mean((10**(yv - yy[:nvalid]) - 1.)**2))))
+
+        # write out emulator 
+        fh5 = h5py.File(fphoto, 'w') 
+        fh5.attrs['bands'] = np.array(emu['bands'], dtype='S') 
+        fh5.attrs['zmin'] = zmin 
+        fh5.attrs['zmax'] = zmax 
+        fh5.attrs['nlayer'] = len(emu['W']) 
+        for k in ['x_mean', 'x_std', 'y_mean', 'y_std']: 
+            fh5.create_dataset(k, data=emu[k]) 
+        for i in range(len(emu['W'])): 
+            fh5.create_dataset('W%i' % i, data=emu['W'][i]) 
+            fh5.create_dataset('b%i' % i, data=emu['b'][i]) 
+        fh5.close() 
+        self.load_photo_emulator(fphoto) 
+        
+        return 10**(self._photo_mlp(self._photo_emu, xx[:nvalid]) - yy[:nvalid]) - 1.
+
+    def load_photo_emulator(self, fphoto): 
+        ''' load photometry emulator constructed by `train_photo_emulator`
+
+        :param fphoto: 
+            hdf5 file of the photometry emulator 
+        '''
+        fh5 = h5py.File(fphoto, 'r') 
+        emu = {} 
+        emu['bands'] = [_b.decode() if isinstance(_b, bytes) else str(_b) for _b in fh5.attrs['bands']]
+        emu['zmin'] = float(fh5.attrs['zmin']) 
+        emu['zmax'] = float(fh5.attrs['zmax']) 
+        for k in ['x_mean', 'x_std', 'y_mean', 'y_std']: 
+            emu[k] = fh5[k][...]
+        emu['W'] = [fh5['W%i' % i][...] for i in range(fh5.attrs['nlayer'])]
+        emu['b'] = [fh5['b%i' % i][...] for i in range(fh5.attrs['nlayer'])]
+        fh5.close() 
+
+        self._photo_emu = emu 
+        self._photo_emu_checked = {} 
+        self._config['photo_emulator'] = fphoto 
+        return None 
+
+    def _photo_emulator_batch(self, zz_arr, zred, filters, dont_transform=False, grad=False): 
+        ''' photometry in nanomaggies from the photometry emulator for an N x
+        Ntheta array of parameters. If grad, the N x Ntheta x Nband array of
+        derivatives is also returned. 
+        '''
+        if self.model_name != 'emulator': 
+            raise ValueError("the photometry emulator is trained on the spectral emulator; model_name must be 'emulator'") 
+        emu = self._photo_emu 
+        if emu is None: 
+            raise ValueError("no photometry emulator; see iSpeculator.train_photo_emulator") 
+        if list(filters.names) != emu['bands']: 
+            raise ValueError("photometry emulator is for %s" % ', '.join(emu['bands'])) 
+
+        zz_arr = np.atleast_2d(zz_arr) 
+        nbatch, ntheta = zz_arr.shape 
+
+        xx, tt = self._photo_emulator_input(zz_arr, zred, dont_transform=dont_transform) 
+        offset = zz_arr[:,0][:,None] + self._photo_emulator_offset(zred) 
+        if not grad: 
+            return 10**(offset + self._photo_mlp(emu, xx)) 
+        
+        log_photo, dlog_photo = self._photo_mlp(emu, xx, grad=True) 
+        photo = 10**(offset + log_photo) 
+        # d log_photo / d (b1SFH...b4SFH, g1ZH, g2ZH, tau) 
+        dlog_photo = dlog_photo[:,:7,:] * self._transform_theta_jacobian(tt)[:,:,None]
+
+        dphoto = np.zeros((nbatch, ntheta, photo.shape[1])) 
+        dphoto[:,0,:] = 1. 
+        if dont_transform: 
+            dphoto[:,1:5,:] = dlog_photo[:,:4,:]
+        else: 
+            dphoto[:,1:5,:] = np.einsum('nij,nib->njb', 
+                    self._transform_to_SFH_basis_jacobian(zz_arr[:,1:5]), dlog_photo[:,:4,:])
+        dphoto[:,5:8,:] = dlog_photo[:,4:7,:]
+        dphoto *= np.log(10.) * photo[:,None,:]
+        return photo, dphoto 
+
+    def _photo_emulator_input(self, zz_arr, zred, dont_transform=False): 
+        ''' input of the photometry emulator network, [sqrt(b1SFH), b2SFH,
+        sqrt(b3SFH), b4SFH, g1ZH, g2ZH, tau, zred] (see `_transform_theta`),
+        and the N x 7 array of parameters [b1SFH, b2SFH, b3SFH, b4SFH, g1ZH,
+        g2ZH, tau]
+        '''
+        tt = zz_arr[:,1:8].copy() 
+        if not dont_transform: 
+            tt[:,:4] = self._transform_to_SFH_basis(zz_arr[:,1:5]) 
+
+        xx = np.zeros((len(tt), 8)) 
+        xx[:,:7] = self._transform_theta(tt) 
+        xx[:,7] = zred 
+        return xx, tt 
+
+    def _photo_emulator_offset(self, zred): 
+        ''' log10 of the luminosity distance scaling of the photometry, which
+        is divided out of the photometry emulator 
+        '''
+        d_lum = Cosmo.luminosity_distance(self.cosmo, zred) 
+        return -2. * np.log10(d_lum / (10. * UT.parsec())) - np.log10(1. + zred)
+
+    def _photo_emulator_check(self, filters, zred, prior, nsample=100, tol=0.01, silent=True): 
+        ''' check the photometry emulator against the spectral emulator
+        photometry for nsample draws from the prior at zred. 
+
+        :return accurate: 
+            True if the rms fractional error of the bands is within tol 
+        '''
+        key = (tuple(filters.names), float(zred)) 
+        if self._photo_emu is None: 
+            print('no photometry emulator; using the spectral emulator') 
+            return False 
+        if list(filters.names) != self._photo_emu['bands'] or \
+                not (self._photo_emu['zmin'] <= zred <= self._photo_emu['zmax']): 
+            print('photometry emulator does not cover the bands or redshift; using the spectral emulator') 
+            return False 
+        if key in self._photo_emu_checked: return self._photo_emu_checked[key] 
+
+        rng = np.random.RandomState(0) 
+        zz = prior.min + (prior.max - prior.min) * rng.uniform(size=(nsample, prior.ndim))
+        photo = self.model_photo_batch(zz, zred=zred, filters=filters) 
+        photo_emu = self.model_photo_batch(zz, zred=zred, filters=filters, photo_emulator=True) 
+        frac_err = photo_emu / photo - 1. 
+        rms_err = np.sqrt(np.mean(frac_err**2)) 
+
+        self._photo_emu_checked[key] = (rms_err < tol) 
+        msg = 'photometry emulator rms (max) fractional error = %.2e (%.2e)' % (rms_err, np.abs(frac_err).max())
+        if not self._photo_emu_checked[key]: 
+            print(msg + '; using the spectral emulator') 
+        elif not silent: 
+            print(msg) 
+        return self._photo_emu_checked[key] 
+
+    def _photo_mlp(self, emu, xx, grad=False): 
+        ''' forward pass of the photometry emulator network. If grad, also
+        returns the N x Ninput x Noutput Jacobian. 
+        '''
+        hh = (xx - emu['x_mean']) / emu['x_std'] 
+        if grad: jac = np.diag(1. / emu['x_std']) 
+        for W, b in zip(emu['W'][:-1], emu['b'][:-1]): 
+            hh = np.tanh(np.dot(hh, W) + b) 
+            if grad: jac = np.dot(jac, W) * (1. - hh**2)[:,None,:]
+        yy = (np.dot(hh, emu['W'][-1]) + emu['b'][-1]) * emu['y_std'] + emu['y_mean']
+        if grad: return yy, np.dot(jac, emu['W'][-1]) * emu['y_std']
+        return yy 
+
+    def _photo_mlp_backprop(self, emu, xs, ys): 
+        ''' gradients of the mean squared error of the photometry emulator
+        network with respect to the weights and biases for standardized inputs 
+        xs and outputs ys 
+        '''
+        hs = [xs] 
+        for W, b in zip(emu['W'][:-1], emu['b'][:-1]): 
+            hs.append(np.tanh(np.dot(hs[-1], W) + b)) 
+        delta = 2. * (np.dot(hs[-1], emu['W'][-1]) + emu['b'][-1] - ys) / ys.size 
+
+        gW, gb = [], [] 
+        for i in range(len(emu['W']) - 1, -1, -1): 
+            gW.insert(0, np.dot(hs[i].T, delta)) 
+            gb.insert(0, delta.sum(axis=0)) 
+            if i > 0: delta = np.dot(delta, emu['W'][i].T) * (1. - hs[i]**2)
+        return gW + gb 
+
     def _transform_theta(self, theta):
         ''' initial transform applied to input parameters (network is trained over a 
         transformed parameter set)
         '''
         transformed_theta = np.copy(theta)
-        transformed_theta[0] = np.sqrt(theta[0])
-        transformed_theta[2] = np.sqrt(theta[2])
+        transformed_theta[...,0] = np.sqrt(theta[...,0])
+        transformed_theta[...,2] = np.sqrt(theta[...,2])
         return transformed_theta
 
+    def _transform_theta_jacobian(self, theta): 
+        ''' derivative of `_transform_theta` with respect to each parameter
+        (the transform is element-wise) 
+        '''
+        dtransformed_theta = np.ones(theta.shape) 
+        dtransformed_theta[...,0] = 0.5 / np.sqrt(theta[...,0])
+        dtransformed_theta[...,2] = 0.5 / np.sqrt(theta[...,2])
+        return dtransformed_theta
+
     def _fsps_model(self, tt): 
         ''' same model as emulator but using fsps 
 
@@ -1892,19 +4587,18 @@ class iSpeculator(iFSPS):
             tt_dust_index = tt[8]
             tage        = tt[9] 
 
-        _t = np.linspace(0, tage, 50)
+        _t, sfh_basis, zh_basis, _ = self._nmf_table(tage)
         tages   = max(_t) - _t + 1e-8 
 
         # Compute SFH and ZH
-        sfh = np.sum(np.array([
-            tt_sfh[i] *
-            self._sfh_basis[i](_t)/np.trapz(self._sfh_basis[i](_t), _t) 
-            for i in range(4)]), 
-            axis=0)
-        zh = np.sum(np.array([
-            tt_zh[i] * self._zh_basis[i](_t) 
-            for i in range(2)]), 
-            axis=0)
+        sfh = np.dot(tt_sfh, sfh_basis) 
+        zh = np.dot(tt_zh, zh_basis) 
+
+        if self._ssp_grid is not None: 
+            if self.model_name == 'fsps': 
+                return self._ssp_grid_model(tages, sfh, zh, tt_dust) 
+            return self._ssp_grid_model(tages, sfh, zh, tt_dust2, dust1=tt_dust1, 
+                    dust_index=tt_dust_index) 
         
         for i, tage, m, z in zip(range(len(tages)), tages, sfh, zh): 
             if m <= 0: # no star formation in this bin 
@@ -1924,6 +4618,99 @@ class iSpeculator(iFSPS):
 
         lum_ssp /= np.sum(sfh)
         return wave_rest, lum_ssp
+
+    def _ssp_grid_initiate(self): 
+        ''' tabulate dust-free FSPS SSP spectra at the FSPS metallicities and 
+        ages. With sfh=0 and tage=0, FSPS returns the SSPs at all ages, so this
+        only requires one FSPS call per metallicity. 
+        '''
+        self._ssp.params['dust1'] = 0. 
+        self._ssp.params['dust2'] = 0. 
+
+        logzsol = np.log10(self._ssp.zlegend / 0.0190) # log(Z/Zsun) 
+        ssp_lum = [] 
+        for _logzsol in logzsol: 
+            self._ssp.params['logzsol'] = _logzsol 
+            wave_rest, _ssp_lum = self._ssp.get_spectrum(tage=0., peraa=True) # nage x nwave 
+            ssp_lum.append(_ssp_lum) 
+        ssp_lum = np.array(ssp_lum) 
+        nz, nage, nwave = ssp_lum.shape
+
+        self._ssp_grid = {
+                'logzsol': logzsol, 
+                'log_age': np.array(self._ssp.log_age), # log10(age/yr) 
+                'wave': wave_rest, 
+                'lum': ssp_lum.reshape((nz * nage, nwave))} # (Z, age) x wavelength 
+        self._calzetti = None 
+        return None 
+
+    def _ssp_grid_weights(self, x, grid): 
+        ''' indices and weights of linear interpolation on grid. x outside of 
+        grid is clipped to the edges. 
+        '''
+        x = np.clip(x, grid[0], grid[-1]) 
+        i = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid) - 2) 
+        frac = (x - grid[i]) / (grid[i+1] - grid[i]) 
+        return i, frac 
+
+    def _ssp_grid_model(self, tages, sfh, zh, dust2, dust1=None, dust_index=None): 
+        ''' composite spectrum from the SSP grid: SFH weights times the age and 
+        metallicity interpolation weights contracted with the SSP grid. Dust 
+        is applied analytically: Calzetti et al. (2000) for 'fsps' and Kriek & 
+        Conroy (2013) with birth cloud attenuation of young stars for
+        'fsps_complexdust', following their FSPS implementations. This is
+        an approximation of the FSPS time bin loop: SSPs are interpolated
+        linearly in log age and log Z rather than by FSPS and dust emission is
+        not included. 
+
+        :return flux: 
+            FSPS SSP flux in units of Lsun/A
+        '''
+        grid = self._ssp_grid 
+        nage = len(grid['log_age']) 
+
+        star = (sfh > 0) # no star formation in these bins 
+        log_age = np.log10(tages[star]) + 9. 
+        i_age, f_age = self._ssp_grid_weights(log_age, grid['log_age']) 
+        i_z, f_z = self._ssp_grid_weights(np.log10(np.clip(zh[star], 1e-10, None)/0.0190), grid['logzsol']) 
+
+        # row indices and weights of the 4 (Z, age) corners of each time bin 
+        rows = np.concatenate([
+            i_z * nage + i_age, i_z * nage + i_age + 1, 
+            (i_z + 1) * nage + i_age, (i_z + 1) * nage + i_age + 1])
+        wts = np.concatenate([
+            (1. - f_z) * (1. - f_age), (1. - f_z) * f_age, 
+            f_z * (1. - f_age), f_z * f_age]) * np.tile(sfh[star], 4)
+
+        wave_rest = grid['wave'] 
+        if self.model_name == 'fsps': 
+            lum_ssp = np.dot(wts, grid['lum'][rows]) 
+            lum_ssp *= np.exp(-dust2 * self._calzetti_curve(wave_rest))
+        elif self.model_name == 'fsps_complexdust': 
+            # stars younger than dust_tesc are also attenuated by the birth cloud 
+            young = np.tile(log_age < self._ssp.params['dust_tesc'], 4) 
+            lum_old = np.dot(wts[~young], grid['lum'][rows[~young]]) 
+            lum_young = np.dot(wts[young], grid['lum'][rows[young]]) 
+
+            tau_bc = dust1 * (wave_rest / 5500.)**self._ssp.params['dust1_index'] 
+            lum_ssp = (lum_old + lum_young * np.exp(-tau_bc)) * \
+                    np.exp(-dust2 * self._kriek_conroy_curve(wave_rest, dust_index))
+
+        lum_ssp /= np.sum(sfh)
+        return wave_rest, lum_ssp
+
+    def _kriek_conroy_curve(self, w, dust_index): 
+        ''' Kriek & Conroy (2013) attenuation curve, as implemented in FSPS for
+        dust_type=4: Calzetti curve with a UV bump whose strength scales with 
+        the slope, tilted by (w/5500)^dust_index 
+        '''
+        x = 1e4 / w # inverse microns 
+        k_cal = np.where(w > 6300., 
+                1.17 * (-1.857 + 1.04 * x) + 1.78, 
+                1.17 * (-2.156 + 1.509 * x - 0.198 * x**2 + 0.011 * x**3) + 1.78) / 0.44
+        e_bump = 0.85 - 1.9 * dust_index 
+        drude = e_bump * (w * 350.)**2 / ((w**2 - 2175.**2)**2 + (w * 350.)**2) 
+        return np.clip((k_cal + drude) / 4.05 * (w / 5500.)**dust_index, 0., None) 
     
     def _load_model_params(self): 
         ''' read in pickle file that contains all the parameters required for the emulator
@@ -1949,8 +4736,21 @@ class iSpeculator(iFSPS):
         self._emu_wave          = params[11]
 
         self._emu_n_layers = len(self._emu_W) # number of network layers
+        self._emu_buffers = threading.local() # work buffers for the batched forward pass (per thread)
+        self._emu_view = None # emulator view of the observed wavelength window
         return None 
         
+    def _check_nthreads(self, nthreads): 
+        ''' walkers can only be evaluated in threads (nthreads > 1) if the
+        model is thread-safe, i.e. the emulator or the SSP grid. FSPS shares
+        its parameters (self._ssp.params) between threads, so concurrent
+        walkers would silently get each other's spectra. 
+        '''
+        if nthreads is None or nthreads <= 1: return None 
+        if self.model_name != 'emulator' and self._ssp_grid is None: 
+            raise ValueError("nthreads > 1 requires model_name == 'emulator' or ssp_grid=True; FSPS is not thread-safe") 
+        return None 
+
     def _transform_to_SFH_basis(self, zarr):
         ''' MCMC is sampled in a warped manifold transformation of the original basis manifold
         as specified in Betancourt(2013). This function transforms back to the original manifold
@@ -1979,6 +4779,69 @@ class iSpeculator(iFSPS):
 
         return xarr 
 
+    def _transform_from_SFH_basis(self, xarr): 
+        ''' inverse of `_transform_to_SFH_basis` 
+
+        z_i = 1 - x_i / (1 - \\sum\\limits_{k=1}^{i-1} x_k)     for i < m
+
+        z_m does not enter the transform and cannot be recovered. 
+
+        :param xarr: 
+            N x m array 
+        :return zarr: 
+            N x (m-1) array of z_1, ..., z_{m-1}
+        '''
+        xarr    = np.atleast_2d(xarr)
+        
+        # fraction of the "stick" that remains before x_i 
+        remain  = 1. - np.cumsum(xarr[:,:-1], axis=1) + xarr[:,:-1] 
+        with np.errstate(divide='ignore', invalid='ignore'): 
+            zarr = 1. - xarr[:,:-1] / remain 
+        # if nothing remains, z_i is unconstrained 
+        zarr[remain <= 0.] = 0.5 
+        return np.clip(zarr, 0., 1.) 
+
+    def _chain_to_sampling_basis(self, chain, prior): 
+        ''' transform an output MCMC chain back to the warped manifold that is
+        sampled (see `_transform_to_SFH_basis`). beta4' is not constrained by
+        the SFH basis coefficients and is drawn from its prior. 
+        '''
+        _chain = chain.copy() 
+        _chain[:,1:4] = self._transform_from_SFH_basis(chain[:,1:5]) 
+        _chain[:,4] = np.random.uniform(prior.min[4], prior.max[4], size=chain.shape[0]) 
+        return _chain 
+
+    def _chain_to_SFH_basis(self, chain): 
+        ''' transform an MCMC chain from the warped manifold that is sampled to
+        the original SFH basis (see `_transform_to_SFH_basis`). A `ChainView`
+        is transformed block by block as it is read. 
+        '''
+        if isinstance(chain, ChainView): 
+            return chain.transformed(self._chain_to_SFH_basis) 
+        _chain = np.array(chain) 
+        _chain[:,1:5] = self._transform_to_SFH_basis(_chain[:,1:5]) 
+        return _chain 
+
+    def _transform_to_SFH_basis_jacobian(self, zarr): 
+        ''' Jacobian of `_transform_to_SFH_basis` 
+
+        :param zarr: 
+            N x m array 
+        :return jac: 
+            N x m x m array of d x_i / d z_j 
+        '''
+        zarr    = np.atleast_2d(zarr)
+        n, m    = zarr.shape
+        jac     = np.zeros((n, m, m)) 
+
+        for i in range(m): 
+            f = (1. - zarr[:,i]) if i < m-1 else 1.
+            for j in range(i): 
+                jac[:,i,j] = np.prod(np.delete(zarr[:,:i], j, axis=1), axis=1) * f
+            if i < m-1: 
+                jac[:,i,i] = -np.prod(zarr[:,:i], axis=1) 
+        return jac 
+
     def _get_bands(self, bands): 
         ''' given bands
         '''
@@ -2065,7 +4928,34 @@ class iSpeculator(iFSPS):
                     max(self._nmf_t_lookback) - self._nmf_t_lookback, 
                     self._nmf_zh_basis[i], k=1) 
                 for i in range(Ncomp_zh)]
+
+        # tables of the bases evaluated on the time grid, memoized by tage 
+        self._nmf_tables = {} 
         return None 
+
+    def _nmf_table(self, tage): 
+        ''' SFH and ZH NMF bases evaluated on the time grid np.linspace(0,
+        tage, 50) used throughout. The bases only depend on tage, so the table
+        is computed once per tage and memoized. 
+
+        :param tage: 
+            age of the galaxy in Gyr
+        :return t, sfh_basis, zh_basis, norm_sfh: 
+            time grid; Ncomp_sfh x 50 array of SFH bases each normalized by
+            its integral over t; Ncomp_zh x 50 array of ZH bases; and the sum
+            of each normalized SFH basis over t, so that the SSP normalization
+            of the emulator is np.dot(tt_sfh, norm_sfh). 
+        '''
+        tage = float(tage) 
+        if tage not in self._nmf_tables: 
+            t = np.linspace(0, tage, 50)
+
+            sfh_basis = np.array([self._sfh_basis[i](t) for i in range(len(self._sfh_basis))])
+            sfh_basis /= np.trapz(sfh_basis, t, axis=1)[:,None]
+            zh_basis = np.array([self._zh_basis[i](t) for i in range(len(self._zh_basis))])
+            
+            self._nmf_tables[tage] = (t, sfh_basis, zh_basis, np.sum(sfh_basis, axis=1))
+        return self._nmf_tables[tage] 
     
     def _ssp_initiate(self):
         ''' for models that use fsps, initiate fsps.StellarPopulation object 
@@ -2095,6 +4985,8 @@ class pseudoFirefly(Fitter):
     def __init__(self, model_name='vanilla', prior=None, cosmo=cosmo, downgraded=False, silent=True): 
         from estimations_3d import estimation
 
+        self._config = {'model_name': model_name, 'prior': prior, 'cosmo': cosmo, 
+                'downgraded': downgraded, 'silent': silent} 
         self._model_init(model_name)
         self.cosmo = cosmo # cosmology  
         self._set_prior(prior) # set prior 
@@ -2153,7 +5045,7 @@ class pseudoFirefly(Fitter):
     
         wave_obs_rest = wave_obs / (1. + zred) 
 
-        d_lum = self.cosmo.luminosity_distance(zred).to(U.cm).value # luminosity distance 
+        d_lum = Cosmo.luminosity_distance(self.cosmo, zred) # luminosity distance 
 
         # check mask 
         _mask = self._check_mask(mask, wave_obs, flux_ivar_obs, zred) 
@@ -2648,6 +5540,782 @@ class pseudoFirefly(Fitter):
         return extra_fit_list
 
 
+class _FitterPool(object): 
+    ''' pool of processes that evaluate the log posterior of a fitter. Each
+    process has its own copy of the fitter (and its fsps.StellarPopulation)
+    and of the log posterior arguments. Calling the pool with an N x Ntheta
+    array of walker positions splits the walkers into nprocs chunks and
+    returns the N log posteriors, i.e. it is a vectorized log posterior for
+    emcee. 
+
+    Where it is available (and safe, i.e. not on macOS) the processes are
+    forked when the pool is created, so they inherit the fitter as it is.
+    Otherwise they are spawned and the fitter is pickled, which only keeps
+    its configuration (see `Fitter.__getstate__`): the fitter is rebuilt in
+    each process and attributes changed after it was constructed are lost. 
+
+    :param fitter: 
+        fitter object 
+    :param lnpost_fn: 
+        log posterior function (method of fitter) 
+    :param lnpost_args: 
+        arguments of lnpost_fn 
+    :param lnpost_kwargs: 
+        keyword arguments of lnpost_fn 
+    :param nprocs: 
+        number of processes 
+    :param vectorize: (default: False) 
+        If `True`, lnpost_fn takes an N x Ntheta array. 
+    :param start_method: (default: None) 
+        'fork' or 'spawn'. If None, 'fork' is used where it is available
+        except on macOS. 
+    '''
+    def __init__(self, fitter, lnpost_fn, lnpost_args, lnpost_kwargs, nprocs, vectorize=False,
+            start_method=None): 
+        import multiprocessing as MP
+        self.nprocs = nprocs 
+        if start_method is None: 
+            fork = (sys.platform != 'darwin' and 'fork' in MP.get_all_start_methods()) 
+            start_method = 'fork' if fork else 'spawn' 
+        self.start_method = start_method 
+
+        if start_method == 'fork': 
+            # forked processes inherit the fitter, so it is not pickled 
+            initargs = (None, lnpost_fn, lnpost_args, lnpost_kwargs, vectorize) 
+        elif getattr(lnpost_fn, '__self__', None) is fitter: 
+            # the pickled fitter is rebuilt in each process 
+            initargs = (fitter, lnpost_fn.__name__, lnpost_args, lnpost_kwargs, vectorize) 
+        else: 
+            initargs = (fitter, lnpost_fn, lnpost_args, lnpost_kwargs, vectorize) 
+        self._pool = MP.get_context(start_method).Pool(nprocs, initializer=_pool_initiate, 
+                initargs=initargs) 
+
+    def __call__(self, tt_arr): 
+        chunks = [_tt for _tt in np.array_split(np.atleast_2d(tt_arr), self.nprocs) if len(_tt) > 0]
+        return np.concatenate(self._pool.map(_pool_lnpost, chunks)) 
+
+    def close(self): 
+        self._pool.close() 
+        self._pool.join() 
+        return None 
+
+
+class _FitterThreadPool(object): 
+    ''' pool of threads that evaluate the log posterior of a fitter. Calling
+    the pool with an N x Ntheta array of walker positions splits the walkers
+    into nthreads chunks, which are evaluated concurrently. This only speeds
+    things up for log posteriors that spend most of their time in NumPy
+    operations that release the GIL (e.g. the emulator). 
+
+    To avoid oversubscription, each BLAS call is limited to blas_threads
+    threads until the pool is closed, so that up to nthreads x blas_threads
+    cores are used. threadpoolctl sets the limit of the BLAS library, so it
+    applies to the whole process and not only to the walker threads. This
+    requires threadpoolctl; otherwise set OMP_NUM_THREADS (or equivalent)
+    before NumPy is imported. 
+
+    :param lnpost_fn: 
+        log posterior function (method of fitter) 
+    :param lnpost_args: 
+        arguments of lnpost_fn 
+    :param lnpost_kwargs: 
+        keyword arguments of lnpost_fn 
+    :param nthreads: 
+        number of walker threads 
+    :param blas_threads: (default: 1) 
+        number of threads of each BLAS call 
+    :param vectorize: (default: False) 
+        If `True`, lnpost_fn takes an N x Ntheta array. 
+    '''
+    def __init__(self, lnpost_fn, lnpost_args, lnpost_kwargs, nthreads, 
+            blas_threads=1, vectorize=False, silent=True): 
+        from concurrent.futures import ThreadPoolExecutor
+        self.nthreads = nthreads 
+        self.lnpost_fn = lnpost_fn 
+        self.lnpost_args = lnpost_args 
+        self.lnpost_kwargs = lnpost_kwargs 
+        self.vectorize = vectorize 
+
+        self._limits = None 
+        try: 
+            from threadpoolctl import threadpool_limits
+            self._limits = threadpool_limits(limits=blas_threads, user_api='blas') 
+        except ImportError: 
+            if not silent: 
+                print('threadpoolctl is not installed; BLAS threads are not limited') 
+        self._pool = ThreadPoolExecutor(max_workers=nthreads) 
+
+    def _lnpost(self, tt_arr): 
+        if self.vectorize: 
+            return np.asarray(self.lnpost_fn(tt_arr, *self.lnpost_args, **self.lnpost_kwargs)) 
+        return np.array([self.lnpost_fn(tt, *self.lnpost_args, **self.lnpost_kwargs) 
+            for tt in tt_arr]) 
+
+    def __call__(self, tt_arr): 
+        chunks = [_tt for _tt in np.array_split(np.atleast_2d(tt_arr), self.nthreads) if len(_tt) > 0]
+        return np.concatenate(list(self._pool.map(self._lnpost, chunks))) 
+
+    def close(self): 
+        self._pool.shutdown() 
+        if self._limits is not None: 
+            self._limits.restore_original_limits() 
+        return None 
+
+
+# log posterior of the worker processes of _FitterPool 
+_pool_state = {} 
+
+
+def _pool_initiate(fitter, lnpost_fn, lnpost_args, lnpost_kwargs, vectorize): 
+    ''' initialize a _FitterPool worker process. If lnpost_fn is a string, it
+    is the name of the log posterior method of fitter. 
+    '''
+    if isinstance(lnpost_fn, str): lnpost_fn = getattr(fitter, lnpost_fn) 
+    _pool_state['lnpost_fn'] = lnpost_fn 
+    _pool_state['lnpost_args'] = lnpost_args 
+    _pool_state['lnpost_kwargs'] = lnpost_kwargs 
+    _pool_state['vectorize'] = vectorize 
+    return None 
+
+
+def _pool_lnpost(tt_arr): 
+    ''' log posteriors of a chunk of walkers in a _FitterPool worker process 
+    '''
+    fn = _pool_state['lnpost_fn'] 
+    args = _pool_state['lnpost_args'] 
+    kwargs = _pool_state['lnpost_kwargs'] 
+    if _pool_state['vectorize']: 
+        return np.asarray(fn(tt_arr, *args, **kwargs)) 
+    return np.array([fn(tt, *args, **kwargs) for tt in tt_arr]) 
+
+
+def _chain_percentile(chain, q): 
+    ''' percentiles of each parameter of an MCMC chain. A `ChainView` is read
+    block by block (see `ChainView.percentile`). 
+    '''
+    if isinstance(chain, ChainView): return chain.percentile(q) 
+    return np.percentile(chain, q, axis=0) 
+
+
+def _write_chain(fh5, name, chain): 
+    ''' write an MCMC chain to a compressed dataset of an open hdf5 file. A
+    `ChainView` is copied block by block. 
+    '''
+    if not isinstance(chain, ChainView): 
+        fh5.create_dataset(name, data=np.asarray(chain), compression='gzip', chunks=True) 
+        return None 
+    dset = fh5.create_dataset(name, shape=chain.shape, dtype=chain.backend.dtype, 
+            compression='gzip', chunks=True) 
+    i = 0 
+    for block in chain.blocks(): 
+        dset[i:i+block.shape[0]] = block 
+        i += block.shape[0] 
+    return None 
+
+
+class SubspaceStretchMove(emcee.moves.StretchMove): 
+    ''' emcee stretch move that only updates the parameters in index, with
+    the other parameters of each walker fixed (i.e. a Metropolis-within-Gibbs
+    step). The stretch is applied in the subspace, so the proposal factor is
+    (len(index) - 1) log z. Mixed with the full stretch move, the ensemble
+    still samples the full posterior. 
+
+    :param index: 
+        indices of the parameters that are updated 
+    :param a: (default: 2.) 
+        scale parameter of the stretch move 
+    '''
+    def __init__(self, index, a=2.0, **kwargs): 
+        super(SubspaceStretchMove, self).__init__(a=a, **kwargs) 
+        self.index = np.atleast_1d(index) 
+
+    def get_proposal(self, s, c, random): 
+        c = np.concatenate(c, axis=0) 
+        Ns, Nc = len(s), len(c) 
+        zz = ((self.a - 1.0) * random.rand(Ns) + 1) ** 2.0 / self.a 
+        factors = (len(self.index) - 1.0) * np.log(zz) 
+        rint = random.randint(Nc, size=(Ns,)) 
+        q = s.copy() 
+        q[:,self.index] = c[rint][:,self.index] - (c[rint][:,self.index] - s[:,self.index]) * zz[:,None]
+        return q, factors 
+
+
+class DelayedAcceptanceMove(emcee.moves.StretchMove): 
+    ''' emcee stretch move with delayed acceptance (Christen & Fox 2005). 
+    Proposals are first accepted or rejected with a cheap approximate log
+    posterior and only the proposals that survive are evaluated with the
+    exact log posterior of the sampler. They are then accepted with
+    probability min(1, p(y) q(x) / (p(x) q(y))), where p and q are the exact
+    and approximate posteriors, so the chain samples the exact posterior. 
+
+    :param lnpost_fn: 
+        approximate log posterior function that takes an N x Ntheta array 
+    :param lnpost_args: 
+        arguments of lnpost_fn 
+    :param lnpost_kwargs: 
+        keyword arguments of lnpost_fn 
+    :param a: (default: 2.) 
+        scale parameter of the stretch move 
+    '''
+    def __init__(self, lnpost_fn, lnpost_args=(), lnpost_kwargs=None, a=2.0, **kwargs): 
+        super(DelayedAcceptanceMove, self).__init__(a=a, **kwargs) 
+        self.lnpost_fn      = lnpost_fn 
+        self.lnpost_args    = lnpost_args 
+        self.lnpost_kwargs  = {} if lnpost_kwargs is None else lnpost_kwargs 
+
+        self.n_proposed = 0 # number of proposals 
+        self.n_exact    = 0 # number of exact log posterior evaluations 
+        self._coords = None # walker positions and their approximate log posteriors 
+        self._lnpost = None 
+
+    def _approx_lnpost(self, coords): 
+        return np.asarray(self.lnpost_fn(coords, *self.lnpost_args, **self.lnpost_kwargs))
+
+    def propose(self, model, state): 
+        nwalkers, ndim = state.coords.shape
+        if nwalkers < 2 * ndim and not self.live_dangerously:
+            raise RuntimeError("It is unadvisable to use a red-blue move with fewer walkers than twice the number of dimensions.")
+        self.setup(state.coords)
+
+        # approximate log posterior of the current walkers 
+        if self._coords is None or not np.array_equal(self._coords, state.coords): 
+            self._lnpost = self._approx_lnpost(state.coords) 
+        lnpost_approx = self._lnpost.copy() 
+
+        accepted = np.zeros(nwalkers, dtype=bool) 
+        all_inds = np.arange(nwalkers) 
+        inds = all_inds % self.nsplits 
+        if self.randomize_split: 
+            model.random.shuffle(inds) 
+
+        for split in range(self.nsplits): 
+            S1 = (inds == split) 
+            sets = [state.coords[inds == j] for j in range(self.nsplits)] 
+            s = sets[split] 
+            c = sets[:split] + sets[split + 1:] 
+            q, factors = self.get_proposal(s, c, model.random) 
+
+            # first stage with the approximate log posterior 
+            lnq_new = self._approx_lnpost(q) 
+            dlnq = lnq_new - lnpost_approx[S1] 
+            stage1 = (factors + dlnq > np.log(model.random.rand(len(q)))) 
+
+            # second stage with the exact log posterior 
+            new_log_probs = np.repeat(-np.inf, len(q)) 
+            if np.any(stage1): 
+                new_log_probs[stage1], _ = model.compute_log_prob_fn(q[stage1]) 
+            self.n_proposed += len(q) 
+            self.n_exact += np.sum(stage1) 
+
+            for i, j in enumerate(all_inds[S1]): 
+                if not stage1[i]: continue 
+                if new_log_probs[i] - state.log_prob[j] - dlnq[i] > np.log(model.random.rand()): 
+                    accepted[j] = True 
+
+            new_state = emcee.State(q, log_prob=new_log_probs) 
+            state = self.update(state, new_state, accepted, S1) 
+            lnpost_approx[S1 & accepted] = lnq_new[accepted[S1]] 
+
+        self._coords = state.coords.copy() 
+        self._lnpost = lnpost_approx 
+        return state, accepted 
+
+
+class ChainBackend(emcee.backends.Backend): 
+    ''' emcee backend that streams the chain to a chunked and compressed hdf5
+    dataset. Only the most recent `window` iterations are kept in memory
+    (enough for the convergence checks in `_emcee`); older iterations are
+    written to disk in blocks and read back only when requested. The chain
+    and log posteriors are stored in `name`/chain and `name`/log_prob. 
+
+    :param filename: 
+        hdf5 file name 
+    :param name: (default: 'mcmc') 
+        name of the hdf5 group 
+    :param window: (default: 1000) 
+        number of iterations kept in memory 
+    :param compression: (default: 'gzip') 
+        hdf5 compression filter 
+    :param compression_opts: (default: 4) 
+        hdf5 compression level 
+    '''
+    def __init__(self, filename, name='mcmc', window=1000, compression='gzip', 
+            compression_opts=4, dtype=None): 
+        super(ChainBackend, self).__init__(dtype=dtype) 
+        self.filename           = filename 
+        self.name               = name 
+        self.window             = window 
+        self.compression        = compression 
+        self.compression_opts   = compression_opts 
+
+    def reset(self, nwalkers, ndim): 
+        super(ChainBackend, self).reset(nwalkers, ndim) 
+        self._offset = 0 # number of iterations written to disk 
+        self.chain = np.empty((self.window, self.nwalkers, self.ndim), dtype=self.dtype)
+        self.log_prob = np.empty((self.window, self.nwalkers), dtype=self.dtype)
+
+        # ~1MB chunks 
+        nchunk = int(max(1, min(self.window, 2**17 // (self.nwalkers * self.ndim))))
+        fh5 = h5py.File(self.filename, 'a') 
+        if self.name in fh5: del fh5[self.name] 
+        grp = fh5.create_group(self.name) 
+        grp.create_dataset('chain', shape=(0, self.nwalkers, self.ndim), 
+                maxshape=(None, self.nwalkers, self.ndim), chunks=(nchunk, self.nwalkers, self.ndim), 
+                dtype=self.dtype, compression=self.compression, 
+                compression_opts=self.compression_opts) 
+        grp.create_dataset('log_prob', shape=(0, self.nwalkers), 
+                maxshape=(None, self.nwalkers), chunks=(nchunk, self.nwalkers), 
+                dtype=self.dtype, compression=self.compression, 
+                compression_opts=self.compression_opts) 
+        fh5.close() 
+        return None 
+
+    def grow(self, ngrow, blobs): 
+        # the in-memory window has a fixed size 
+        if blobs is not None: 
+            raise ValueError('ChainBackend does not support blobs') 
+        return None 
+
+    def save_step(self, state, accepted): 
+        self._check(state, accepted) 
+        if self.iteration - self._offset == self.window: self.flush() 
+
+        i = self.iteration - self._offset 
+        self.chain[i,:,:] = state.coords 
+        self.log_prob[i,:] = state.log_prob 
+        self.accepted += accepted 
+        self.random_state = state.random_state 
+        self.iteration += 1 
+        return None 
+
+    def flush(self): 
+        ''' write the iterations in memory to disk 
+        '''
+        n = self.iteration - self._offset 
+        if n == 0: return None 
+        fh5 = h5py.File(self.filename, 'a') 
+        for k in ['chain', 'log_prob']: 
+            dset = fh5[self.name][k]
+            dset.resize(self.iteration, axis=0) 
+            dset[self._offset:self.iteration] = getattr(self, k)[:n]
+        fh5.close() 
+        self._offset = self.iteration 
+        return None 
+
+    def save_checkpoint(self, random_state, **state): 
+        ''' flush the chain and save the random state of the sampler and the
+        state of the run (keyword arguments of scalars and arrays) along with
+        the acceptances to `name`/checkpoint 
+        '''
+        self.flush() 
+        fh5 = h5py.File(self.filename, 'a') 
+        grp = fh5[self.name] 
+        if 'checkpoint' in grp: del grp['checkpoint'] 
+        ckpt = grp.create_group('checkpoint') 
+        ckpt.attrs['iteration'] = self.iteration 
+        ckpt.create_dataset('accepted', data=self.accepted) 
+        name, keys, pos, has_gauss, cached_gaussian = random_state 
+        ckpt.attrs['random_state'] = name 
+        ckpt.create_dataset('random_keys', data=keys) 
+        ckpt.attrs['random_pos'] = pos 
+        ckpt.attrs['random_has_gauss'] = has_gauss 
+        ckpt.attrs['random_cached_gaussian'] = cached_gaussian 
+        for k in state.keys(): 
+            ckpt.create_dataset(k, data=state[k]) 
+        fh5.close() 
+        return None 
+
+    def load_checkpoint(self): 
+        ''' restore the backend from the checkpoint in the file. Iterations
+        written after the checkpoint are discarded. 
+
+        :return state: 
+            dictionary of the state saved by `save_checkpoint` or None if there
+            is no checkpoint 
+        '''
+        if not os.path.isfile(self.filename): return None 
+        fh5 = h5py.File(self.filename, 'a') 
+        if self.name not in fh5 or 'checkpoint' not in fh5[self.name]: 
+            fh5.close() 
+            return None 
+        grp = fh5[self.name] 
+        ckpt = grp['checkpoint'] 
+        
+        iteration = int(ckpt.attrs['iteration']) 
+        for k in ['chain', 'log_prob']: 
+            grp[k].resize(iteration, axis=0) 
+        _, self.nwalkers, self.ndim = grp['chain'].shape 
+        self.dtype = grp['chain'].dtype 
+
+        self.iteration = iteration 
+        self._offset = iteration 
+        self.accepted = ckpt['accepted'][...]
+        self.random_state = (str(ckpt.attrs['random_state']), ckpt['random_keys'][...], 
+                int(ckpt.attrs['random_pos']), int(ckpt.attrs['random_has_gauss']), 
+                float(ckpt.attrs['random_cached_gaussian']))
+        state = {} 
+        for k in ckpt.keys(): 
+            if k in ['accepted', 'random_keys']: continue 
+            state[k] = ckpt[k][...]
+        fh5.close() 
+
+        self.chain = np.empty((self.window, self.nwalkers, self.ndim), dtype=self.dtype)
+        self.log_prob = np.empty((self.window, self.nwalkers), dtype=self.dtype)
+        self.blobs = None 
+        self.initialized = True 
+        return state 
+
+    def get_value(self, name, flat=False, thin=1, discard=0): 
+        if self.iteration <= 0: 
+            raise AttributeError("you must run the sampler before accessing the results") 
+        if name == 'blobs': return None 
+        
+        v = self.get_range(name, discard + thin - 1, self.iteration, thin) 
+        if flat: 
+            return v.reshape((v.shape[0] * v.shape[1],) + v.shape[2:])
+        return v 
+
+    def get_range(self, name, start, stop, step=1): 
+        ''' iterations start:stop:step of `name` ('chain' or 'log_prob'). Only
+        the requested iterations are read from disk. 
+        '''
+        stop = min(stop, self.iteration) 
+        v = [] 
+        if start < min(stop, self._offset): # iterations on disk 
+            fh5 = h5py.File(self.filename, 'r') 
+            v.append(fh5[self.name][name][start:min(stop, self._offset):step])
+            fh5.close() 
+            start += step * int(np.ceil((self._offset - start) / step))
+        # iterations in memory 
+        v.append(getattr(self, name)[max(start - self._offset, 0):max(stop - self._offset, 0):step])
+        return np.concatenate(v, axis=0) 
+
+
+class ChainView(object): 
+    ''' lazily read and thinned view of the flattened chain of a
+    `ChainBackend`. The chain is only read from disk when it is accessed and
+    then only the iterations that are needed: slices (e.g. view[:,0] or
+    view[-100:]) and `percentile` are read block by block, so the full chain
+    is never in memory. Converting the view to an array (np.asarray(view) or
+    view.copy()) reads the full chain. 
+
+    :param backend: 
+        ChainBackend object 
+    :param thin: (default: 1) 
+        thinning of the chain 
+    :param discard: (default: 0) 
+        number of iterations to discard 
+    :param transform: (default: None) 
+        function applied to each N x Ntheta block of the chain as it is read
+        (e.g. a change of basis). It must return an N x Ntheta array. 
+    :param block_size: (default: 2**17) 
+        number of rows read from disk at once 
+    '''
+    def __init__(self, backend, thin=1, discard=0, transform=None, block_size=2**17): 
+        self.backend = backend 
+        self.thin = thin 
+        self.discard = discard 
+        self.transform = transform 
+        self.block_size = block_size 
+        self.ndim = 2 
+
+    @property 
+    def niter(self): 
+        ''' number of (thinned) iterations in the view 
+        '''
+        return len(range(self.discard + self.thin - 1, self.backend.iteration, self.thin))
+
+    @property 
+    def shape(self): 
+        return (self.niter * self.backend.nwalkers, self.backend.ndim) 
+
+    def __len__(self): 
+        return self.shape[0] 
+
+    def __array__(self, dtype=None, copy=None): 
+        chain = self._read(0, self.niter) 
+        if dtype is not None: chain = chain.astype(dtype) 
+        return chain 
+
+    def __getitem__(self, key): 
+        rows, cols = (key[0], key[1:]) if isinstance(key, tuple) else (key, ()) 
+        if not isinstance(rows, (int, np.integer, slice)) or Ellipsis in cols: 
+            return np.asarray(self)[key] 
+
+        nwalkers = self.backend.nwalkers 
+        cols = (slice(None),) + cols 
+        if not isinstance(rows, slice): 
+            irow = range(self.shape[0])[rows] 
+            i = irow // nwalkers 
+            return self._read(i, i + 1)[cols][irow % nwalkers] 
+
+        irow = range(self.shape[0])[rows] 
+        if len(irow) == 0: return np.empty((0, self.backend.ndim))[cols] 
+        irow = np.array(irow) 
+        reverse = irow[0] > irow[-1] 
+        if reverse: irow = irow[::-1] 
+
+        out = [] 
+        for i0, i1 in self._blocks(irow[0] // nwalkers, irow[-1] // nwalkers + 1): 
+            inblock = (irow >= i0 * nwalkers) & (irow < i1 * nwalkers) 
+            out.append(self._read(i0, i1)[irow[inblock] - i0 * nwalkers][cols]) 
+        out = np.concatenate(out, axis=0) 
+        if reverse: return out[::-1] 
+        return out 
+
+    def copy(self): 
+        return np.asarray(self) 
+
+    def transformed(self, transform): 
+        ''' view of the chain with `transform` applied to each block after the
+        transform of this view 
+        '''
+        _transform = transform 
+        if self.transform is not None: 
+            _transform = lambda chain: transform(self.transform(chain)) 
+        return ChainView(self.backend, thin=self.thin, discard=self.discard, 
+                transform=_transform, block_size=self.block_size) 
+
+    def blocks(self): 
+        ''' iterate over the chain in blocks of about `block_size` rows 
+        '''
+        for i0, i1 in self._blocks(0, self.niter): 
+            yield self._read(i0, i1) 
+
+    def percentile(self, q): 
+        ''' percentiles of each parameter. Equivalent to np.percentile(view, q,
+        axis=0) but the chain is read block by block: the first pass gets the
+        range of each parameter, the second histograms each parameter to find
+        the bins of the order statistics that are needed, and the third reads
+        only the values in those bins. 
+
+        :param q: 
+            percentile or sequence of percentiles 
+        '''
+        nbins = 4096 
+        n, ndim = self.shape 
+        if n == 0: raise ValueError('the chain is empty') 
+
+        lo = np.full(ndim, np.inf) 
+        hi = np.full(ndim, -np.inf) 
+        for block in self.blocks(): 
+            lo = np.minimum(lo, block.min(axis=0)) 
+            hi = np.maximum(hi, block.max(axis=0)) 
+        scale = nbins / np.where(hi > lo, hi - lo, 1.) 
+        def _bin(block): 
+            return np.clip(((block - lo) * scale).astype(int), 0, nbins - 1) 
+
+        counts = np.zeros((ndim, nbins), dtype=int) 
+        for block in self.blocks(): 
+            ibin = _bin(block) 
+            for j in range(ndim): 
+                counts[j] += np.bincount(ibin[:,j], minlength=nbins) 
+        cumcounts = np.cumsum(counts, axis=1) 
+
+        # order statistics for linear interpolation between the closest ranks
+        # (the default of np.percentile) 
+        pos = np.asarray(q, dtype=float) / 100. * (n - 1) 
+        k0 = np.floor(pos).astype(int) 
+        k1 = np.minimum(k0 + 1, n - 1) 
+        ranks = np.unique(np.concatenate([np.atleast_1d(k0), np.atleast_1d(k1)])) 
+        rbins = [np.unique(np.searchsorted(cumcounts[j], ranks, side='right')) for j in range(ndim)]
+
+        values = [[[] for b in rbins[j]] for j in range(ndim)] 
+        for block in self.blocks(): 
+            ibin = _bin(block) 
+            for j in range(ndim): 
+                for ib, b in enumerate(rbins[j]): 
+                    values[j][ib].append(block[ibin[:,j] == b, j]) 
+
+        def _order_stat(j, k): 
+            b = np.searchsorted(cumcounts[j], k, side='right') 
+            ib = np.searchsorted(rbins[j], b) 
+            if not isinstance(values[j][ib], np.ndarray): 
+                values[j][ib] = np.sort(np.concatenate(values[j][ib])) 
+            return values[j][ib][k - (cumcounts[j][b] - counts[j][b])] 
+
+        x0 = np.array([[_order_stat(j, k) for j in range(ndim)] for k in np.atleast_1d(k0)])
+        x1 = np.array([[_order_stat(j, k) for j in range(ndim)] for k in np.atleast_1d(k1)])
+        t = (np.atleast_1d(pos) - np.atleast_1d(k0))[:,None] 
+        out = x0 + t * (x1 - x0) 
+        if np.ndim(q) == 0: return out[0] 
+        return out 
+
+    def _blocks(self, start, stop): 
+        ''' (i0, i1) ranges of iterations of about `block_size` rows 
+        '''
+        nblock = max(1, self.block_size // self.backend.nwalkers) 
+        for i0 in range(start, stop, nblock): 
+            yield i0, min(i0 + nblock, stop) 
+
+    def _read(self, i0, i1): 
+        ''' flattened chain of (thinned) iterations i0 to i1 
+        '''
+        start = self.discard + self.thin - 1 
+        chain = self.backend.get_range('chain', start + i0 * self.thin, start + i1 * self.thin, self.thin)
+        chain = chain.reshape((chain.shape[0] * chain.shape[1], chain.shape[2])) 
+        if self.transform is not None: chain = self.transform(chain) 
+        return chain 
+
+
+class ConvergenceMonitor(object): 
+    ''' incremental Gelman-Rubin convergence monitor for an ensemble of
+    walkers. Running per-walker and per-parameter means and sums of squared
+    deviations are updated with each new block of the chain (Welford's
+    algorithm, combined blockwise), so the cost of monitoring does not grow
+    with the length of the chain. Each walker is treated as a separate chain. 
+
+    The integrated autocorrelation time is estimated with batch means. Per-walker
+    sums over batches of the chain are kept and neighboring batches are merged
+    (doubling the batch size) whenever there are 2 x nbatch batches, so
+    there are always nbatch to 2 x nbatch batches. 
+
+    :param nwalkers: 
+        number of walkers 
+    :param ndim: 
+        number of parameters 
+    :param threshold: (default: 1.1) 
+        the chain is converged when the PSRF of every parameter is below
+        threshold 
+    :param nbatch: (default: 8) 
+        minimum number of batches for the autocorrelation time 
+    '''
+    def __init__(self, nwalkers, ndim, threshold=1.1, nbatch=8): 
+        self.nwalkers   = nwalkers 
+        self.ndim       = ndim 
+        self.threshold  = threshold 
+        self.nbatch     = nbatch 
+
+        self.n      = 0 # number of iterations 
+        self.mean   = np.zeros((nwalkers, ndim)) # per-walker mean 
+        self.m2     = np.zeros((nwalkers, ndim)) # per-walker sum of squared deviations 
+
+        self.batch_size     = 1 
+        self.batch_sums     = np.zeros((0, nwalkers, ndim)) # per-walker batch sums 
+        self.partial_sum    = np.zeros((nwalkers, ndim)) # sum over the incomplete batch 
+        self.npartial       = 0 # number of iterations in the incomplete batch 
+
+    def update(self, chain): 
+        ''' update the statistics with a new block of the chain 
+
+        :param chain: 
+            Niter x Nwalkers x Ndim array of the new iterations (i.e. the
+            output of emcee.EnsembleSampler.get_chain) 
+        '''
+        n_b = chain.shape[0] 
+        if n_b == 0: return None 
+        mean_b = np.mean(chain, axis=0) 
+        m2_b = np.sum((chain - mean_b)**2, axis=0) 
+
+        n = self.n + n_b 
+        delta = mean_b - self.mean 
+        self.mean += delta * n_b / n 
+        self.m2 += m2_b + delta**2 * self.n * n_b / n 
+        self.n = n 
+        
+        self._update_batches(chain) 
+        return None 
+
+    def _update_batches(self, chain): 
+        ''' add the new iterations to the batch sums 
+        '''
+        b = self.batch_size 
+        # complete the incomplete batch 
+        k = min(b - self.npartial, chain.shape[0]) 
+        self.partial_sum += np.sum(chain[:k], axis=0) 
+        self.npartial += k 
+        chain = chain[k:] 
+        if self.npartial == b: 
+            self.batch_sums = np.concatenate([self.batch_sums, self.partial_sum[None,:,:]], axis=0) 
+            self.partial_sum = np.zeros((self.nwalkers, self.ndim)) 
+            self.npartial = 0 
+
+        # full batches 
+        m = chain.shape[0] // b 
+        if m > 0: 
+            sums = np.sum(chain[:m*b].reshape((m, b, self.nwalkers, self.ndim)), axis=1) 
+            self.batch_sums = np.concatenate([self.batch_sums, sums], axis=0) 
+        
+        # the rest 
+        if chain.shape[0] > m * b: 
+            self.partial_sum = np.sum(chain[m*b:], axis=0) 
+            self.npartial = chain.shape[0] - m * b 
+
+        # merge neighboring batches 
+        while self.batch_sums.shape[0] >= 2 * self.nbatch: 
+            nb = self.batch_sums.shape[0] 
+            if nb % 2 == 1: 
+                # the unpaired batch becomes part of the incomplete batch 
+                self.partial_sum += self.batch_sums[-1] 
+                self.npartial += self.batch_size 
+            self.batch_sums = np.sum(self.batch_sums[:2*(nb//2)].reshape(
+                (nb//2, 2, self.nwalkers, self.ndim)), axis=1) 
+            self.batch_size *= 2 
+        return None 
+
+    def tau(self): 
+        ''' integrated autocorrelation time of each parameter estimated from
+        the variance of the batch means: batch_size * var(batch mean) / var
+        averaged over the walkers. The autocorrelation time is undefined (NaN)
+        for parameters that do not vary within the walkers (e.g. constant
+        parameters or stuck walkers). 
+        '''
+        if self.batch_sums.shape[0] < 2: return np.repeat(np.inf, self.ndim) 
+        bmeans = self.batch_sums / self.batch_size 
+        var_bm = np.mean(np.var(bmeans, axis=0, ddof=1), axis=0) 
+        var = np.mean(self.m2 / (self.n - 1.), axis=0) 
+        return np.where(var > 0, self.batch_size * var_bm / np.where(var > 0, var, 1.), np.nan)
+
+    def get_state(self): 
+        ''' dictionary of the monitor statistics (e.g. for checkpointing) 
+        '''
+        return {'n': self.n, 'mean': self.mean, 'm2': self.m2, 
+                'batch_size': self.batch_size, 'batch_sums': self.batch_sums, 
+                'partial_sum': self.partial_sum, 'npartial': self.npartial}
+
+    def set_state(self, state): 
+        ''' restore the monitor statistics from `get_state` 
+        '''
+        self.n = int(state['n']) 
+        self.mean = np.array(state['mean']) 
+        self.m2 = np.array(state['m2']) 
+        self.batch_size = int(state['batch_size']) 
+        self.batch_sums = np.array(state['batch_sums']) 
+        self.partial_sum = np.array(state['partial_sum']) 
+        self.npartial = int(state['npartial']) 
+        return None 
+
+    def _variances(self): 
+        N, M = float(self.n), float(self.nwalkers) 
+        W = np.mean(self.m2 / N, axis=0) # within-walker variance 
+        B = N * np.var(self.mean, axis=0, ddof=1) # between-walker variance 
+        p_var = W * (N - 1.) / N + (M + 1.) * B / (M * N) 
+        return W, B, p_var 
+
+    def rhat(self): 
+        ''' potential scale reduction factor (PSRF) of each parameter. Same
+        definition as `iFSPS.ACM`. Parameters with no within-walker variance
+        have PSRF = 1 if all the walkers agree and infinity otherwise. 
+        '''
+        W, B, p_var = self._variances() 
+        return np.where(W > 0, p_var / np.where(W > 0, W, 1.), np.where(B > 0, np.inf, 1.))
+
+    def ess(self): 
+        ''' effective sample size of each parameter estimated from the
+        between- and within-walker variances (Gelman et al. 2003): 
+        Nwalkers * Niter * min(1, var / B). If B = 0 (e.g. a constant
+        parameter), the ESS is Nwalkers * Niter. 
+        '''
+        W, B, p_var = self._variances() 
+        var = W * (self.n - 1.) / self.n + B / self.n 
+        return self.nwalkers * self.n * np.where(B > 0, np.minimum(1., var / np.where(B > 0, B, 1.)), 1.)
+
+    def converged(self): 
+        ''' True if the PSRF of the worst parameter is below the threshold 
+        '''
+        return bool(np.max(self.rhat()) < self.threshold) 
+
+
 class FlatDirichletPrior(object): 
     ''' flat dirichlet prior
     '''
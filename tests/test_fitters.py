@@ -1,10 +1,25 @@
-__all__ = ['test_iSpeculator']
+__all__ = ['test_iSpeculator', 'test_iSpeculator_emulator_batch', 
+        'test_iSpeculator_lnPost_batch', 'test_iSpeculator_emulator_view', 
+        'test_iSpeculator_model_grad', 'test_nuts', 'test_laplace', 
+        'test_photo_projection', 'test_cosmology_tables', 'test_iFSPS_grid', 
+        'test_iFSPS_dust_cache', 'test_subspace_stretch_move', 'test_iSpeculator_ssp_grid', 
+        'test_iFSPS_native_mags', 'test_photo_emulator', 
+        'test_delayed_acceptance', 'test_fitter_pool', 'test_fitter_pool_state', 
+        'test_fitter_thread_pool', 'test_fitter_thread_pool_blas', 'test_iSpeculator_fsps_nthreads', 'test_iSpeculator_fsps_photo_emulator', 'test_fitter_pickle', 
+        'test_convergence_monitor', 'test_chain_backend', 'test_chain_file_output', 'test_emcee_resume', 
+        'test_convergence_monitor_tau', 'test_convergence_monitor_degenerate', 'test_emcee_autocorr_undefined', 'test_emcee_autocorr_thin', 'test_multistart', 'test_warm_start']
 
+import h5py
+import pickle
+import warnings
 import pytest
 import numpy as np 
+from astropy import units as U
 # --- gqp_mc --- 
 from gqp_mc import data as Data
 from gqp_mc import fitters as Fitters
+from gqp_mc import cosmology as Cosmo
+from gqp_mc import util as UT
 
 
 @pytest.mark.parametrize("data_type", ('spec', 'photo'))
@@ -50,3 +65,823 @@ def test_iSpeculator(data_type):
                 opt_maxiter=100,
                 silent=False) 
         assert 'theta_med' in output.keys() 
+
+
+def test_iSpeculator_emulator_batch(): 
+    # batched forward pass should reproduce the single theta forward pass 
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+
+    tt = np.array([
+        [0.25, 0.25, 0.25, 0.25, 1e-3, 1e-3, 0.5, 11.],
+        [0.7, 0.1, 0.1, 0.1, 5e-3, 1e-4, 1.5, 11.],
+        [0.1, 0.2, 0.3, 0.4, 1e-4, 7e-3, 0.1, 9.]])
+
+    flux_batch = iSpec._emulator_batch(tt) 
+    assert flux_batch.shape == (3, len(iSpec._emu_wave))
+    for i in range(tt.shape[0]): 
+        assert np.allclose(flux_batch[i], _emulator_reference(iSpec, tt[i]), rtol=1e-10)
+        assert np.allclose(iSpec._emulator(tt[i]), flux_batch[i], rtol=1e-10)
+
+
+def _emulator_reference(iSpec, tt): 
+    ''' single theta forward pass through the emulator network, one layer at a
+    time, as it was before the batched forward pass 
+    '''
+    act = []
+    offset = np.log(np.sum(tt[0:4]))
+    layers = [(iSpec._transform_theta(tt) - iSpec._emu_theta_mean)/iSpec._emu_theta_std]
+    for i in range(iSpec._emu_n_layers-1):
+        act.append(np.dot(layers[-1], iSpec._emu_W[i]) + iSpec._emu_b[i])
+        layers.append((iSpec._emu_beta[i] + (1.-iSpec._emu_beta[i])*1./(1.+np.exp(-iSpec._emu_alpha[i]*act[-1])))*act[-1])
+    layers.append(np.dot(layers[-1], iSpec._emu_W[-1]) + iSpec._emu_b[-1])
+
+    logflux = np.dot(layers[-1]*iSpec._emu_pca_std + iSpec._emu_pca_mean, iSpec._emu_pcas)*iSpec._emu_spec_std + iSpec._emu_spec_mean + offset
+    flux = np.exp(logflux)
+
+    _t = np.linspace(0, tt[7], 50)
+    norm_sfh = np.sum([tt[:4][i] * 
+        iSpec._sfh_basis[i](_t)/np.trapz(iSpec._sfh_basis[i](_t), _t) for i
+        in range(4)])
+    return flux / norm_sfh 
+
+
+def test_iSpeculator_lnPost_batch(): 
+    # vectorized log posteriors should reproduce the log posterior of the
+    # single theta reference model 
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    prior = iSpec._default_prior(f_fiber_prior=[0.1, 2.])
+    np.random.seed(0) 
+    
+    zred = 0.1 
+    tt = np.array([prior() for i in range(5)]) 
+    tt[0,0] = prior.max[0] + 1. # outside of the prior 
+
+    bands_list = iSpec._get_bands('desi') 
+    filters = Fitters.specFilter.load_filters(*tuple(bands_list))
+    w_obs = np.linspace(3600., 9800., 1000) 
+    mask = (w_obs > 6500.) & (w_obs < 6600.) 
+
+    _, flux_obs = _model_reference(iSpec, tt[1,:-1], zred, wavelength=w_obs) 
+    photo_obs = _photo_reference(iSpec, tt[1,:-1], zred, filters) 
+    flux_obs = flux_obs * (1. + 0.05 * np.random.randn(len(w_obs))) 
+    photo_obs = photo_obs * (1. + 0.05 * np.random.randn(len(photo_obs))) 
+    ivar_obs = np.ones(len(w_obs)) 
+    photo_ivar_obs = np.ones(len(photo_obs)) 
+
+    chi2_spec, chi2_spec_fiber, chi2_photo = [], [], [] 
+    for _tt in tt[1:]: 
+        _, flux = _model_reference(iSpec, _tt[:-1], zred, wavelength=w_obs) 
+        photo = _photo_reference(iSpec, _tt[:-1], zred, filters) 
+        chi2_spec.append(np.sum((flux - flux_obs)[~mask]**2 * ivar_obs[~mask])) 
+        chi2_spec_fiber.append(np.sum((_tt[-1] * flux - flux_obs)[~mask]**2 * ivar_obs[~mask])) 
+        chi2_photo.append(np.sum((photo - photo_obs)**2 * photo_ivar_obs)) 
+    chi2_spec, chi2_spec_fiber, chi2_photo = np.array(chi2_spec), np.array(chi2_spec_fiber), np.array(chi2_photo)
+
+    prior_nofiber = Fitters.UniformPrior(prior.min[:-1], prior.max[:-1]) 
+    lnpost = iSpec._lnPost_batch(tt[:,:-1], w_obs, flux_obs, ivar_obs, zred, 
+            mask=mask, prior=prior_nofiber) 
+    assert lnpost[0] == -np.inf 
+    assert np.allclose(lnpost[1:], -0.5 * chi2_spec, rtol=1e-6)
+
+    lnpost = iSpec._lnPost_photo_batch(tt[:,:-1], photo_obs, photo_ivar_obs, zred, 
+            filters=filters, prior=prior_nofiber) 
+    assert lnpost[0] == -np.inf 
+    assert np.allclose(lnpost[1:], -0.5 * chi2_photo, rtol=1e-6)
+
+    lnpost = iSpec._lnPost_spectrophoto_batch(tt, w_obs, flux_obs, ivar_obs, 
+            photo_obs, photo_ivar_obs, zred, mask=mask, filters=filters, prior=prior) 
+    assert lnpost[0] == -np.inf 
+    assert np.allclose(lnpost[1:], -0.5 * (chi2_spec_fiber + chi2_photo), rtol=1e-6)
+
+
+def _model_reference(iSpec, zz, zred, wavelength=None): 
+    ''' emulator model spectrum of a single theta (with the transformed SFH
+    basis coefficients) computed without batching, emulator views, or cached
+    tables 
+    '''
+    tt = np.concatenate([zz, [iSpec.cosmo.age(zred).value]]) 
+    tt[1:5] = iSpec._transform_to_SFH_basis(zz[1:5])[0] 
+    lum = 10**tt[0] * _emulator_reference(iSpec, tt[1:]) 
+
+    w_z = iSpec._emu_wave * (1. + zred) 
+    d_lum = iSpec.cosmo.luminosity_distance(zred).to(U.cm).value 
+    flux = lum * UT.Lsun() / (4. * np.pi * d_lum**2) / (1. + zred) * 1e17 # 10^-17 ergs/s/cm^2/Ang
+    if wavelength is None: return w_z, flux 
+    return wavelength, np.interp(wavelength, w_z, flux, left=0, right=0) 
+
+
+def _emulator_fitter(ndraw): 
+    ''' emulator fitter, its default prior, and ndraw draws from the prior
+    with the SFH basis parameters kept away from the edges of the prior 
+    '''
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    prior = iSpec._default_prior()
+    zz = np.array([prior() for i in range(ndraw)]) 
+    zz[:,1:4] = np.clip(zz[:,1:4], 0.05, 0.95) 
+    return iSpec, prior, zz 
+
+
+def _photo_reference(iSpec, zz, zred, filters): 
+    ''' photometry of the reference model spectrum from speclite. The
+    spectrum is zero padded to cover the filters. 
+    '''
+    w_pad, spec_pad = _zero_pad_reference(*_model_reference(iSpec, zz, zred)) 
+    maggies = filters.get_ab_maggies(spec_pad * 1e-17*U.erg/U.s/U.cm**2/U.Angstrom, 
+            wavelength=w_pad*U.Angstrom) 
+    return np.array(list(maggies[0])) * 1e9 
+
+
+def test_iSpeculator_emulator_view(): 
+    # model evaluated on the observed wavelength window should reproduce the
+    # interpolated full model 
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    prior = iSpec._default_prior()
+    tt = np.array([prior() for i in range(3)]) 
+
+    zred = 0.1 
+    w_obs = np.linspace(3000., 10000., 2000) 
+    w_z, flux = iSpec.model_batch(tt, zred=zred) 
+    _, flux_view = iSpec.model_batch(tt, zred=zred, wavelength=w_obs) 
+    for i in range(tt.shape[0]): 
+        assert np.allclose(flux_view[i], np.interp(w_obs, w_z, flux[i], left=0, right=0), rtol=1e-10)
+
+
+def test_iSpeculator_model_grad(): 
+    # analytic derivatives of the model spectra should match finite differences
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    prior = iSpec._default_prior()
+    tt = prior() 
+
+    zred = 0.1 
+    w_obs = np.linspace(3600., 9800., 1000) 
+    _, flux, dflux = iSpec.model(tt, zred=zred, wavelength=w_obs, grad=True) 
+    assert dflux.shape == (len(tt), len(w_obs))
+
+    for i in range(len(tt)): 
+        h = 1e-6 * (prior.max[i] - prior.min[i]) 
+        tt_p, tt_m = tt.copy(), tt.copy() 
+        tt_p[i] += h 
+        tt_m[i] -= h 
+        dflux_fd = (iSpec.model(tt_p, zred=zred, wavelength=w_obs)[1] - 
+                iSpec.model(tt_m, zred=zred, wavelength=w_obs)[1]) / (2. * h) 
+        assert np.allclose(dflux[i], dflux_fd, rtol=1e-5, atol=1e-6 * np.abs(flux).max())
+
+
+def test_nuts(): 
+    # NUTS should sample a correlated gaussian posterior 
+    np.random.seed(0) 
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    prior = Fitters.UniformPrior(np.array([-10., -10.]), np.array([10., 10.])) 
+
+    mu = np.array([0., 1.]) 
+    cov = np.array([[1., 0.9], [0.9, 1.]]) 
+    icov = np.linalg.inv(cov) 
+    def lnpost(tt, prior=None, grad=False): 
+        dtt = np.atleast_2d(tt) - mu 
+        lp = -0.5 * np.sum(np.dot(dtt, icov) * dtt, axis=1) 
+        if grad: return lp, -np.dot(dtt, icov) 
+        return lp 
+
+    chain = iSpec._nuts(lnpost, (), {'prior': prior}, nchains=2, burnin=200,
+            niter=1000, vectorize=True) 
+    assert chain.shape == (2000, 2) 
+    assert np.allclose(np.mean(chain, axis=0), mu, atol=0.2) 
+    assert np.allclose(np.cov(chain.T), cov, atol=0.2)
+
+
+def test_laplace(capsys): 
+    # Laplace approximation of a gaussian posterior should be exact 
+    np.random.seed(0) 
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    prior = Fitters.UniformPrior(np.array([-10., -10.]), np.array([10., 10.])) 
+
+    mu = np.array([0., 1.]) 
+    cov = np.array([[1., 0.9], [0.9, 1.]]) 
+    icov = np.linalg.inv(cov) 
+    def lnpost(tt, prior=None, grad=False): 
+        dtt = np.atleast_2d(tt) - mu 
+        lp = -0.5 * np.sum(np.dot(dtt, icov) * dtt, axis=1) 
+        if grad: return lp, -np.dot(dtt, icov) 
+        return lp 
+
+    chain = iSpec._laplace(lnpost, (), {'prior': prior}, nsample=10000, vectorize=True) 
+    assert chain.shape == (10000, 2) 
+    assert np.allclose(iSpec.laplace['theta_map'], mu, atol=1e-4) 
+    assert np.allclose(iSpec.laplace['cov'], cov, atol=1e-4) 
+    assert np.allclose(np.cov(chain.T), cov, atol=0.1)
+
+    # the prior truncates most of the Gaussian, but the chain is still filled 
+    prior = Fitters.UniformPrior(np.array([1., 1.]), np.array([10., 10.])) 
+    chain = iSpec._laplace(lnpost, (), {'prior': prior}, nsample=1000, vectorize=True) 
+    assert chain.shape == (1000, 2) 
+    assert iSpec.laplace['acceptance'] < 0.6 
+
+    # the prior truncates essentially all of the Gaussian: a short chain is
+    # returned with a warning 
+    prior = Fitters.UniformPrior(np.array([-1e-6, -10.]), np.array([1e-6, 10.])) 
+    chain = iSpec._laplace(lnpost, (), {'prior': prior}, nsample=1000, vectorize=True) 
+    assert chain.shape[0] < 1000 
+    assert np.all(np.isfinite(iSpec._lnPrior_batch(chain, prior=prior))) 
+    assert capsys.readouterr().out.count('WARNING') > 0
+
+
+@pytest.mark.parametrize('zred', [0.2, 0.05]) 
+def test_photo_projection(zred): 
+    # photometry from the cached filter projection should match speclite. At
+    # zred=0.05 the emulator wavelengths end before the DECam z filter, so the
+    # projection is built from zero padded wavelengths 
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    prior = iSpec._default_prior()
+    tt = np.array([prior() for i in range(3)]) 
+
+    bands_list = iSpec._get_bands('desi') 
+    filters = Fitters.specFilter.load_filters(*tuple(bands_list))
+    w, spec = iSpec.model_batch(tt, zred=zred) 
+    padded = (w[-1] < filters[-1].wavelength[-1]) 
+    assert padded == (zred < 0.1) 
+
+    photo = iSpec._get_photo(w, spec, filters) 
+    assert photo.shape == (3, len(bands_list))
+    w_pad, spec_pad = _zero_pad_reference(w, spec) 
+    assert np.allclose(photo, iSpec._get_ab_maggies(w_pad, spec_pad, filters), rtol=1e-10)
+    # the projection is cached, but only for the same wavelength grid 
+    assert iSpec._photo_projection(w, filters) is iSpec._photo_projection(w, filters) 
+    w_log = np.geomspace(w[0], w[-1], len(w)) # same length and end points 
+    spec_log = np.array([np.interp(w_log, w, _spec) for _spec in spec]) 
+    assert np.allclose(iSpec._get_photo(w_log, spec_log, filters), 
+            iSpec._get_ab_maggies(*_zero_pad_reference(w_log, spec_log), filters), rtol=1e-10)
+
+
+def _zero_pad_reference(w, spec): 
+    ''' zero pad N x Nwave spectra to 1000-20000A at 1A resolution, as
+    speculator photometry did before the cached projections 
+    '''
+    n_below = int(w.min() - 1e3) + 1 
+    n_above = int(2e4 - w.max()) + 1
+    w_pad = np.concatenate([
+        np.linspace(1e3, w.min(), n_below)[:-1], 
+        w,
+        np.linspace(w.max(), 2e4, n_above)[1:]]) 
+    spec = np.atleast_2d(spec) 
+    spec_pad = np.concatenate([
+        np.zeros((spec.shape[0], n_below-1)), 
+        spec, 
+        np.zeros((spec.shape[0], n_above-1))], axis=1)
+    return w_pad, spec_pad 
+
+
+def test_cosmology_tables(): 
+    # tabulated cosmology should match astropy inside and outside the table 
+    from astropy import units as U
+    from astropy.cosmology import Planck13 as cosmo
+    z = np.array([0.01, 0.1, 0.35, 1.5, 5.]) 
+    assert Cosmo.get_table(cosmo) is Cosmo.get_table(cosmo) 
+    assert np.allclose(Cosmo.age(cosmo, z), cosmo.age(z).value, rtol=1e-10) 
+    assert np.allclose(Cosmo.luminosity_distance(cosmo, z), 
+            cosmo.luminosity_distance(z).to(U.cm).value, rtol=1e-10) 
+    assert np.isclose(Cosmo.age(cosmo, 0.1), cosmo.age(0.1).value, rtol=1e-10)
+
+    # changing the redshift range applies to existing fitters 
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    tt = iSpec._default_prior()() 
+    _, flux = iSpec.model(tt, zred=0.1) 
+    try: 
+        Cosmo.set_zrange(zmin=0., zmax=0.5, nz=500) 
+        _, flux_zrange = iSpec.model(tt, zred=0.1) 
+        assert (id(iSpec.cosmo), 0., 0.5, 500) in Cosmo._tables 
+    finally: 
+        Cosmo.set_zrange() 
+    assert np.allclose(flux_zrange, flux, rtol=1e-8) 
+
+
+def test_iFSPS_grid(tmpdir): 
+    # grid spectra should reproduce FSPS at the grid points and approximate it
+    # between them 
+    ifsps = Fitters.iFSPS(model_name='vanilla') 
+    fgrid = str(tmpdir.join('grid.hdf5'))
+    ifsps.build_grid(fgrid, zred=0.1, axes={'z_metal': [-1., -0.75, -0.5], 
+        'dust2': [0.5, 1.], 'tau': [1., 1.25, 1.5]}) 
+    assert ifsps._grid is None # building the grid does not change the model 
+
+    ifsps_grid = Fitters.iFSPS(model_name='vanilla', grid=fgrid) 
+    tt = np.array([10., -0.75, 1., 1.25]) 
+    w, spec = ifsps.model(tt, zred=0.1) 
+    w_grid, spec_grid = ifsps_grid.model(tt, zred=0.1) 
+    assert np.allclose(w, w_grid) 
+    assert np.allclose(spec, spec_grid, rtol=1e-4) 
+
+    # off the grid points. dust2 is exactly linear in log luminosity, so the
+    # interpolation error (< 2% in the optical) comes from Z and tau 
+    tt = np.array([10., -0.6, 0.7, 1.1]) 
+    w, spec = ifsps.model(tt, zred=0.1) 
+    w_grid, spec_grid = ifsps_grid.model(tt, zred=0.1) 
+    assert np.all(np.isfinite(spec_grid)) 
+    optical = (w > 3500. * 1.1) & (w < 9000. * 1.1) 
+    assert np.allclose(spec_grid[optical], spec[optical], rtol=0.02) 
+
+
+def test_iFSPS_dust_cache(): 
+    # analytic Calzetti attenuation of cached dust-free spectra should match FSPS
+    ifsps = Fitters.iFSPS(model_name='vanilla') 
+    ifsps_cache = Fitters.iFSPS(model_name='vanilla', dust_cache=True) 
+    for dust2 in [0.2, 1.]: 
+        tt = np.array([10., -1., dust2, 2.]) 
+        w, spec = ifsps.model(tt, zred=0.1) 
+        _, spec_cache = ifsps_cache.model(tt, zred=0.1) 
+        optical = (w < 2e4) 
+        assert np.allclose(spec_cache[optical], spec[optical], rtol=1e-3) 
+
+    info = ifsps_cache.dust_cache_info() 
+    assert info['hits'] == 1 and info['misses'] == 1
+
+    # emcee steps that only update dust2 should hit the cache 
+    ifsps_cache = Fitters.iFSPS(model_name='vanilla', dust_cache=True) 
+    w_obs = np.linspace(3600., 9800., 1000) 
+    _, flux_obs = ifsps.model(np.array([10., -1., 0.5, 2.]), zred=0.1, wavelength=w_obs)
+    ifsps_cache.MCMC_spec(w_obs, flux_obs, np.ones(len(w_obs)), 0.1, 
+            prior=ifsps._default_prior(), nwalkers=20, burnin=10, niter=40, opt_maxiter=20)
+    assert ifsps_cache.dust_cache_info()['hit_rate'] > 0.25 
+
+
+def test_subspace_stretch_move(): 
+    # stretch moves of a subset of the parameters mixed with the full stretch
+    # move should sample the full posterior 
+    import emcee 
+    np.random.seed(0) 
+    mu = np.array([0., 1.]) 
+    cov = np.array([[1., 0.5], [0.5, 1.]]) 
+    icov = np.linalg.inv(cov) 
+    lnpost = lambda tt: -0.5 * np.sum(np.dot(tt - mu, icov) * (tt - mu), axis=1) 
+
+    move = Fitters.SubspaceStretchMove([1]) 
+    sampler = emcee.EnsembleSampler(20, 2, lnpost, vectorize=True, moves=move) 
+    sampler.run_mcmc(np.random.randn(20, 2), 10) 
+    chain = sampler.get_chain() 
+    assert np.all(chain[:,:,0] == chain[0,:,0]) # only the second parameter moves
+    
+    sampler = emcee.EnsembleSampler(20, 2, lnpost, vectorize=True, 
+            moves=[(emcee.moves.StretchMove(), 0.5), (move, 0.5)]) 
+    sampler.run_mcmc(np.random.randn(20, 2), 5000) 
+    chain = sampler.get_chain(discard=500, flat=True) 
+    assert np.allclose(np.mean(chain, axis=0), mu, atol=0.1) 
+    assert np.allclose(np.cov(chain.T), cov, atol=0.1)
+
+
+@pytest.mark.parametrize('model_name, tt', [
+    ('fsps', np.array([0.25, 0.25, 0.25, 0.25, 1e-2, 1e-2, 0.5, 10.])), 
+    ('fsps_complexdust', np.array([0.25, 0.25, 0.25, 0.25, 1e-2, 1e-2, 0.5, 0.5, -0.5, 10.]))])
+def test_iSpeculator_ssp_grid(model_name, tt): 
+    # SSP grid contraction should approximate the FSPS time bin loop, which is
+    # the default. The grid interpolates SSPs linearly and has no dust
+    # emission, so they only agree to a few percent in the optical 
+    iSpec = Fitters.iSpeculator(model_name=model_name, ssp_grid=True) 
+    iSpec_loop = Fitters.iSpeculator(model_name=model_name) 
+    assert iSpec._ssp_grid is not None and iSpec_loop._ssp_grid is None 
+
+    w, lum = iSpec._fsps_model(tt) 
+    w_loop, lum_loop = iSpec_loop._fsps_model(tt) 
+    optical = (w > 3000.) & (w < 2e4) 
+    assert np.allclose(w, w_loop) 
+    assert np.allclose(lum[optical], lum_loop[optical], rtol=0.05) 
+
+
+def test_iFSPS_native_mags(): 
+    # FSPS photometry with the built-in filters should match speclite photometry 
+    ifsps = Fitters.iFSPS(model_name='vanilla') 
+    ifsps_native = Fitters.iFSPS(model_name='vanilla') 
+    filters = Fitters.specFilter.load_filters(*tuple(ifsps._get_bands('desi')))
+    
+    prior = ifsps._default_prior() 
+    assert ifsps_native._native_mags_setup(filters, 0.1, prior)
+
+    tt = np.array([10., -1., 0.5, 2.]) 
+    photo = ifsps.model_photo(tt, zred=0.1, filters=filters) 
+    photo_native = ifsps_native.model_photo(tt, zred=0.1, filters=filters, native_mags=True) 
+    assert np.allclose(photo_native, photo, rtol=0.02) 
+
+    # after validating native photometry, native_mags=False still uses speclite 
+    assert np.array_equal(ifsps_native.model_photo(tt, zred=0.1, filters=filters), photo) 
+    lnpost = ifsps_native._lnPost_photo(tt, photo_native, np.ones(len(photo)), 0.1,
+            filters=filters, prior=prior) 
+    assert np.isclose(lnpost, -0.5 * np.sum((photo - photo_native)**2)) 
+
+
+def test_photo_emulator(tmpdir): 
+    # train a small photometry emulator, reload it and check its derivatives 
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    fphoto = str(tmpdir.join('photo_emulator.hdf5'))
+    iSpec.train_photo_emulator(fphoto, zmin=0.1, zmax=0.3, ntrain=1000, nz=2,
+            nhidden=[16], nepoch=5) 
+
+    iSpec_photo = Fitters.iSpeculator(model_name='emulator', photo_emulator=fphoto) 
+    _, _, zz = _emulator_fitter(3) 
+    filters = Fitters.specFilter.load_filters(*tuple(iSpec._get_bands('desi')))
+    
+    photo = iSpec.model_photo_batch(zz, zred=0.2, filters=filters, photo_emulator=True) 
+    assert np.allclose(photo, iSpec_photo.model_photo_batch(zz, zred=0.2,
+        filters=filters, photo_emulator=True))
+
+    _, dphoto = iSpec_photo.model_photo_batch(zz, zred=0.2, filters=filters, 
+            photo_emulator=True, grad=True) 
+    for i in range(zz.shape[1]): 
+        dzz = np.zeros(zz.shape[1]) 
+        dzz[i] = 1e-6 
+        dphoto_fd = (iSpec_photo.model_photo_batch(zz + dzz, zred=0.2, filters=filters, photo_emulator=True) - 
+                iSpec_photo.model_photo_batch(zz - dzz, zred=0.2, filters=filters, photo_emulator=True)) / 2e-6
+        assert np.allclose(dphoto[:,i,:], dphoto_fd, rtol=1e-4, atol=1e-6 * np.abs(photo).max())
+
+
+def test_delayed_acceptance(): 
+    # delayed acceptance with an approximate posterior should sample the exact
+    # posterior and skip the exact posterior for proposals rejected in the
+    # first stage
+    lnpost = lambda tt: -0.5 * np.sum(tt**2, axis=1) 
+    lnpost_approx = lambda tt: -0.5 * np.sum(((tt - 0.2)/1.2)**2, axis=1) 
+    
+    np.random.seed(0) 
+    move = Fitters.DelayedAcceptanceMove(lnpost_approx) 
+    sampler = Fitters.emcee.EnsembleSampler(20, 3, lnpost, vectorize=True, moves=move)
+    sampler.run_mcmc(np.random.randn(20, 3), 3000) 
+    chain = sampler.get_chain(discard=500, flat=True) 
+
+    assert np.all(np.abs(chain.mean(axis=0)) < 0.1) 
+    assert np.all(np.abs(chain.std(axis=0) - 1.) < 0.1) 
+    assert move.n_exact < move.n_proposed 
+
+
+@pytest.mark.parametrize('start_method', ['fork', 'spawn']) 
+def test_fitter_pool(start_method): 
+    # walkers evaluated in a process pool should match the serial evaluation.
+    # spawned processes rebuild the fitter from its pickled configuration 
+    iSpec, prior, zz = _emulator_fitter(10) 
+
+    pool = Fitters._FitterPool(iSpec, iSpec._lnPrior_batch, (), {'prior': prior}, 3, 
+            vectorize=True, start_method=start_method) 
+    lnp = pool(zz) 
+    pool.close() 
+    assert np.allclose(lnp, iSpec._lnPrior_batch(zz, prior=prior)) 
+
+    w = np.linspace(3600., 9800., 1000) 
+    _, flux = iSpec.model(zz[0], zred=0.2, wavelength=w) 
+    lnpost_args = (w, flux, np.ones(len(w)), 0.2) 
+    lnpost_kwargs = {'mask': np.zeros(len(w)).astype(bool), 'prior': prior} 
+    pool = Fitters._FitterPool(iSpec, iSpec._lnPost, lnpost_args, lnpost_kwargs, 2, 
+            vectorize=False, start_method=start_method) 
+    lnp = pool(zz) 
+    pool.close() 
+    assert np.allclose(lnp, [iSpec._lnPost(_zz, *lnpost_args, **lnpost_kwargs) for _zz in zz]) 
+
+
+def test_fitter_pool_state(): 
+    # non-vectorized log posterior that depends on the state of the fitter:
+    # forked workers should evaluate it with the fitter as it was when the
+    # pool was created, not with a freshly constructed one 
+    from astropy.cosmology import Planck13 
+
+    iSpec, prior, zz = _emulator_fitter(6) 
+
+    w = np.linspace(3600., 9800., 1000) 
+    _, flux = iSpec.model(zz[0], zred=0.2, wavelength=w) 
+    lnpost_args = (w, flux, np.ones(len(w)), 0.2) 
+    lnpost_kwargs = {'mask': np.zeros(len(w)).astype(bool), 'prior': prior} 
+    lnp_default = np.array([iSpec._lnPost(_zz, *lnpost_args, **lnpost_kwargs) for _zz in zz]) 
+
+    iSpec.cosmo = Planck13.clone(H0=50.) 
+    lnp_serial = np.array([iSpec._lnPost(_zz, *lnpost_args, **lnpost_kwargs) for _zz in zz]) 
+    assert not np.allclose(lnp_serial, lnp_default) 
+
+    pool = Fitters._FitterPool(iSpec, iSpec._lnPost, lnpost_args, lnpost_kwargs, 3, 
+            vectorize=False, start_method='fork') 
+    lnp = pool(zz) 
+    pool.close() 
+    assert lnp.shape == (len(zz),) 
+    assert np.allclose(lnp, lnp_serial) 
+
+
+def test_fitter_thread_pool(): 
+    # emulator evaluated in a thread pool should match the serial evaluation 
+    iSpec, prior, zz = _emulator_fitter(10) 
+    
+    w = np.linspace(3600., 9800., 1000) 
+    _, flux = iSpec.model(zz[0], zred=0.2, wavelength=w) 
+    lnpost_args = (w, flux, np.ones(len(w)), 0.2) 
+    lnpost_kwargs = {'mask': np.zeros(len(w)).astype(bool), 'prior': prior} 
+
+    pool = Fitters._FitterThreadPool(iSpec._lnPost_batch, lnpost_args,
+            lnpost_kwargs, 3, vectorize=True) 
+    lnp = pool(zz) 
+    pool.close() 
+    assert np.allclose(lnp, iSpec._lnPost_batch(zz, *lnpost_args, **lnpost_kwargs)) 
+
+
+def test_fitter_thread_pool_blas(monkeypatch): 
+    # the BLAS thread budget is passed from the MCMC methods to the thread pool 
+    iSpec, prior, zz = _emulator_fitter(1) 
+    w = np.linspace(3600., 9800., 500) 
+    _, flux = iSpec.model(zz[0], zred=0.2, wavelength=w) 
+
+    pools = [] 
+    class _ThreadPool(Fitters._FitterThreadPool): 
+        def __init__(self, *args, **kwargs): 
+            pools.append(kwargs['blas_threads']) 
+            super(_ThreadPool, self).__init__(*args, **kwargs) 
+    monkeypatch.setattr(Fitters, '_FitterThreadPool', _ThreadPool) 
+    iSpec.MCMC_spec(w, flux, np.ones(len(w)), 0.2, prior=prior, nwalkers=20, 
+            burnin=10, niter=20, opt_maxiter=10, nthreads=2, blas_threads=3) 
+    assert pools == [3] 
+
+
+
+def test_iSpeculator_fsps_nthreads(): 
+    # FSPS is not thread-safe, so walkers cannot be evaluated in threads 
+    iSpec = Fitters.iSpeculator(model_name='fsps', ssp_grid=False) 
+    prior = iSpec._default_prior()
+    w = np.linspace(3600., 9800., 1000) 
+    with pytest.raises(ValueError): 
+        iSpec.MCMC_spec(w, np.ones(len(w)), np.ones(len(w)), 0.2, prior=prior, nthreads=2) 
+    with pytest.raises(ValueError): 
+        iSpec.MCMC_spec(w, np.ones(len(w)), np.ones(len(w)), 0.2, prior=prior,
+                sampler='emcee_da', nthreads=2) 
+
+
+def test_iSpeculator_fsps_photo_emulator(tmpdir): 
+    # the photometry emulator is trained on the spectral emulator: it cannot
+    # replace FSPS and with delayed acceptance it only screens proposals 
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    fphoto = str(tmpdir.join('photo_emulator.hdf5'))
+    iSpec.train_photo_emulator(fphoto, zmin=0.1, zmax=0.3, ntrain=1000, nz=2,
+            nhidden=[16], nepoch=5) 
+
+    ifsps = Fitters.iSpeculator(model_name='fsps', photo_emulator=fphoto) 
+    prior = ifsps._default_prior()
+    filters = Fitters.specFilter.load_filters(*tuple(ifsps._get_bands('desi')))
+    photo = np.ones(len(filters.names)) 
+    with pytest.raises(ValueError): 
+        ifsps.MCMC_photo(photo, photo, 0.2, bands='desi', prior=prior, photo_emulator=True) 
+    with pytest.raises(ValueError): 
+        ifsps.model_photo_batch(prior(), zred=0.2, filters=filters, photo_emulator=True) 
+
+    calls = {} 
+    def _emcee(lnpost_fn, lnpost_args, lnpost_kwargs, moves=None, **kwargs): 
+        calls['exact'] = lnpost_kwargs 
+        calls['emulator'] = moves.lnpost_kwargs 
+        return np.zeros((1, prior.ndim)) 
+    ifsps._emcee = _emcee 
+    ifsps._emcee_delayed_acceptance('_lnPost_photo_batch', (photo, photo, 0.2), 
+            {'filters': filters, 'photo_emulator': True, 'prior': prior}) 
+    assert calls['emulator']['photo_emulator'] 
+    assert not calls['exact'].get('photo_emulator', False) 
+
+
+def test_fitter_pickle(): 
+    # only the configuration is pickled and the fitter is rebuilt on first use 
+    iSpec, _, zz = _emulator_fitter(5) 
+    w = np.linspace(3600., 9800., 1000) 
+
+    iSpec_pickle = pickle.loads(pickle.dumps(iSpec)) 
+    assert '_emu_W' not in iSpec_pickle.__dict__ 
+    assert iSpec_pickle.model_name == 'emulator' 
+    assert np.allclose(iSpec_pickle.model_batch(zz, zred=0.2, wavelength=w)[1], 
+            iSpec.model_batch(zz, zred=0.2, wavelength=w)[1])
+
+
+def test_convergence_monitor(): 
+    # PSRF from blockwise updates should match ACM on the full chain 
+    chain = np.random.normal(size=(300, 10, 3)) 
+    chain[:,:,2] += np.linspace(0., 1., 10) # unconverged parameter 
+
+    monitor = Fitters.ConvergenceMonitor(10, 3) 
+    for i in range(3): 
+        monitor.update(chain[i*100:(i+1)*100]) 
+    
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    flatchain = chain.reshape(-1, 3) 
+    psrf = [iSpec.ACM(flatchain[:,i], 10, 300, True)[1] for i in range(3)]
+    assert np.allclose(monitor.rhat(), psrf) 
+    assert not monitor.converged() 
+    assert np.all(monitor.ess() <= 3000) 
+
+
+def test_chain_backend(tmpdir): 
+    # chain streamed to disk should match the in-memory chain 
+    import emcee 
+    lnpost = lambda tt: -0.5 * np.sum(tt**2, axis=1) 
+    p0 = np.random.randn(10, 2) 
+
+    np.random.seed(0) 
+    sampler = emcee.EnsembleSampler(10, 2, lnpost, vectorize=True) 
+    sampler.run_mcmc(p0, 250) 
+
+    backend = Fitters.ChainBackend(str(tmpdir.join('chain.hdf5')), window=100) 
+    np.random.seed(0) 
+    sampler_disk = emcee.EnsembleSampler(10, 2, lnpost, vectorize=True, backend=backend)
+    sampler_disk.run_mcmc(p0, 250) 
+    assert backend.chain.shape[0] == 100 
+
+    for discard, thin in [(0, 1), (50, 3), (220, 1)]: 
+        assert np.allclose(sampler_disk.get_chain(discard=discard, thin=thin), 
+                sampler.get_chain(discard=discard, thin=thin)) 
+    
+    backend.flush() 
+    view = Fitters.ChainView(backend, thin=5) 
+    assert view.shape == (500, 2) 
+    assert np.allclose(np.asarray(view), sampler.get_chain(flat=True, thin=5)) 
+
+    # slices, percentiles and the hdf5 copy are read block by block 
+    chain = sampler.get_chain(flat=True, thin=5) 
+    view = Fitters.ChainView(backend, thin=5, block_size=64) 
+    for key in [3, -1, slice(None), slice(10, 300, 7), slice(None, None, -3), 
+            (slice(None), 0), (slice(-50, None), slice(1, 2)), (17, 1)]: 
+        assert np.array_equal(view[key], chain[key]) 
+    q = [2.5, 16, 50, 84, 97.5] 
+    assert np.allclose(view.percentile(q), np.percentile(chain, q, axis=0)) 
+    assert np.allclose(Fitters._chain_percentile(view, 50), np.median(chain, axis=0)) 
+
+    view2 = view.transformed(lambda tt: 2. * tt) 
+    assert np.allclose(view2[::4], 2. * chain[::4]) 
+    with h5py.File(str(tmpdir.join('output.hdf5')), 'w') as fh5: 
+        Fitters._write_chain(fh5, 'mcmc_chain', view2) 
+    with h5py.File(str(tmpdir.join('output.hdf5')), 'r') as fh5: 
+        assert np.allclose(fh5['mcmc_chain'][...], 2. * chain) 
+
+
+def test_chain_file_output(tmpdir): 
+    # a fit streamed to disk returns a lazily transformed view of the chain
+    # that matches the chain in memory 
+    iSpec, prior, zz = _emulator_fitter(1) 
+    w = np.linspace(3600., 9800., 500) 
+    _, flux = iSpec.model(zz[0], zred=0.2, wavelength=w) 
+    kwargs = {'prior': prior, 'nwalkers': 20, 'burnin': 10, 'niter': 60, 'opt_maxiter': 10}
+
+    np.random.seed(0) 
+    output = iSpec.MCMC_spec(w, flux, np.ones(len(w)), 0.2, **kwargs) 
+    np.random.seed(0) 
+    output_disk = iSpec.MCMC_spec(w, flux, np.ones(len(w)), 0.2, 
+            chain_file=str(tmpdir.join('chain.hdf5')), 
+            writeout=str(tmpdir.join('output.hdf5')), **kwargs) 
+
+    assert isinstance(output_disk['mcmc_chain'], Fitters.ChainView) 
+    assert np.allclose(np.asarray(output_disk['mcmc_chain']), output['mcmc_chain']) 
+    assert np.allclose(output_disk['theta_med'], output['theta_med']) 
+    with h5py.File(str(tmpdir.join('output.hdf5')), 'r') as fh5: 
+        assert np.allclose(fh5['mcmc_chain'][...], output['mcmc_chain']) 
+
+
+def test_emcee_resume(tmpdir): 
+    # an interrupted run resumed from its checkpoint should reproduce the
+    # uninterrupted chain 
+    ncall = [0, np.inf] 
+    def lnpost(tt, prior=None): 
+        ncall[0] += 1 
+        if ncall[0] > ncall[1]: raise KeyboardInterrupt 
+        return -0.5 * np.sum(tt**2, axis=1) 
+    prior = Fitters.UniformPrior(np.zeros(2) - 5., np.zeros(2) + 5.) 
+    emcee_kwargs = {'nwalkers': 8, 'burnin': 10, 'niter': 2500, 'opt_maxiter': 10, 'vectorize': True}
+
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    np.random.seed(0) 
+    chain = np.asarray(iSpec._emcee(lnpost, (), {'prior': prior}, 
+        chain_file=str(tmpdir.join('chain0.hdf5')), **emcee_kwargs))
+
+    ncall[:] = [0, ncall[0] - 1000]
+    np.random.seed(0) 
+    with pytest.raises(KeyboardInterrupt): 
+        iSpec._emcee(lnpost, (), {'prior': prior}, 
+                chain_file=str(tmpdir.join('chain1.hdf5')), **emcee_kwargs)
+    ncall[:] = [0, np.inf] 
+    chain_resume = np.asarray(iSpec._emcee(lnpost, (), {'prior': prior}, 
+        chain_file=str(tmpdir.join('chain1.hdf5')), resume=True, **emcee_kwargs))
+    assert np.array_equal(chain, chain_resume) 
+
+
+def test_convergence_monitor_tau(): 
+    # autocorrelation time of an AR(1) process: tau = (1 + phi) / (1 - phi) 
+    np.random.seed(0) 
+    phi = 0.8 
+    chain = np.zeros((20000, 32, 1)) 
+    eps = np.random.normal(size=chain.shape) 
+    for i in range(1, chain.shape[0]): 
+        chain[i] = phi * chain[i-1] + eps[i]
+
+    monitor = Fitters.ConvergenceMonitor(32, 1) 
+    for i in range(0, chain.shape[0], 777): 
+        monitor.update(chain[i:i+777]) 
+    assert np.allclose(monitor.batch_sums.sum(axis=0) + monitor.partial_sum, chain.sum(axis=0)) 
+    assert np.abs(monitor.tau()[0] / ((1. + phi) / (1. - phi)) - 1.) < 0.3 
+
+
+def test_convergence_monitor_degenerate(): 
+    # constant parameters and stuck walkers do not produce NaNs or warnings 
+    np.random.seed(0) 
+    chain = np.random.normal(size=(2000, 8, 3)) 
+    chain[:,:,1] = 0.5 # constant parameter 
+    chain[:,:,2] = np.arange(8) # stuck walkers 
+
+    monitor = Fitters.ConvergenceMonitor(8, 3) 
+    with warnings.catch_warnings(): 
+        warnings.simplefilter('error') 
+        monitor.update(chain) 
+        rhat, ess, tau = monitor.rhat(), monitor.ess(), monitor.tau() 
+    assert np.array_equal(rhat[1:], [1., np.inf]) 
+    assert ess[1] == 8 * 2000 
+    assert np.all(np.isfinite(ess)) 
+    assert np.isfinite(tau[0]) and np.all(np.isnan(tau[1:])) 
+
+
+def test_emcee_autocorr_undefined(monkeypatch): 
+    # stop='autocorr' ignores parameters with an undefined autocorrelation
+    # time and only runs to maxiter if none of them has one 
+    lnpost = lambda tt, prior=None: -0.5 * np.sum(tt**2, axis=1) 
+    prior = Fitters.UniformPrior(np.zeros(2) - 5., np.zeros(2) + 5.) 
+    emcee_kwargs = {'nwalkers': 16, 'burnin': 100, 'niter': 'adaptive', 'stop': 'autocorr', 
+            'maxiter': 20000, 'opt_maxiter': 10, 'vectorize': True} 
+
+    undefined = [1] 
+    class _Monitor(Fitters.ConvergenceMonitor): 
+        def tau(self): 
+            tau = super(_Monitor, self).tau() 
+            tau[undefined] = np.nan 
+            return tau 
+    monkeypatch.setattr(Fitters, 'ConvergenceMonitor', _Monitor) 
+
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    np.random.seed(0) 
+    chain = iSpec._emcee(lnpost, (), {'prior': prior}, **emcee_kwargs) 
+    assert iSpec.sampler.iteration < 20000 
+    assert chain.shape[0] < 16 * iSpec.sampler.iteration 
+
+    undefined[:] = [0, 1] 
+    chain = iSpec._emcee(lnpost, (), {'prior': prior}, **emcee_kwargs) 
+    assert iSpec.sampler.iteration == 20000 
+    assert chain.shape[0] == 16 * 20000 
+
+
+def test_emcee_autocorr_thin(): 
+    # with stop='autocorr' the chain is thinned by the autocorrelation time 
+    lnpost = lambda tt, prior=None: -0.5 * np.sum(tt**2, axis=1) 
+    prior = Fitters.UniformPrior(np.zeros(2) - 5., np.zeros(2) + 5.) 
+
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    np.random.seed(0) 
+    chain = iSpec._emcee(lnpost, (), {'prior': prior}, nwalkers=16, burnin=100, 
+            niter='adaptive', stop='autocorr', opt_maxiter=10, vectorize=True) 
+    thin = int(np.ceil(np.max(iSpec.autocorr_time))) 
+    assert thin > 1 
+    assert chain.shape == (16 * (iSpec.sampler.iteration // thin), 2) 
+
+
+def test_multistart(): 
+    # starting from the middle of the prior finds the minor mode. the
+    # multi-start initialization should put walkers around both modes 
+    def lnpost(tt, prior=None, grad=False): 
+        l0 = -0.5 * np.sum((tt + 2.)**2, axis=1) / 0.01 + np.log(0.05) 
+        l1 = -0.5 * np.sum((tt - 3.)**2, axis=1) / 0.01 
+        lp = np.logaddexp(l0, l1) 
+        if not grad: return lp 
+        w0 = np.exp(l0 - lp)[:,None] 
+        w1 = np.exp(l1 - lp)[:,None] 
+        return lp, -(w0 * (tt + 2.) + w1 * (tt - 3.)) / 0.01 
+    prior = Fitters.UniformPrior(np.zeros(3) - 5., np.zeros(3) + 5.) 
+
+    iSpec = Fitters.iSpeculator(model_name='emulator') 
+    np.random.seed(1) 
+    tt0 = iSpec._optimize(lnpost, (), {'prior': prior}, opt_maxiter=300, vectorize=True)
+    assert np.allclose(tt0, -2., atol=1e-3) 
+
+    for grad in [False, True]: 
+        p0 = iSpec._multistart(lnpost, (), {'prior': prior}, 32, vectorize=True, grad=grad)
+        assert p0.shape == (32, 3) 
+        assert np.all(np.isfinite(iSpec._lnPrior_batch(p0, prior=prior))) 
+        near = [np.sum(np.all(np.abs(p0 - mu) < 1., axis=1)) for mu in [-2., 3.]]
+        assert near[0] >= 10 and near[1] >= 10 
+
+
+def test_warm_start(tmpdir): 
+    # the inverse SFH transform should recover the warped manifold 
+    iSpec, _, zz = _emulator_fitter(100) 
+    xx = iSpec._transform_to_SFH_basis(zz[:,1:5]) 
+    assert np.allclose(iSpec._transform_from_SFH_basis(xx), zz[:,1:4]) 
+
+    # walkers from a photometric chain (in the SFH basis) with f_fiber added 
+    np.random.seed(0) 
+    prior = iSpec._default_prior(f_fiber_prior=[0.1, 1.]) 
+    zz = np.tile(zz[0], (500, 1)) 
+    zz[:,0] += 0.01 * np.random.randn(500) 
+    chain = zz.copy() 
+    chain[:,1:5] = iSpec._transform_to_SFH_basis(zz[:,1:5]) 
+
+    zz_med = np.median(zz, axis=0) 
+    zz_med[4] = 0.5 # beta4' is redrawn from its prior 
+    wave = np.linspace(4000., 5000., 100) 
+    flux = 0.3 * iSpec.model(zz_med, zred=0.1, wavelength=wave)[1] 
+    
+    with h5py.File(str(tmpdir.join('photo.hdf5')), 'w') as fh5: 
+        fh5.create_dataset('mcmc_chain', data=chain) 
+    for warm_start in [{'mcmc_chain': chain}, str(tmpdir.join('photo.hdf5'))]: 
+        p0 = iSpec._warm_start(warm_start, 20, prior, wave, flux, np.ones(100), 0.1, 
+                mask=np.zeros(100).astype(bool)) 
+        assert p0.shape == (20, prior.ndim) 
+        assert np.all(np.isfinite(iSpec._lnPrior_batch(p0, prior=prior))) 
+        assert np.allclose(p0[:,1:4], zz[0,1:4], atol=1e-3) 
+        assert np.abs(np.median(p0[:,-1]) - 0.3) < 0.05 
+        assert len(np.unique(p0[:,0])) == 20